@@ -8,6 +8,7 @@ setup(
     # Project uses reStructuredText, so ensure that the docutils get
     # installed or upgraded on the target machine
     install_requires=['docutils>=0.3'],
+    extras_require={'packets': ['numpy']},  # packets.py bitrate profiles
 
     # package_data={
     #     # If any package contains *.txt or *.rst files, include them:
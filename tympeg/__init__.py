@@ -1,8 +1,20 @@
 from .timecode import split_timecode, concat_timecode, add_timecodes, subtract_timecodes, \
                       timecode_to_seconds, seconds_to_timecode, simplify_timecode
-from .mediaobject import MediaObject, makeMediaObjectsInDirectory
+from .mediaobject import MediaObject, makeMediaObjectsInDirectory, iterMediaObjects, probe, probe_many
+from .discovery import find_media_files, is_media_header, has_media_extension
+from .mediastream import MediaStream
+from .streamindex import StreamIndex, MultiStreamIndex
+from .probecache import ProbeCache, enable_probe_cache, set_default_probe_cache, get_default_probe_cache
+from .catalog import Catalog
+from .keyframes import KeyframeIndex, get_keyframe_index
+from .packets import BitrateProfile, StreamProfile, analyze_packets, get_bitrate_profile
+from .quality import CrfEstimate, find_crf
 from .converter import MediaConverter
+from .progress import ConversionProgress, parse_progress
 from .queue import MediaConverterQueue
+from .adaptive import AdaptiveController
+from .jobjournal import JobJournal, JournalJob
+from .distributed import JobCoordinator, ConversionWorker
 from .concat import ffConcat, concat_files_in_directory
 from .util import split_ext, list_dirs, list_files, get_dir_size, MBtokb, renameFile, get_dir_size_recursive
 from .streamsaver import StreamSaver
@@ -0,0 +1,219 @@
+import json
+import os
+import signal
+import time
+from collections import deque
+
+
+class AdaptiveController:
+    """ Adjusts how many jobs a MediaConverterQueue runs at once from the load on the machine, for boxes shared with
+     other work. Every interval it samples /proc/loadavg, /proc/pressure/cpu and available memory, lowers the
+     queue's max_processes when the machine is busy and raises it when there are idle cores, one step at a time and
+     at most once per cooldown. Running jobs are never killed, a lower limit just holds back new ones.
+
+     When available memory drops under memory_pause a running job is paused with SIGSTOP, the newest first, down to
+     one running job. Paused jobs get SIGCONT once available memory is back over memory_resume.
+
+     Every decision is kept in self.decisions, and appended to log_path as a line of json if it's set.
+
+    """
+    def __init__(self, min_processes=1, max_processes=None, target_load=1.0, pressure_high=40.0, pressure_low=10.0,
+                 memory_low=0.15, memory_pause=0.05, memory_resume=0.15, interval=5.0, cooldown=30.0, log_path=''):
+        """
+
+        :param min_processes: int, fewest jobs to allow at once
+        :param max_processes: int, most jobs to allow at once. Defaults to the number of cores.
+        :param target_load: float, 1 minute load average per core to aim for
+        :param pressure_high: float, /proc/pressure/cpu 'some avg10' percent over which the limit shrinks
+        :param pressure_low: float, cpu pressure percent under which the limit can grow
+        :param memory_low: float, fraction of memory available under which the limit shrinks
+        :param memory_pause: float, fraction of memory available under which running jobs are paused
+        :param memory_resume: float, fraction of memory available over which paused jobs continue
+        :param interval: float, seconds between samples
+        :param cooldown: float, seconds to hold the limit after changing it, the load average lags behind
+        :param log_path: string, file to append decisions to, one json object per line
+        """
+        self.min_processes = max(1, min_processes)
+        self.max_processes = max_processes if max_processes is not None else (os.cpu_count() or 1)
+        self.target_load = target_load
+        self.pressure_high = pressure_high
+        self.pressure_low = pressure_low
+        self.memory_low = memory_low
+        self.memory_pause = memory_pause
+        self.memory_resume = memory_resume
+        self.interval = interval
+        self.cooldown = cooldown
+        self.log_path = log_path
+
+        self.cores = os.cpu_count() or 1
+        self.paused = []  # Paused processes, in the order they were paused
+        self.decisions = deque(maxlen=10000)
+        self.last_change = 0.0
+
+    def sample(self):
+        """ Reads the machine's load. Values the kernel doesn't provide are None.
+
+        :return: dict, 'load' 1 minute load average per core, 'cpu_pressure' percent of time tasks waited on cpu
+                 over the last 10 seconds, 'memory_available' fraction of memory available
+        """
+        return {'load': read_loadavg(self.cores), 'cpu_pressure': read_cpu_pressure(),
+                'memory_available': read_memory_available()}
+
+    def update(self, queue):
+        """ Samples the machine and adjusts the queue, called by the queue's dispatcher every self.interval seconds.
+
+        :param queue: MediaConverterQueue
+        :return: dict, the decision, see decide()
+        """
+        self.paused = [process for process in self.paused if process.is_alive()]
+        running = [process for process in queue.processes if process.is_alive() and process not in self.paused]
+        decision = self.decide(self.sample(), len(running), queue.max_processes)
+
+        if decision['action'] == 'pause':
+            process = running[-1]
+            signal_tree(process.pid, signal.SIGSTOP)
+            self.paused.append(process)
+        elif decision['action'] == 'resume':
+            process = self.paused.pop(0)
+            signal_tree(process.pid, signal.SIGCONT)
+        elif decision['action'] in ('grow', 'shrink'):
+            self.last_change = decision['time']
+        queue.max_processes = decision['limit']
+
+        self.record(decision)
+        return decision
+
+    def decide(self, sample, running, limit):
+        """ Picks what to do about a sample: 'pause' or 'resume' a job, 'grow' or 'shrink' the limit, or 'hold'.
+
+        :param sample: dict, from sample()
+        :param running: int, jobs running and not paused
+        :param limit: int, current limit on jobs at once
+        :return: dict, the sample, running and paused job counts, the new limit, action and time
+        """
+        now = time.time()
+        load = sample['load']
+        pressure = sample['cpu_pressure']
+        memory = sample['memory_available']
+        bounded = min(max(limit, self.min_processes), self.max_processes)
+        action = 'hold'
+
+        if memory is not None and memory < self.memory_pause and running > 1:
+            action = 'pause'
+        elif memory is not None and memory > self.memory_resume and self.paused:
+            action = 'resume'
+        elif now - self.last_change >= self.cooldown:
+            busy = (load is not None and load > self.target_load) or \
+                   (pressure is not None and pressure > self.pressure_high) or \
+                   (memory is not None and memory < self.memory_low)
+            idle = (load is None or load < self.target_load - 1 / self.cores) and \
+                   (pressure is None or pressure < self.pressure_low)
+            if busy and bounded > self.min_processes:
+                action = 'shrink'
+                bounded -= 1
+            elif idle and not busy and bounded < self.max_processes and running >= bounded:
+                # Only grow a limit that's in use, a queue that's running out of jobs doesn't need more room
+                action = 'grow'
+                bounded += 1
+
+        decision = dict(sample)
+        decision.update({'time': now, 'running': running, 'paused': len(self.paused), 'limit': bounded,
+                         'action': action})
+        return decision
+
+    def resume_all(self):
+        """ Continues every paused job.
+
+        :return:
+        """
+        for process in self.paused:
+            if process.is_alive():
+                signal_tree(process.pid, signal.SIGCONT)
+        self.paused = []
+
+    def record(self, decision):
+        self.decisions.append(decision)
+        if self.log_path != '':
+            with open(self.log_path, 'a') as log:
+                log.write(json.dumps(decision) + "\n")
+
+
+def read_loadavg(cores=None):
+    """ 1 minute load average from /proc/loadavg.
+
+    :param cores: int, divide the load by this many cores
+    :return: float, None if it can't be read
+    """
+    try:
+        with open('/proc/loadavg') as file:
+            load = float(file.read().split()[0])
+    except (OSError, ValueError, IndexError):
+        return None
+    return load / cores if cores else load
+
+
+def read_cpu_pressure():
+    """ Share of the last 10 seconds some tasks waited on the cpu, from /proc/pressure/cpu (Linux 4.20+).
+
+    :return: float, percent, None if pressure stall information isn't available
+    """
+    try:
+        with open('/proc/pressure/cpu') as file:
+            for line in file:
+                fields = line.split()
+                if fields and fields[0] == 'some':
+                    for field in fields[1:]:
+                        key, _, value = field.partition('=')
+                        if key == 'avg10':
+                            return float(value)
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def read_memory_available():
+    """ Fraction of memory available to start new programs without swapping, from /proc/meminfo.
+
+    :return: float, None if it can't be read
+    """
+    values = {}
+    try:
+        with open('/proc/meminfo') as file:
+            for line in file:
+                key, _, value = line.partition(':')
+                if key in ('MemTotal', 'MemAvailable'):
+                    values[key] = int(value.split()[0])
+    except (OSError, ValueError, IndexError):
+        return None
+    if values.get('MemTotal', 0) <= 0 or 'MemAvailable' not in values:
+        return None
+    return values['MemAvailable'] / values['MemTotal']
+
+
+def signal_tree(pid, signum):
+    """ Sends a signal to a process and all of it's descendants, a job's ffmpeg runs as a child of it's process.
+
+    :param pid: int, process id
+    :param signum: int, signal to send
+    :return:
+    """
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open('/proc/{}/stat'.format(entry)) as file:
+                # The command name is in parentheses and can hold spaces, the parent pid is 2 fields after it
+                parent = int(file.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, ValueError, IndexError):
+            continue
+        children.setdefault(parent, []).append(int(entry))
+
+    pending = [pid]
+    while pending:
+        current = pending.pop()
+        try:
+            os.kill(current, signum)
+        except ProcessLookupError:
+            continue
+        pending.extend(children.get(current, []))
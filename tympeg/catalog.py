@@ -0,0 +1,464 @@
+import json
+import sqlite3
+import threading
+import time
+from os import path, makedirs, stat
+
+from .mediaobject import iterMediaObjects
+from .discovery import find_media_files, media_extensions
+from .probecache import file_key
+from .util import list_entries
+
+
+class Catalog:
+    """ Local SQLite database of probed media files: sizes, codecs, durations, dimensions and derived metrics like
+     bits/pixel, indexed so library wide questions ("which files in each directory aren't hevc, and how big are
+     they") are answered with a query instead of a walk and a probe of every file. scan() and refresh() bring
+     entries up to date, only probing files whose size, mtime or inode changed.
+
+    """
+    # Columns of the media table, in table order
+    columns = ('path', 'directory', 'file_name', 'size', 'mtime_ns', 'inode', 'valid', 'video_codec', 'codecs',
+               'stream_types', 'duration', 'width', 'height', 'framerate', 'bitrate', 'video_bitrate',
+               'audio_bitrate', 'bits_per_pixel', 'probe_profile', 'scanned', 'probe')
+
+    # Operators select() accepts in conditions, and the SQL they become
+    operators = {'=': '= ?', '!=': '!= ?', '<': '< ?', '<=': '<= ?', '>': '> ?', '>=': '>= ?', 'like': 'LIKE ?',
+                 'in': 'IN', 'not in': 'NOT IN', 'under': "LIKE ? ESCAPE '\\'"}
+
+    def __init__(self, db_path='', keep_probe=False):
+        """
+
+        :param db_path: string, path of the catalog database. Defaults to ~/.cache/tympeg/catalog.sqlite3
+        :param keep_probe: bool, also store each file's ffprobe json output in the 'probe' column
+        """
+        if db_path == '':
+            db_path = path.join(path.expanduser('~'), '.cache', 'tympeg', 'catalog.sqlite3')
+        directory = path.dirname(path.abspath(db_path))
+        if not path.isdir(directory):
+            makedirs(directory)
+
+        self.db_path = db_path
+        self.keep_probe = keep_probe
+        self._lock = threading.Lock()
+
+        self._connection = sqlite3.connect(self.db_path, check_same_thread=False)
+        self._connection.row_factory = sqlite3.Row
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.execute('CREATE TABLE IF NOT EXISTS media ('
+                                 'path TEXT PRIMARY KEY, directory TEXT NOT NULL, file_name TEXT NOT NULL, '
+                                 'size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, inode INTEGER NOT NULL, '
+                                 'valid INTEGER NOT NULL, video_codec TEXT NOT NULL, codecs TEXT NOT NULL, '
+                                 'stream_types TEXT NOT NULL, duration REAL NOT NULL, width INTEGER NOT NULL, '
+                                 'height INTEGER NOT NULL, framerate REAL NOT NULL, bitrate INTEGER NOT NULL, '
+                                 'video_bitrate REAL NOT NULL, audio_bitrate REAL NOT NULL, '
+                                 'bits_per_pixel REAL NOT NULL, probe_profile TEXT NOT NULL, scanned REAL NOT NULL, '
+                                 'probe TEXT)')
+        for column in ['directory', 'video_codec', 'size', 'bits_per_pixel']:
+            self._connection.execute('CREATE INDEX IF NOT EXISTS media_{0} ON media ({0})'.format(column))
+
+        # Directory mtimes and listings for refresh_tree(), and the journal of changes it found
+        self._connection.execute('CREATE TABLE IF NOT EXISTS directories ('
+                                 'path TEXT PRIMARY KEY, mtime_ns INTEGER NOT NULL, files TEXT NOT NULL, '
+                                 'subdirectories TEXT NOT NULL)')
+        self._connection.execute('CREATE TABLE IF NOT EXISTS journal ('
+                                 'id INTEGER PRIMARY KEY AUTOINCREMENT, time REAL NOT NULL, change TEXT NOT NULL, '
+                                 'path TEXT NOT NULL)')
+        self._connection.commit()
+
+    def scan(self, directory, recursive=True, workers=None, probe_profile='fast', sniff=False,
+             extensions=media_extensions):
+        """ Brings the catalog up to date with the media files under a directory. New files and files whose size,
+         mtime or inode changed are probed, unchanged files aren't, and entries of files that are gone are removed.
+
+        :param directory: string, path of directory to scan
+        :param recursive: bool, scan sub directories too
+        :param workers: int, number of ffprobe calls to run at once. Defaults to the number of cores.
+        :param probe_profile: string, 'full' or 'fast', see MediaObject()
+        :param sniff: bool, skip files whose header isn't a media container, see find_media_files()
+        :param extensions: iterable[string], suffixes of media files
+        :return: (int, int), number of files probed and number of entries removed
+        """
+        directory = path.abspath(directory)
+        known = {row['path']: (row['size'], row['mtime_ns'], row['inode'])
+                 for row in self._execute('SELECT path, size, mtime_ns, inode FROM media WHERE path '
+                                          + Catalog.operators['under'],
+                                          (_under_pattern(directory),))}
+        if not recursive:
+            known = {file_path: key for file_path, key in known.items() if path.dirname(file_path) == directory}
+
+        found = set()
+
+        def changed():
+            for file_path in find_media_files(directory, recursive, extensions, sniff):
+                found.add(file_path)
+                try:
+                    key = file_key(file_path)
+                except OSError:
+                    continue
+                if known.get(file_path) != key:
+                    yield file_path
+
+        probed = self.add(iterMediaObjects(changed(), workers, probeProfile=probe_profile))
+        removed = self.remove([file_path for file_path in known if file_path not in found])
+        return probed, removed
+
+    def refresh(self, file_paths, workers=None, probe_profile='fast'):
+        """ Re-probes specific files. Paths that no longer exist are removed from the catalog.
+
+        :param file_paths: iterable[string], paths of media files
+        :param workers: int, number of ffprobe calls to run at once. Defaults to the number of cores.
+        :param probe_profile: string, 'full' or 'fast', see MediaObject()
+        :return: (int, int), number of files probed and number of entries removed
+        """
+        existing = []
+        missing = []
+        for file_path in file_paths:
+            file_path = path.abspath(file_path)
+            if path.isfile(file_path):
+                existing.append(file_path)
+            else:
+                missing.append(file_path)
+        return self.add(iterMediaObjects(existing, workers, probeProfile=probe_profile)), self.remove(missing)
+
+    def refresh_tree(self, directory, extensions=media_extensions, check_files=False, probe=True, workers=None,
+                     probe_profile='fast'):
+        """ Incrementally refreshes the catalog of a tree. Directory mtimes and listings are stored, and only
+         directories whose mtime changed are listed again, the rest are just stat()ed to check their mtime. Added,
+         removed and modified media files are written to the change journal, see journal().
+
+         A directory's mtime only changes when entries are added, removed or renamed in it, not when a file's
+         contents are rewritten in place. check_files=True also stat()s the known files of unchanged directories to
+         catch those, which is still far cheaper than listing them.
+
+         When probing, the new listings and the journal are only stored once the changes are in the catalog, so an
+         interrupted refresh finds the same changes again. Known files of unchanged directories without a catalog
+         entry, left by an earlier refresh with probe=False, are probed too, without being journaled again.
+
+        :param directory: string, path of directory to refresh
+        :param extensions: iterable[string], suffixes of media files
+        :param check_files: bool, also check the files of unchanged directories for in place modifications
+        :param probe: bool, probe added and modified files and remove entries of removed ones from the catalog
+        :param workers: int, number of ffprobe calls to run at once. Defaults to the number of cores.
+        :param probe_profile: string, 'full' or 'fast', see MediaObject()
+        :return: list[(string, string)], ('added', 'removed' or 'modified', path) of each change, also journaled
+        """
+        directory = path.abspath(directory)
+        extensions = tuple(extension.lower() for extension in extensions)
+        under = _under_pattern(directory)
+        stored = {row['path']: row for row in self._execute(
+            'SELECT path, mtime_ns, files, subdirectories FROM directories WHERE path = ? OR path '
+            + Catalog.operators['under'], (directory, under))}
+
+        catalogued = set()
+        if probe:
+            catalogued = {row['path'] for row in self._execute(
+                'SELECT path FROM media WHERE path ' + Catalog.operators['under'], (under,))}
+
+        changes = []
+        unprobed = []  # Known files missing from the catalog
+        listed = []
+        visited = set()
+        pending = [directory]
+        while pending:
+            current = pending.pop()
+            try:
+                mtime_ns = stat(current).st_mtime_ns
+            except OSError:
+                continue
+
+            entry = stored.get(current)
+            if entry is not None and entry['mtime_ns'] == mtime_ns:
+                visited.add(current)
+                files = json.loads(entry['files'])
+                if probe:
+                    for name in sorted(files):
+                        file_path = path.join(current, name)
+                        if file_path not in catalogued:
+                            unprobed.append(file_path)
+                if check_files:
+                    modified = False
+                    for name in sorted(files):
+                        file_path = path.join(current, name)
+                        try:
+                            key = list(file_key(file_path))
+                        except OSError:
+                            continue  # Removing it would have changed the directory's mtime
+                        if key != files[name]:
+                            changes.append(('modified', file_path))
+                            files[name] = key
+                            modified = True
+                    if modified:
+                        listed.append((current, mtime_ns, json.dumps(files), entry['subdirectories']))
+                pending.extend(reversed(json.loads(entry['subdirectories'])))
+                continue
+
+            try:
+                files, subdirectories = list_entries(current)
+            except OSError:
+                continue
+            visited.add(current)
+            files = {name: key for name, key in files.items() if name.lower().endswith(extensions)}
+            if entry is not None:
+                known = {name: tuple(key) for name, key in json.loads(entry['files']).items()}
+            else:
+                # First refresh of this directory, diff against what scan() put in the catalog
+                known = {row['file_name']: (row['size'], row['mtime_ns'], row['inode']) for row in
+                         self._execute('SELECT file_name, size, mtime_ns, inode FROM media WHERE directory = ?',
+                                       (current,))}
+
+            for name, key in sorted(files.items()):
+                if name not in known:
+                    changes.append(('added', path.join(current, name)))
+                elif known[name] != key:
+                    changes.append(('modified', path.join(current, name)))
+            for name in sorted(known):
+                if name not in files:
+                    changes.append(('removed', path.join(current, name)))
+
+            listed.append((current, mtime_ns, json.dumps(files), json.dumps(sorted(subdirectories))))
+            pending.extend(sorted(subdirectories, reverse=True))
+
+        # Directories that are gone, or no longer reachable, take their files with them
+        gone = [entry for directory_path, entry in stored.items() if directory_path not in visited]
+        for entry in gone:
+            for name in sorted(json.loads(entry['files'])):
+                changes.append(('removed', path.join(entry['path'], name)))
+
+        if probe:
+            probed = list(dict.fromkeys([file_path for change, file_path in changes if change != 'removed']
+                                        + unprobed))
+            self.add(iterMediaObjects(probed, workers, probeProfile=probe_profile))
+            self.remove([file_path for change, file_path in changes if change == 'removed'])
+
+        now = time.time()
+        with self._lock:
+            self._connection.executemany('INSERT OR REPLACE INTO directories VALUES (?, ?, ?, ?)', listed)
+            self._connection.executemany('DELETE FROM directories WHERE path = ?', [(entry['path'],) for entry in gone])
+            self._connection.executemany('INSERT INTO journal (time, change, path) VALUES (?, ?, ?)',
+                                         [(now, change, file_path) for change, file_path in changes])
+            self._connection.commit()
+        return changes
+
+    def journal(self, since=0, directory=None):
+        """ Gets changes refresh_tree() found. Consumers can remember the last id they handled and ask for the
+         changes after it.
+
+        :param since: int, only return changes with a greater id
+        :param directory: string, only return changes to files under this directory
+        :return: list[dict], {'id': int, 'time': float, 'change': 'added', 'removed' or 'modified', 'path': string}
+        """
+        query = 'SELECT id, time, change, path FROM journal WHERE id > ?'
+        params = [since]
+        if directory is not None:
+            query += ' AND path ' + Catalog.operators['under']
+            params.append(_under_pattern(directory))
+        return [dict(row) for row in self._execute(query + ' ORDER BY id', params)]
+
+    def trim_journal(self, before):
+        """ Removes journal entries every consumer has handled.
+
+        :param before: int, remove changes with an id up to and including this
+        :return: int, number of entries removed
+        """
+        with self._lock:
+            removed = self._connection.execute('DELETE FROM journal WHERE id <= ?', (before,)).rowcount
+            self._connection.commit()
+        return removed
+
+    def add(self, media_objects):
+        """ Adds or replaces the entries of run MediaObjects.
+
+        :param media_objects: iterable[MediaObject]
+        :return: int, number of entries written
+        """
+        # media_objects is often a generator running ffprobe, the lock is only held to write each batch of rows so
+        # queries from other threads aren't held up by the scan
+        count = 0
+        rows = []
+        for media in media_objects:
+            try:
+                rows.append(self.entry(media))
+            except OSError:  # Removed since it was probed
+                continue
+            if len(rows) >= 500:
+                count += self.write_entries(rows)
+                rows = []
+        return count + self.write_entries(rows)
+
+    def write_entries(self, rows):
+        """ Adds or replaces entries in one transaction.
+
+        :param rows: list[tuple], values of Catalog.columns, see entry()
+        :return: int, number of entries written
+        """
+        if rows:
+            with self._lock:
+                self._connection.executemany('INSERT OR REPLACE INTO media VALUES ({})'.format(
+                    ', '.join('?' * len(Catalog.columns))), rows)
+                self._connection.commit()
+        return len(rows)
+
+    def entry(self, media):
+        """ Makes the row of a run MediaObject.
+
+        :param media: MediaObject
+        :return: tuple, values of Catalog.columns
+        """
+        file_path = path.abspath(media.filePath)
+        size, mtime_ns, inode = file_key(file_path)
+        if media.fileIsValid:
+            video_codecs = media.videoCodecs()
+            framerate = media.framerate_dec if media.width else 0.0
+            row = (','.join(video_codecs), ','.join(media.codecs), ','.join(media.streamTypes), media.duration,
+                   media.width, media.height, framerate, media.bitrate, media.video_bitrate, media.audio_bitrate,
+                   bits_per_pixel(media.video_bitrate, media.width, media.height, framerate))
+        else:
+            row = ('', '', '', -1.0, 0, 0, 0.0, 0, 0, 0, -1.0)
+
+        probe = None
+        if self.keep_probe and media.fileIsValid:
+            probe = media.ffprobeOut or None
+
+        return (file_path, path.dirname(file_path), path.basename(file_path), size, mtime_ns, inode,
+                int(media.fileIsValid)) + row + (media.probeProfile, time.time(), probe)
+
+    def remove(self, file_paths):
+        """ Removes entries from the catalog.
+
+        :param file_paths: iterable[string], paths of media files
+        :return: int, number of entries removed
+        """
+        with self._lock:
+            removed = 0
+            for file_path in file_paths:
+                removed += self._connection.execute('DELETE FROM media WHERE path = ?',
+                                                    (path.abspath(file_path),)).rowcount
+            self._connection.commit()
+        return removed
+
+    def select(self, conditions=(), columns=None, order_by=None, limit=None):
+        """ Finds entries matching every condition.
+
+            catalog.select([('path', 'under', '/media/'), ('video_codec', '!=', 'hevc'), ('size', '>', 10**9)])
+
+        :param conditions: iterable[(string, string, value)], (column, operator, value) tuples. Operators are
+                           '=', '!=', '<', '<=', '>', '>=', 'like', 'in' and 'not in' (value is a list), and 'under'
+                           (value is a directory, matches paths anywhere below it).
+        :param columns: list[string], columns to return, all of them by default
+        :param order_by: string or list[string], columns to sort by, prefix with '-' for descending
+        :param limit: int, maximum number of entries returned
+        :return: list[dict], entries
+        """
+        if columns is None:
+            columns = Catalog.columns
+        for column in columns:
+            _check_column(column)
+
+        where, params = _where(conditions)
+        query = 'SELECT {} FROM media{}'.format(', '.join(columns), where)
+        if order_by is not None:
+            query += _order_by(order_by)
+        if limit is not None:
+            query += ' LIMIT ?'
+            params.append(int(limit))
+        return [dict(row) for row in self._execute(query, params)]
+
+    def group(self, by, conditions=(), order_by=None):
+        """ Counts and totals the entries matching every condition, grouped by a column.
+
+            catalog.group('directory', [('video_codec', '!=', 'hevc'), ('size', '>', 10**9)])
+
+        :param by: string, column to group by, usually 'directory'
+        :param conditions: iterable[(string, string, value)], see select()
+        :param order_by: string or list[string], columns of the result to sort by, prefix with '-' for descending
+        :return: list[dict], {by: value, 'count': int, 'size': int, 'duration': float} for each group
+        """
+        _check_column(by)
+        where, params = _where(conditions)
+        query = 'SELECT {0}, COUNT(*) AS count, SUM(size) AS size, SUM(MAX(duration, 0)) AS duration ' \
+                'FROM media{1} GROUP BY {0}'.format(by, where)
+        if order_by is not None:
+            query += _order_by(order_by, (by, 'count', 'size', 'duration'))
+        return [dict(row) for row in self._execute(query, params)]
+
+    def __len__(self):
+        return self._execute('SELECT COUNT(*) FROM media', ())[0][0]
+
+    def _execute(self, query, params):
+        with self._lock:
+            return self._connection.execute(query, params).fetchall()
+
+    def clear(self):
+        """ Removes every entry in the catalog, the stored directory listings and the journal.
+
+        :return:
+        """
+        with self._lock:
+            for table in ['media', 'directories', 'journal']:
+                self._connection.execute('DELETE FROM ' + table)
+            self._connection.commit()
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+def bits_per_pixel(video_bitrate, width, height, framerate):
+    """ Video bits per pixel per frame, the same measure as tools.calc_bits_per_pixel().
+
+    :return: float, -1.0 if the file has no video
+    """
+    try:
+        return video_bitrate / (width * height * framerate)
+    except (TypeError, ZeroDivisionError):
+        return -1.0
+
+
+def _check_column(column):
+    if column not in Catalog.columns:
+        raise ValueError("Unknown catalog column '{}'".format(column))
+
+
+def _under_pattern(directory):
+    directory = path.join(path.abspath(directory), '')
+    return directory.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+
+
+def _where(conditions):
+    clauses = []
+    params = []
+    for column, operator, value in conditions:
+        _check_column(column)
+        operator = operator.lower()
+        if operator not in Catalog.operators:
+            raise ValueError("Unknown operator '{}'".format(operator))
+
+        if operator in ('in', 'not in'):
+            value = list(value)
+            clauses.append('{} {} ({})'.format(column, Catalog.operators[operator], ', '.join('?' * len(value))))
+            params.extend(value)
+        elif operator == 'under':
+            clauses.append('{} {}'.format(column, Catalog.operators[operator]))
+            params.append(_under_pattern(value))
+        else:
+            clauses.append('{} {}'.format(column, Catalog.operators[operator]))
+            params.append(value)
+
+    if not clauses:
+        return '', params
+    return ' WHERE ' + ' AND '.join(clauses), params
+
+
+def _order_by(order_by, allowed=Catalog.columns):
+    if isinstance(order_by, str):
+        order_by = [order_by]
+    terms = []
+    for column in order_by:
+        descending = column.startswith('-')
+        column = column.lstrip('-')
+        if column not in allowed:
+            raise ValueError("Can't order by '{}'".format(column))
+        terms.append(column + (' DESC' if descending else ''))
+    return ' ORDER BY ' + ', '.join(terms)
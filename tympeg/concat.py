@@ -6,11 +6,13 @@ from .mediaobject import MediaObject, makeMediaObjectsInDirectory
 from .util import list_files
 
 
-def ffConcat(mediaObjectArray, outputFilepath):
+def ffConcat(mediaObjectArray, outputFilepath, listDirectory=''):
     """
 
     :param mediaObjectArray: Array of mediaObjects in order of concatenation
     :param outputFilepath: String, output file path
+    :param listDirectory: String, directory to write the concat demuxer's list file to, defaults to the working
+                          directory. Concats running at once need different ones.
     :return: subprocess completion data
     """
     # check and verify all items in array are MediaObjects
@@ -25,7 +27,7 @@ def ffConcat(mediaObjectArray, outputFilepath):
             return
 
     # write the temporary list.txt of inputs that the ffmpeg concat demuxer wants
-    listFileName = path.join(str(getcwd()), "tempFfConcat.txt")
+    listFileName = path.join(listDirectory or str(getcwd()), "tempFfConcat.txt")
     with open(listFileName, 'w') as file:
         for items in mediaObjectArray:
             print(str(items.filePath))
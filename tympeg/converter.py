@@ -1,30 +1,69 @@
 from tympeg.util import renameFile
 import subprocess
 import time
+import math
+import copy
+import shutil
+import tempfile
 import warnings
-from os import path, mkdir
+import json
+from concurrent.futures import ThreadPoolExecutor
+from os import path, mkdir, listdir, cpu_count, replace, remove
 
 from .timecode import timecode_to_seconds, seconds_to_timecode, subtract_timecodes
 
 from .util import renameFile
+from .progress import parse_progress
+from .mediaobject import MediaObject
+from .concat import ffConcat
 
 
 class MediaConverter:
     """ Holds settings that get turned into an arg array for ffmpeg conversion
     """
-    def __init__(self, mediaObject, outputFilePath='', debug=False, verbosity=24):
+    # Cores a video encoder keeps busy encoding 1080p at 'medium' speed, see cpuWeight()
+    encoderWeights = {'x264': 8.0, 'x265': 6.0, 'vp9': 4.0, 'vp8': 2.0, 'copy': 0.0}
+
+    # How x26X speed presets scale encoderWeights, faster presets leave less work for their threads
+    speedWeights = {'placebo': 1.25, 'veryslow': 1.25, 'slower': 1.2, 'slow': 1.1, 'medium': 1.0, 'fast': 0.9,
+                    'faster': 0.85, 'veryfast': 0.75, 'superfast': 0.6, 'ultrafast': 0.5}
+
+    # Cores an encoded audio stream keeps busy
+    audioWeight = 0.25
+
+    # ffmpeg encoders smartClip() re-encodes boundary GOPs with, by source codec, so the parts can be joined
+    smartCutEncoders = {'h264': 'libx264', 'hevc': 'libx265', 'vp9': 'libvpx-vp9', 'vp8': 'libvpx'}
+
+    # Encoder profiles matching the profiles ffprobe reports, by source codec. A profile missing here can't be
+    # matched, and the file is clipped normally. vp8 has no profiles.
+    smartCutProfiles = {'h264': {'Constrained Baseline': 'baseline', 'Baseline': 'baseline', 'Main': 'main',
+                                 'High': 'high', 'High 10': 'high10', 'High 4:2:2': 'high422',
+                                 'High 4:4:4 Predictive': 'high444'},
+                        'hevc': {'Main': 'main', 'Main 10': 'main10', 'Main Still Picture': 'mainstillpicture'},
+                        'vp9': {'Profile 0': '0', 'Profile 1': '1', 'Profile 2': '2', 'Profile 3': '3'}}
+
+    # Containers smartClip() writes parts to before joining them. In mpegts h264 and hevc are annex b, with their
+    # parameter sets in band at every keyframe, so the copied part keeps the source's and the encoded parts keep
+    # their own. vp8 and vp9 keyframes carry their own headers and can't go in mpegts.
+    smartCutContainers = {'h264': 'ts', 'hevc': 'ts'}
+
+    def __init__(self, mediaObject, outputFilePath='', debug=False, verbosity=24, keyframeSeek=True):
         """ Generates a ConversionSettings object. Populate fields with createXSettings() Methods.
 
         :param mediaObject:  MediaObject of file to be created
         :param outputFilePath: string, file path of output file
         :param debug: bool, whether or not to print certain messages helpful with debugging
         :param verbosity: int, level of ffmpeg verbosity. Integers correspond to ffmpeg's -loglevel options
+        :param keyframeSeek: bool, clips seek straight to the keyframe before their start using the file's keyframe
+                             index, and stream copied clips start on that keyframe. False fast seeks to a fixed 90
+                             seconds before the start instead.
         :return:
         """
         # general conversion settings
         self.mediaObject = mediaObject
         self.debug = debug
         self.verbosity = verbosity
+        self.keyframeSeek = keyframeSeek
 
         # parse MediaObject if it hasn't been done
         if self.mediaObject.streams == []:
@@ -56,6 +95,9 @@ class MediaConverter:
         self.audioStreams = []
         self.subtitleStreams = []
 
+        # Extra outputs sharing one decode of the video, see createRendition()
+        self.renditions = []
+
         # todo attachment streams
         self.attachmentStreams = []
 
@@ -63,26 +105,416 @@ class MediaConverter:
         self.otherStreams = []
 
         self.argsArray = ['ffmpeg']
+        self.outputIndices = []     # Indices of output file paths in argsArray, set by generateArgsArray()
+        self.outputDuration = -1.0  # Seconds of output, set by generateArgsArray()
+        self.elapsedTime = 0.0      # Set by convertWithProgress()
+        self.returnCode = None
+        self.weight = None  # Cores this job keeps busy, estimated by cpuWeight() unless it's set
+
+    def convert(self, progressCallback=None):
+        """ Runs ffmpeg. Output is written to a partial file next to the output and renamed over it once ffmpeg
+         succeeds, so an interrupted conversion never leaves a half written file at the output path.
+
+        :param progressCallback: function, called with a ConversionProgress each time ffmpeg reports progress
+        :return: float, seconds the conversion took
+        """
+        if progressCallback is not None:
+            for progress in self.convertWithProgress():
+                progressCallback(progress)
+            return self.elapsedTime
+
+        self.prepareOutput()
+        argsArray, partials = partial_args(self.argsArray, self.outputIndices)
+        startTime= time.time()
+        self.returnCode = subprocess.run(argsArray).returncode
+        endTime = time.time()
+        self.returnCode = finish_output(partials, self.returnCode)
+        return endTime - startTime
 
-    def convert(self):
+    def convertWithProgress(self):
+        """ Runs ffmpeg with -progress, yielding it's progress reports as they arrive, about twice a second. Percent
+         and eta are calculated against the output's duration. self.elapsedTime and self.returnCode are set when
+         ffmpeg exits.
+
+        :return: iterator of ConversionProgress
+        """
+        self.prepareOutput()
+        argsArray, partials = partial_args(self.argsArray, self.outputIndices)
+        argsArray = argsArray[:1] + ['-progress', 'pipe:1', '-nostats'] + argsArray[1:]
+        startTime = time.time()
+        process = subprocess.Popen(argsArray, stdout=subprocess.PIPE)
+        finished = False
+        try:
+            for progress in parse_progress(process.stdout, self.outputDuration):
+                yield progress
+            finished = True
+        finally:
+            process.stdout.close()
+            if not finished:
+                process.terminate()  # The caller stopped iterating early
+            self.returnCode = process.wait()
+            self.elapsedTime = time.time() - startTime
+            self.returnCode = finish_output(partials, self.returnCode)
+
+    def prepareOutput(self):
+        """ Generates self.argsArray if it hasn't been and makes sure the output directory exists.
+
+        :return:
+        """
         # generate argsArray if not already done
         if self.argsArray == ['ffmpeg']:
             self.generateArgsArray()
 
-        # Make sure the target directory exists!
-        outputDirectory, outputFilename = path.split(self.outputFilePath)
-        if not path.isdir(outputDirectory):
-            mkdir(outputDirectory)
-        startTime= time.time()
-        subprocess.run(self.argsArray)
-        endTime = time.time()
-        return endTime - startTime
+        # Make sure the target directories exist!
+        for outputFilePath in [self.outputFilePath] + [rendition['outputFilePath'] for rendition in self.renditions]:
+            outputDirectory, outputFilename = path.split(outputFilePath)
+            if not path.isdir(outputDirectory):
+                mkdir(outputDirectory)
+
+    def convertSegmented(self, segments=None, workers=None):
+        """ Encodes one file on all cores by splitting it's video at keyframes into segments, losslessly, encoding
+         the segments as separate ffmpeg processes at once with the same settings and joining them with ffConcat().
+         The audio streams are encoded in one more process over the whole duration while the segments run, and
+         muxed in at the end with the subtitles. Wall clock time drops with the number of workers, as long as
+         there are keyframes to split at.
+
+         Needs exactly one encoded video stream and the file's keyframe index, otherwise it falls back to convert().
+
+        :param segments: int, number of segments. Defaults to twice the number of workers, so a worker that finishes
+                         early has another segment to pick up.
+        :param workers: int, segments encoded at once. Defaults to as many as fit in the cores, see cpuWeight().
+        :return: float, seconds the conversion took
+        """
+        if len(self.videoStreams) != 1 or self.videoStreams[0]['videoEncoder'] == 'copy' or self.renditions:
+            warnings.warn("convertSegmented() needs one encoded video stream, converting " + self.inputFileName +
+                          " in one piece.")
+            return self.convert()
+
+        stream = self.videoStreams[0]['index']
+        keyframes = self.mediaObject.getKeyframeIndex() if self.mediaObject.duration > 0 else None
+        if keyframes is None or len(keyframes.times(stream)) < 2:
+            warnings.warn("No keyframes to split " + self.inputFileName + " at, converting it in one piece.")
+            return self.convert()
+
+        if workers is None:
+            # Per segment weight, one segment's encode can't use more of the machine than the whole file's would
+            workers = max(1, int((cpu_count() or 1) / self.cpuWeight()))
+        if segments is None:
+            segments = 2 * workers
+
+        # Snap evenly spaced cuts to the keyframe before them, dropping cuts that land on the same keyframe
+        cuts = []
+        for segment in range(1, segments):
+            keyframe = keyframes.preceding(self.mediaObject.duration * segment / segments, stream)
+            if keyframe is not None and keyframe > 0 and keyframe not in cuts:
+                cuts.append(keyframe)
+
+        self.prepareOutput()
+        startTime = time.time()
+        outputDirectory, outputFileName = path.split(self.outputFilePath)
+        workDirectory = tempfile.mkdtemp(prefix='.' + outputFileName + '.segments', dir=outputDirectory or None)
+        try:
+            # Split the video stream losslessly, the segment muxer cuts at the first keyframe at or after each time
+            segmentPattern = path.join(workDirectory, 'source_%05d.mkv')
+            splitArgs = ['ffmpeg', '-v', str(self.verbosity), '-i', self.inputFilePath, '-map', '0:' + str(stream),
+                         '-c', 'copy', '-f', 'segment', '-reset_timestamps', '1']
+            if cuts:
+                # A millisecond early so rounding can't push a cut past it's keyframe to the next one
+                splitArgs += ['-segment_times', ','.join('{:.6f}'.format(max(0.0, cut - 0.001)) for cut in cuts)]
+            self.returnCode = subprocess.run(splitArgs + [segmentPattern]).returncode
+            sources = sorted(path.join(workDirectory, name) for name in listdir(workDirectory)
+                             if name.startswith('source_'))
+            if self.returnCode != 0 or not sources:
+                warnings.warn("Couldn't split " + self.inputFileName + " into segments.")
+                return time.time() - startTime
+
+            # Same settings as a whole file conversion, generated by copies of this converter
+            videoOnly = copy.copy(self)
+            videoOnly.audioStreams, videoOnly.subtitleStreams, videoOnly.argsArray = [], [], ['ffmpeg']
+            videoOnly.generateArgsArray()
+            videoArgs = videoOnly.argsArray
+            inputIndex = videoArgs.index('-i') + 1
+            mapIndex = videoArgs.index('-map') + 1
+
+            jobs = []
+            encoded = []
+            for source in sources:
+                segmentArgs = list(videoArgs)
+                segmentArgs[inputIndex] = source
+                segmentArgs[mapIndex] = '0:0'  # The segment only holds the video stream
+                segmentArgs[-1] = path.join(workDirectory, 'encoded_' + path.basename(source)[len('source_'):])
+                jobs.append(segmentArgs)
+                encoded.append(segmentArgs[-1])
+
+            audioPath = path.join(workDirectory, 'audio.mka')
+            if self.audioStreams:
+                audioOnly = copy.copy(self)
+                audioOnly.videoStreams, audioOnly.subtitleStreams, audioOnly.argsArray = [], [], ['ffmpeg']
+                audioOnly.generateArgsArray()
+                jobs.insert(0, audioOnly.argsArray[:-1] + [audioPath])  # Started first, it's the longest single job
+
+            with ThreadPoolExecutor(max_workers=workers + (1 if self.audioStreams else 0)) as executor:
+                returnCodes = list(executor.map(lambda args: subprocess.run(args).returncode, jobs))
+            self.returnCode = max(returnCodes, key=abs)
+            if self.returnCode != 0:
+                warnings.warn("Encoding a segment of " + self.inputFileName + " failed.")
+                return time.time() - startTime
+
+            videoPath = path.join(workDirectory, 'video.mkv')
+            processData = ffConcat([MediaObject(segment, lazy=True) for segment in encoded], videoPath, workDirectory)
+            if processData is None:
+                self.returnCode = 1
+                return time.time() - startTime
+
+            muxArgs = ['ffmpeg', '-v', str(self.verbosity), '-i', videoPath]
+            maps = ['-map', '0']
+            if self.audioStreams:
+                muxArgs += ['-i', audioPath]
+                maps += ['-map', '1']
+            if self.subtitleStreams:
+                subtitleInput = len(maps) // 2
+                muxArgs += ['-i', self.inputFilePath]
+                for subtitle in self.subtitleStreams:
+                    maps += ['-map', '{}:{}'.format(subtitleInput, subtitle['index'])]
+            muxArgs += maps + ['-c', 'copy', self.outputFilePath]
+            argsArray, partials = partial_args(muxArgs, [len(muxArgs) - 1])
+            self.returnCode = finish_output(partials, subprocess.run(argsArray).returncode)
+        finally:
+            shutil.rmtree(workDirectory, ignore_errors=True)
+            self.elapsedTime = time.time() - startTime
+        return self.elapsedTime
+
+    def cpuWeight(self):
+        """ Estimates how many cores the conversion keeps busy, from the output resolution, encoder and speed of its
+         video streams and its encoded audio streams. Copying streams costs one core. MediaConverterQueue(cores=...)
+         packs jobs by this weight. Set self.weight to override the estimate.
+
+        :return: float, cores, between 1 and the number of cores on the machine
+        """
+        if self.weight is not None:
+            return self.weight
+
+        weight = 0.0
+        for stream in self.videoStreams + [rendition['video'] for rendition in self.renditions]:
+            width, height = self.outputResolution(stream)
+            pixels = width * height / (1920 * 1080)
+            weight += MediaConverter.encoderWeights.get(stream['videoEncoder'], 1.0) * pixels \
+                * MediaConverter.speedWeights.get(stream.get('speed', 'medium'), 1.0)
+        for stream in self.audioStreams:
+            if stream['audioEncoder'] != 'copy':
+                weight += MediaConverter.audioWeight
+
+        return min(max(1.0, weight), float(cpu_count() or 1))
+
+    def lane(self):
+        """ Queue lane of the conversion, 'io' when every stream is copied so it's disk bound, otherwise 'cpu'.
+
+        :return: string
+        """
+        encoders = [stream['videoEncoder'] for stream in self.videoStreams] + \
+                   [stream['audioEncoder'] for stream in self.audioStreams]
+        if encoders and all(encoder == 'copy' for encoder in encoders):
+            return 'io'
+        return 'cpu'
 
-    def clip(self, startingTime, endingTime):
+    def outputResolution(self, videoSettingsDict):
+        """ Resolution a video stream is encoded at. -1 dimensions follow the source's aspect ratio.
+
+        :param videoSettingsDict: dict, video stream settings from createVideoStream()
+        :return: (int, int), width and height
+        """
+        sourceWidth, sourceHeight = self.mediaObject.width, self.mediaObject.height
+        width, height = videoSettingsDict.get('width', -1), videoSettingsDict.get('height', -1)
+        if width <= 0 and height <= 0:
+            return sourceWidth, sourceHeight
+        if width <= 0:
+            width = height * sourceWidth / sourceHeight if sourceHeight else height * 16 / 9
+        elif height <= 0:
+            height = width * sourceHeight / sourceWidth if sourceWidth else width * 9 / 16
+        return int(width), int(height)
+
+    def clip(self, startingTime, endingTime, progressCallback=None):
         self.generateArgsArray(startTime=startingTime, endTime=endingTime)
         print(self.argsArray)
 
-        self.convert()
+        return self.convert(progressCallback)
+
+    def smartClip(self, startingTime, endingTime, crf=16):
+        """ Frame accurate clip that only re-encodes the partial GOPs at either end. The video from the first keyframe
+         at or after startingTime to the last keyframe at or before endingTime is stream copied, the frames before
+         and after it are encoded with the source's codec, profile, level and pixel format, and the three parts are
+         joined with ffConcat(). The joined video is probed, and decoded around each join, before it's muxed with
+         the audio and subtitle streams, cut to the same range with this converter's settings.
+
+         Needs one copied video stream in a codec in smartCutEncoders, with a profile in smartCutProfiles, and the
+         file's keyframe index. Ranges without a whole GOP inside them are encoded outright, other conversions fall
+         back to clip().
+
+        :param startingTime: string, timecode of the first frame of the clip
+        :param endingTime: string, timecode the clip ends at
+        :param crf: int, quality the boundary GOPs are encoded at, low so they don't stand out
+        :return: float, seconds the clip took
+        """
+        if len(self.videoStreams) != 1 or self.videoStreams[0]['videoEncoder'] != 'copy' or self.renditions:
+            warnings.warn("smartClip() needs one copied video stream, clipping " + self.inputFileName + " normally.")
+            return self.clip(startingTime, endingTime)
+
+        stream = self.videoStreams[0]['index']
+        # Probed here, the MediaObject may not have kept the profile, level or pixel format
+        parameters = probe_video_parameters(self.inputFilePath, stream)
+        encodeArgs = smart_cut_args(parameters, crf) if parameters is not None else None
+        keyframes = self.mediaObject.getKeyframeIndex()
+        if encodeArgs is None or keyframes is None or not keyframes.times(stream):
+            warnings.warn("Can't smart cut " + self.inputFileName + ", clipping it normally.")
+            return self.clip(startingTime, endingTime)
+
+        start = timecode_to_seconds(startingTime)
+        end = timecode_to_seconds(endingTime)
+        copyStart = keyframes.following(start, stream)
+        copyEnd = keyframes.preceding(end, stream)
+        extension = MediaConverter.smartCutContainers.get(parameters['codec_name'], 'mkv')
+
+        self.prepareOutput()
+        startTime = time.time()
+        outputDirectory, outputFileName = path.split(self.outputFilePath)
+        workDirectory = tempfile.mkdtemp(prefix='.' + outputFileName + '.smartcut', dir=outputDirectory or None)
+        try:
+            def videoPart(partStart, partEnd, codecArgs, name):
+                partPath = path.join(workDirectory, name + '.' + extension)
+                argsArray = ['ffmpeg', '-v', str(self.verbosity), '-ss', '{:.6f}'.format(partStart), '-i',
+                             self.inputFilePath, '-t', '{:.6f}'.format(partEnd - partStart), '-map',
+                             '0:' + str(stream)] + codecArgs + [partPath]
+                return argsArray, partPath
+
+            jobs = []
+            if copyStart is None or copyEnd is None or copyStart >= copyEnd:
+                # No whole GOP inside the range, there's nothing to copy
+                jobs.append(videoPart(start, end, encodeArgs, 'whole'))
+            else:
+                if start < copyStart:
+                    jobs.append(videoPart(start, copyStart, encodeArgs, 'head'))
+                # Rounded up to the millisecond, so the seek lands on this keyframe and not the one before it
+                jobs.append(videoPart(math.ceil(copyStart * 1000) / 1000, copyEnd, ['-c:v', 'copy'], 'middle'))
+                if copyEnd < end:
+                    jobs.append(videoPart(copyEnd, end, encodeArgs, 'tail'))
+
+            audioPath = path.join(workDirectory, 'audio.mka')
+            audioJobs = []
+            if self.audioStreams or self.subtitleStreams:
+                audioOnly = copy.copy(self)
+                audioOnly.videoStreams, audioOnly.argsArray = [], ['ffmpeg']
+                audioOnly.generateArgsArray(startingTime, endingTime)
+                audioJobs.append((audioOnly.argsArray[:-1] + [audioPath], audioPath))
+
+            with ThreadPoolExecutor(max_workers=len(jobs) + len(audioJobs)) as executor:
+                returnCodes = list(executor.map(lambda job: subprocess.run(job[0]).returncode, jobs + audioJobs))
+            self.returnCode = max(returnCodes, key=abs)
+            if self.returnCode != 0:
+                warnings.warn("Cutting a part of " + self.inputFileName + " failed.")
+                return time.time() - startTime
+
+            parts = [partPath for argsArray, partPath in jobs]
+            videoPath = parts[0]
+            if len(parts) > 1:
+                videoPath = path.join(workDirectory, 'video.' + extension)
+                if ffConcat([MediaObject(part, lazy=True) for part in parts], videoPath, workDirectory) is None:
+                    self.returnCode = 1
+                    return time.time() - startTime
+
+                joins = [copyStart - start] if start < copyStart else []
+                if copyEnd < end:
+                    joins.append(copyEnd - start)
+                if not check_join(videoPath, parameters, end - start, joins):
+                    warnings.warn("The smart cut parts of " + self.inputFileName + " didn't join cleanly.")
+                    self.returnCode = 1
+                    return time.time() - startTime
+
+            muxArgs = ['ffmpeg', '-v', str(self.verbosity), '-i', videoPath]
+            maps = ['-map', '0']
+            if audioJobs:
+                muxArgs += ['-i', audioPath]
+                maps += ['-map', '1']
+            muxArgs += maps + ['-c', 'copy', self.outputFilePath]
+            argsArray, partials = partial_args(muxArgs, [len(muxArgs) - 1])
+            self.returnCode = finish_output(partials, subprocess.run(argsArray).returncode)
+            self.outputDuration = end - start
+        finally:
+            shutil.rmtree(workDirectory, ignore_errors=True)
+            self.elapsedTime = time.time() - startTime
+        return self.elapsedTime
+
+    def clipMany(self, clips, clipsPerRun=32):
+        """ Cuts many clips out of the source with as few ffmpeg runs as possible, clipsPerRun clips to a run. The
+         source is probed and it's keyframe index loaded once, and each run is one ffmpeg process with an input and
+         an output per clip, carrying the same seek and stream args clip() would use, so every clip comes out the
+         same as it would from it's own clip() call.
+
+        :param clips: list[(string, string, string)], start timecode, end timecode and output file path of each clip.
+                      An empty output path names the clip after the source.
+        :param clipsPerRun: int, most clips in one ffmpeg run, each open input holds a demuxer and a file handle
+        :return: list[string], output file paths of the clips that were written
+        """
+        if self.renditions:
+            raise ValueError("clipMany() can't cut clips of a converter with renditions.")
+
+        inDir, inFileName = path.split(self.mediaObject.filePath)
+        name, ext = path.splitext(inFileName)
+        named = []
+        taken = set()
+        for number, (startTime, endTime, outputFilePath) in enumerate(clips):
+            if outputFilePath == '':
+                outputFilePath = path.join(inDir, '{}_clip{:03d}{}'.format(name, number, ext))
+            outputFilePath = path.join(path.dirname(outputFilePath), renameFile(outputFilePath))
+            while outputFilePath in taken:  # Two clips asked for the same output, neither exists yet
+                stem, extension = path.splitext(outputFilePath)
+                outputFilePath = stem + '_' + str(number) + extension
+            taken.add(outputFilePath)
+            named.append((startTime, endTime, outputFilePath))
+
+            outputDirectory = path.dirname(outputFilePath)
+            if outputDirectory != '' and not path.isdir(outputDirectory):
+                mkdir(outputDirectory)
+
+        written = []
+        for first in range(0, len(named), clipsPerRun):
+            batch = named[first:first + clipsPerRun]
+            self.generateClipsArgsArray(batch)
+            if self.debug:
+                print(self.argsArray)
+            self.convert()
+            if self.returnCode == 0:
+                written += [outputFilePath for startTime, endTime, outputFilePath in batch]
+        self.argsArray = ['ffmpeg']
+        return written
+
+    def generateClipsArgsArray(self, clips):
+        """ Generates an argsArray that cuts several clips in one ffmpeg run. Each clip's args are generated by
+         generateArgsArray() for a copy of this converter, it's input options and input go before the outputs, and
+         it's output options, maps pointed at it's own input, and output after them.
+
+        :param clips: list[(string, string, string)], start timecode, end timecode and output file path of each clip
+        :return:
+        """
+        inputs = []
+        outputs = []
+        outputIndices = []  # In outputs
+        for number, (startTime, endTime, outputFilePath) in enumerate(clips):
+            single = copy.copy(self)
+            single.argsArray, single.outputFilePath = ['ffmpeg'], outputFilePath
+            single.generateArgsArray(startTime, endTime)
+
+            argsArray = single.argsArray
+            inputIndex = argsArray.index('-i')
+            inputs += argsArray[3:inputIndex + 2]  # After '-v' and it's level, through the input path
+            body = argsArray[inputIndex + 2:]
+            for index in range(len(body) - 1):
+                if body[index] == '-map' and body[index + 1].startswith('0:'):
+                    body[index + 1] = str(number) + body[index + 1][1:]
+            outputs += body
+            outputIndices.append(len(outputs) - 1)
+
+        self.argsArray = ['ffmpeg', '-v', str(self.verbosity)] + inputs + outputs
+        self.outputIndices = [3 + len(inputs) + index for index in outputIndices]
 
     def createVideoStream(self, videoEncoder, rateControlMethod, rateParam, speed='',
                           width=-1, height=-1, videoStream=-1):
@@ -287,6 +719,40 @@ class MediaConverter:
         if self.debug:
             self.printVideoSettings()
 
+    def createRendition(self, outputFilePath, videoEncoder, rateControlMethod, rateParam, speed='', width=-1,
+                        height=-1):
+        """ Adds another output of the video stream at a different resolution, rate or encoder, for an encoding
+         ladder. Every rendition gets the same audio and subtitle streams as the main output. The source is demuxed
+         and decoded once, a split filter feeds a scaled copy of the video to each output's encoder, instead of
+         decoding it again for every rendition.
+
+         The main output's video stream has to be set with createVideoStream() first, renditions encode the same
+         source stream. Stream copies can't be renditions, they don't go through the filter.
+
+        :param outputFilePath: string, file path of rendition output
+        :param videoEncoder: string, encoder used, see createVideoStream()
+        :param rateControlMethod: string, rate control method to be used by the encoder
+        :param rateParam: int, interpreted as bitrate or constant rate factor, depending on rateControlMethod
+        :param speed: string, speed used to encode video in x26X family of encoders
+        :param width: int, width to scale to
+        :param height: int, height to scale to
+        :return:
+        """
+        if len(self.videoStreams) != 1 or self.videoStreams[0]['videoEncoder'] == 'copy':
+            raise ValueError("Renditions need the main output to have one encoded video stream, set it with "
+                             "createVideoStream() first.")
+        if videoEncoder == 'copy':
+            raise ValueError("A rendition can't be a stream copy.")
+
+        # createVideoStream() validates the settings and builds the dict, it's moved from the main output's streams
+        self.createVideoStream(videoEncoder, rateControlMethod, rateParam, speed, width, height,
+                               self.videoStreams[0]['index'])
+        videoSettingsDict = self.videoStreams.pop()
+
+        outDir, outFileName = path.split(outputFilePath)
+        outputFilePath = path.join(outDir, renameFile(outputFilePath))
+        self.renditions.append({'outputFilePath': outputFilePath, 'video': videoSettingsDict})
+
     def printVideoSettings(self):
         """ Prints the video settings of the ConversionSettings object.
 
@@ -404,6 +870,10 @@ class MediaConverter:
         :param endTime: String, input end time for encoding in format HH:MM:SS.SS
         :return:
         """
+        if self.renditions:
+            self.generateLadderArgsArray(startTime, endTime)
+            return
+
         def mapStreamsByType(someStreams, fileIndex, argsArray):
             """ Writes the -map stream to the argArray. Look at how it's called below.
 
@@ -435,13 +905,24 @@ class MediaConverter:
             Calculates the timecodes to fast-seek (jumps to nearest key-frame past this timecode) start/stop timecodes
             :param startTime: Timecode of where the video should be fully decoded
             :param endTime: Timecode of when to stop decoding/transcoding
-            :return: fastSeekTime, startTime, endTime, all timecodes
+            :return: fastSeekTime, startTime, endTime, all timecodes. startTime is None when a stream copied clip
+                     starts on the keyframe it seeks to.
             """
-            slow_seek_gap = 90 # gap in seconds between when fastseek stops and video is fully decoded to startTime
-            if timecode_to_seconds(startTime) < slow_seek_gap + 15:
-                fastSeekTime = '00:00:00'
+            keyframe = seekKeyframe(startTime)
+            if keyframe is not None:
+                # Rounded up to the millisecond, so ffmpeg's seek lands on this keyframe and not the one before it
+                fastSeekTime = seconds_to_timecode(math.ceil(keyframe * 1000) / 1000)
+                if copyVideo:
+                    endTime = subtract_timecodes(fastSeekTime, endTime)
+                    if self.debug:
+                        print("Stream copy snapped to keyframe at " + fastSeekTime + ", ending at " + endTime)
+                    return fastSeekTime, None, endTime
             else:
-                fastSeekTime = subtract_timecodes(seconds_to_timecode(slow_seek_gap), startTime)
+                slow_seek_gap = 90 # gap in seconds between when fastseek stops and video is fully decoded to startTime
+                if timecode_to_seconds(startTime) < slow_seek_gap + 15:
+                    fastSeekTime = '00:00:00'
+                else:
+                    fastSeekTime = subtract_timecodes(seconds_to_timecode(slow_seek_gap), startTime)
             startTime = subtract_timecodes(fastSeekTime, startTime)
             endTime = subtract_timecodes(fastSeekTime, endTime)
 
@@ -451,13 +932,33 @@ class MediaConverter:
                 print("Encoding " + subtract_timecodes(startTime, endTime) + " of media.")
             return fastSeekTime, startTime, endTime
 
+        def seekKeyframe(startTime):
+            """ Finds the keyframe of the first output video stream at or before startTime.
+
+            :param startTime: Timecode of where the clip starts
+            :return: float, keyframe time in seconds, None if the keyframe index isn't used or has no keyframe there
+            """
+            if not self.keyframeSeek or not self.mediaObject.videoStreams:
+                return None
+            keyframes = self.mediaObject.getKeyframeIndex()
+            if keyframes is None:
+                return None
+            if self.videoStreams:
+                stream = self.videoStreams[0]['index']
+            else:
+                stream = self.mediaObject.videoStreams[0]
+            return keyframes.preceding(timecode_to_seconds(startTime), stream)
+
         streamCopy = False
         cut = False
+        copyVideo = any(stream['videoEncoder'] == 'copy' for stream in self.videoStreams)
 
         addArgsToArray('-v ' + str(self.verbosity), self.argsArray)
 
+        self.outputDuration = self.mediaObject.duration
         if (startTime != '0') and (endTime != '0'):
             cut = True
+            self.outputDuration = timecode_to_seconds(endTime) - timecode_to_seconds(startTime)
 
             fastSeekTime, startTime, endTime = fastSeek(startTime, endTime)
             addArgsToArray('-ss ' + fastSeekTime, self.argsArray)
@@ -465,7 +966,8 @@ class MediaConverter:
             self.argsArray.append(str(self.mediaObject.filePath))
 
             # self.argsArray.append()
-            addArgsToArray('-ss ' + startTime, self.argsArray)
+            if startTime is not None:
+                addArgsToArray('-ss ' + startTime, self.argsArray)
             addArgsToArray('-to ' + endTime, self.argsArray)
 
         else:
@@ -589,10 +1091,66 @@ class MediaConverter:
         if streamCopy and cut:
             addArgsToArray('-avoid_negative_ts 1', self.argsArray)
         self.argsArray.append(self.outputFilePath)
+        self.outputIndices = [len(self.argsArray) - 1]
 
         if self.debug:
             print("Conversion argArray after output file: " + str(self.argsArray))
 
+    def generateLadderArgsArray(self, startTime='0', endTime='0'):
+        """ Generates an argsArray with an output for the main video stream and each rendition. The input is read
+         once and it's video is split in a filter_complex, each branch scaled for it's output. Each output's args
+         are generated by generateArgsArray() for a single output copy of this converter, then pointed at it's
+         branch of the filter.
+
+        :param startTime: String, input start time for encoding in format HH:MM:SS.SS
+        :param endTime: String, input end time for encoding in format HH:MM:SS.SS
+        :return:
+        """
+        outputs = [(self.outputFilePath, self.videoStreams[0])] + \
+                  [(rendition['outputFilePath'], rendition['video']) for rendition in self.renditions]
+        source = '0:' + str(self.videoStreams[0]['index'])
+
+        head = []
+        bodies = []
+        for branch, (outputFilePath, videoSettingsDict) in enumerate(outputs):
+            single = copy.copy(self)
+            single.renditions, single.videoStreams, single.argsArray = [], [videoSettingsDict], ['ffmpeg']
+            single.outputFilePath = outputFilePath
+            single.generateArgsArray(startTime, endTime)
+            self.outputDuration = single.outputDuration
+
+            argsArray = single.argsArray
+            inputEnd = argsArray.index('-i') + 2
+            head = argsArray[:inputEnd]
+            body = []
+            index = inputEnd
+            while index < len(argsArray):
+                if argsArray[index] == '-map' and argsArray[index + 1] == source:
+                    body += ['-map', '[v{}]'.format(branch)]
+                elif argsArray[index] == '-vf':
+                    pass  # Scaled in the filter graph
+                else:
+                    body.append(argsArray[index])
+                    index += 1
+                    continue
+                index += 2
+            bodies.append(body)
+
+        graph = '[{}]split={}{}'.format(source, len(outputs), ''.join('[s{}]'.format(branch)
+                                                                       for branch in range(len(outputs))))
+        for branch, (outputFilePath, videoSettingsDict) in enumerate(outputs):
+            graph += ';[s{0}]scale={1}:{2}[v{0}]'.format(branch, videoSettingsDict['width'],
+                                                         videoSettingsDict['height'])
+
+        self.argsArray = head + ['-filter_complex', graph]
+        self.outputIndices = []
+        for body in bodies:
+            self.argsArray += body
+            self.outputIndices.append(len(self.argsArray) - 1)
+
+        if self.debug:
+            print("Ladder argArray: " + str(self.argsArray))
+
     def estimateVideoBitrate(self, targetFileSize, startTime=-1, endTime=-1, audioBitrate=-1, otherBitrates=0):
 
         if startTime == -1 and endTime == -1:
@@ -618,3 +1176,170 @@ class MediaConverter:
 
     def createOtherSettings(self, mediaObject):
         pass
+
+
+def probe_video_parameters(file_path, stream=None):
+    """ Codec parameters of a video stream that have to match for parts of it to be joined.
+
+    :param file_path: string, path of media file
+    :param stream: int, index of stream, None for the first video stream
+    :return: dict, 'codec_name', 'profile', 'level', 'pix_fmt' and 'duration' of the file, None if ffprobe failed
+    """
+    argsArray = ['ffprobe', '-v', 'error', '-select_streams', 'v:0' if stream is None else str(stream),
+                 '-show_entries', 'stream=codec_name,profile,level,pix_fmt:format=duration', '-of', 'json',
+                 '-i', file_path]
+    try:
+        probeOut = json.loads(subprocess.check_output(argsArray).decode("utf-8"))
+    except (subprocess.CalledProcessError, ValueError) as error:
+        warnings.warn("Couldn't probe the video of " + file_path + " in probe_video_parameters().")
+        print(str(error))
+        return None
+    if not probeOut.get('streams'):
+        return None
+
+    parameters = dict(probeOut['streams'][0])
+    try:
+        parameters['duration'] = float(probeOut.get('format', {}).get('duration'))
+    except (TypeError, ValueError):
+        parameters['duration'] = -1.0
+    return parameters
+
+
+def smart_cut_args(parameters, crf):
+    """ Encoder args that make frames the decoder of a stream with these parameters can take without a reset: the
+     same codec, profile, level and pixel format.
+
+    :param parameters: dict, from probe_video_parameters()
+    :param crf: int, constant rate factor
+    :return: list[string], None if the codec or profile can't be matched
+    """
+    codec = parameters.get('codec_name')
+    encoder = MediaConverter.smartCutEncoders.get(codec)
+    if encoder is None:
+        return None
+    encodeArgs = ['-c:v', encoder, '-crf', str(crf)]
+
+    if codec in MediaConverter.smartCutProfiles:
+        profile = MediaConverter.smartCutProfiles[codec].get(parameters.get('profile'))
+        if profile is None:
+            return None
+        encodeArgs += ['-profile:v', profile]
+
+    level = parameters.get('level', -99)
+    if codec == 'h264' and level > 0:
+        encodeArgs += ['-level:v', '{:.1f}'.format(level / 10)]  # 41 is level 4.1
+    elif codec == 'hevc' and level > 0:
+        encodeArgs += ['-x265-params', 'level-idc={:.1f}'.format(level / 30)]  # 123 is level 4.1
+    if encoder == 'libvpx-vp9':
+        encodeArgs += ['-b:v', '0']
+    if parameters.get('pix_fmt'):
+        encodeArgs += ['-pix_fmt', parameters['pix_fmt']]
+    return encodeArgs
+
+
+def check_join(file_path, parameters, duration, joins, window=1.0):
+    """ Checks video joined from parts kept the source's codec parameters and length, and decodes without errors for
+     a window around each join.
+
+    :param file_path: string, path of joined video
+    :param parameters: dict, source's parameters from probe_video_parameters()
+    :param duration: float, seconds the joined video should last
+    :param joins: list[float], seconds into the joined video the parts meet
+    :param window: float, seconds decoded on each side of a join
+    :return: bool, True if the join is clean
+    """
+    joined = probe_video_parameters(file_path)
+    if joined is None:
+        return False
+    for key in ('codec_name', 'profile', 'pix_fmt'):
+        if joined.get(key) != parameters.get(key):
+            print("Joined video's {} is {!r}, the source's is {!r}".format(key, joined.get(key), parameters.get(key)))
+            return False
+    if joined['duration'] > 0 and abs(joined['duration'] - duration) > window:
+        print("Joined video lasts {:.3f} s, expected {:.3f} s".format(joined['duration'], duration))
+        return False
+
+    for join in joins:
+        argsArray = ['ffmpeg', '-v', 'error', '-nostdin', '-ss', '{:.6f}'.format(max(0.0, join - window)),
+                     '-t', '{:.6f}'.format(2 * window), '-i', file_path, '-map', '0:v:0', '-f', 'null', '-']
+        process = subprocess.run(argsArray, stderr=subprocess.PIPE)
+        if process.returncode != 0 or process.stderr.strip():
+            print("Decoding the join at {:.3f} s failed: {}".format(join, process.stderr.decode('utf-8', 'replace')))
+            return False
+    return True
+
+
+def partial_path(output_file_path, tag=''):
+    """ Path ffmpeg writes an output to until it's finished, a hidden file next to the output with the same
+     extension so ffmpeg still picks the right container.
+
+    :param output_file_path: string, path of output file
+    :param tag: string, added to the name so runs of the same job that might overlap write to different files
+    :return: string
+    """
+    directory, file_name = path.split(output_file_path)
+    name, ext = path.splitext(file_name)
+    if tag != '':
+        name += '.' + tag
+    return path.join(directory, '.' + name + '.partial' + ext)
+
+
+def partial_args(args_array, output_indices, tag=''):
+    """ Rewrites an ffmpeg args array to write each of it's outputs to their partial_path(). Partial files left by an
+     interrupted run are removed first. An output that already exists is left in place, unless the args have -y, so
+     ffmpeg asks before overwriting it like it would without partial files.
+
+    :param args_array: list[string], ffmpeg args
+    :param output_indices: list[int], indices of the output file paths in args_array, recorded when the args were
+                           generated, see MediaConverter.outputIndices
+    :param tag: string, see partial_path()
+    :return: (list[string], list[(string, string)]), rewritten args and (partial path, output path) of each output
+    """
+    argsArray = list(args_array)
+    partials = []
+    for index in output_indices:
+        output = argsArray[index]
+        if output == '-' or output.startswith('pipe:') or (path.exists(output) and '-y' not in argsArray):
+            continue
+        partial = partial_path(output, tag)
+        if path.isfile(partial):
+            remove(partial)
+        partials.append((partial, output))
+        argsArray[index] = partial
+    return argsArray, partials
+
+
+def finish_output(partials, return_code):
+    """ Renames finished partial outputs over their output files, each in one atomic step, or deletes them if ffmpeg
+     failed. A partial output missing after ffmpeg succeeded, removed by something else, fails the run.
+
+    :param partials: list[(string, string)], partial and output paths from partial_args()
+    :param return_code: int, ffmpeg's exit code
+    :return: int, return_code, or 1 if ffmpeg succeeded but a partial output is missing
+    """
+    if return_code == 0:
+        missing = [partial for partial, output_file_path in partials if not path.isfile(partial)]
+        if missing:
+            warnings.warn("ffmpeg finished but it's output is missing: " + ', '.join(missing))
+            return_code = 1
+
+    for partial, output_file_path in partials:
+        if return_code == 0:
+            replace(partial, output_file_path)
+        elif path.isfile(partial):
+            remove(partial)
+    return return_code
+
+
+def args_lane(args_array):
+    """ Queue lane of an ffmpeg args array, 'io' when every codec it sets is copy, see MediaConverter.lane().
+
+    :param args_array: list[string], ffmpeg args
+    :return: string
+    """
+    codecs = [args_array[index + 1] for index in range(len(args_array) - 1)
+              if args_array[index].startswith(('-c:', '-codec:')) or args_array[index] in ('-c', '-codec', '-vcodec',
+                                                                                           '-acodec', '-scodec')]
+    if codecs and all(codec == 'copy' for codec in codecs):
+        return 'io'
+    return 'cpu'
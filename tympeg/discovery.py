@@ -0,0 +1,93 @@
+from os import scandir, path
+
+
+# Lowercase suffixes of files treated as media
+media_extensions = ('.mp4', '.mkv', '.avi', '.m4v', '.wmv', '.webm', '.flv', '.mov', '.mpg', '.mpeg', '.ogg', '.ogv',
+                    '.ts', '.m2ts', '.mts', '.vob', '.rmvb', '.rm', '.asf', '.3gp')
+
+# (offset, bytes) signatures of container headers, any match identifies a media file
+media_signatures = (
+    (0, b'\x1a\x45\xdf\xa3'),                   # Matroska, WebM
+    (4, b'ftyp'), (4, b'moov'), (4, b'mdat'),   # MP4, M4V, MOV, 3GP
+    (4, b'free'), (4, b'wide'), (4, b'skip'),
+    (8, b'AVI '),                               # AVI, after RIFF and size
+    (0, b'\x30\x26\xb2\x75\x8e\x66\xcf\x11'),   # ASF, WMV
+    (0, b'FLV'),
+    (0, b'OggS'),
+    (0, b'.RMF'),                               # RealMedia
+    (0, b'\x00\x00\x01\xba'),                   # MPEG program stream, VOB
+    (0, b'\x00\x00\x01\xb3'),                   # MPEG video elementary stream
+)
+
+ts_packet_size = 188
+m2ts_packet_size = 192
+header_size = m2ts_packet_size + 8
+
+
+def find_media_files(directory, recursive=True, extensions=media_extensions, sniff=False, follow_links=False):
+    """ Walks a directory with os.scandir and yields paths of media files as they're found, so probing can start
+     before the walk finishes. Files are matched on a case-insensitive suffix, foo.mp4.part isn't a media file.
+
+    :param directory: string, path of directory to search
+    :param recursive: bool, search sub directories too
+    :param extensions: iterable[string], suffixes of media files, matched case-insensitively
+    :param sniff: bool, also read each matching file's header and skip files that don't start like a media container,
+                  like truncated downloads or misnamed files, before ffprobe has to look at them
+    :param follow_links: bool, follow symlinked directories when recursive
+    :return: iterator of string, paths of media files in scandir order, files before sub directories
+    """
+    extensions = tuple(extension.lower() for extension in extensions)
+    pending = [directory]
+    while pending:
+        current = pending.pop()
+        subdirectories = []
+        try:
+            with scandir(current) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=follow_links):
+                            if recursive:
+                                subdirectories.append(entry.path)
+                        elif entry.is_file() and entry.name.lower().endswith(extensions):
+                            if not sniff or is_media_header(entry.path):
+                                yield entry.path
+                    except OSError:
+                        continue
+        except OSError:  # Unreadable or vanished directory, skip it like os.walk() does
+            continue
+        # Reversed so the stack pops sub directories in scandir order
+        pending.extend(reversed(subdirectories))
+
+
+def is_media_header(file_path):
+    """ Sniffs the first bytes of a file for the header of a container ffprobe can read.
+
+    :param file_path: string, path of file
+    :return: bool, True if the header matches a known media container
+    """
+    try:
+        with open(file_path, 'rb') as file:
+            header = file.read(header_size)
+    except OSError:
+        return False
+
+    for offset, signature in media_signatures:
+        if header[offset:offset + len(signature)] == signature:
+            return True
+
+    # MPEG-TS has no header, just sync bytes at the start of every packet. M2TS packets have a 4 byte prefix.
+    if header[:1] == b'\x47' and header[ts_packet_size:ts_packet_size + 1] == b'\x47':
+        return True
+    if header[4:5] == b'\x47' and header[m2ts_packet_size + 4:m2ts_packet_size + 5] == b'\x47':
+        return True
+    return False
+
+
+def has_media_extension(file_name, extensions=media_extensions):
+    """ Case-insensitive suffix test of a file name.
+
+    :param file_name: string, name or path of file
+    :param extensions: iterable[string], suffixes of media files
+    :return: bool
+    """
+    return path.basename(file_name).lower().endswith(tuple(extension.lower() for extension in extensions))
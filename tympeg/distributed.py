@@ -0,0 +1,396 @@
+import queue
+import re
+import socket
+import subprocess
+import threading
+import time
+import warnings
+from multiprocessing.connection import Listener, Client
+from os import path, makedirs, cpu_count
+
+from .converter import MediaConverter, partial_args, finish_output
+from .progress import ConversionProgress, parse_progress
+from .queue import job_weight, heaviest_fitting
+
+
+class JobCoordinator:
+    """ Serves conversion jobs to ConversionWorkers on other machines, or the same one, over a TCP or Unix socket.
+     Jobs go out as plain data: ffmpeg args, input and output paths, cpu weight and output duration, so input and
+     output paths have to mean the same thing on every worker, like a shared mount.
+
+     Workers pull as many jobs as fit in their cores, heartbeat while they run them and report progress and results.
+     A worker that disconnects, or goes heartbeat_timeout seconds without a message, has it's jobs queued again
+     once another two heartbeat timeouts have passed, time for it to notice and stop it's ffmpeg. Every assignment
+     of a job writes to it's own partial file, so a copy still running elsewhere can't clobber it.
+
+     Messages are pickled, so anyone who can connect can run code on the coordinator and it's workers. Connections
+     have to pass the authkey handshake, and the coordinator only listens on localhost unless given an address.
+
+    """
+    def __init__(self, authkey, address=('127.0.0.1', 0), journal=None, heartbeat_timeout=30.0):
+        """
+
+        :param authkey: bytes, shared secret workers need to connect, keep it out of source code
+        :param address: (string, int) host and port to listen on, port 0 picks a free one. Pass ('', port) or the
+                        host's address to accept workers on other machines. A string path listens on a Unix socket
+                        instead.
+        :param journal: JobJournal, records job state like MediaConverterQueue(journal=...) does
+        :param heartbeat_timeout: float, seconds a worker can go silent before it's presumed dead
+        """
+        check_authkey(authkey)
+        self.authkey = authkey
+        self.journal = journal
+        self.heartbeat_timeout = heartbeat_timeout
+
+        self.pending = []     # Job specs waiting for a worker
+        self.held = []        # (time to queue again, job spec) of jobs taken from dropped workers
+        self.assigned = {}    # job id: (worker name, job spec)
+        self.results = {}     # job id: return code
+        self.progress = {}    # job id: latest ConversionProgress
+        self.workers = {}     # worker name: time of last message
+        self.start_time = 0
+        self.total_time = 0
+
+        self._next_id = 1
+        self._worker_count = 0
+        self._closing = False
+        self._lock = threading.Lock()
+        self.finished = threading.Event()
+
+        self.listener = Listener(address, authkey=authkey)
+        self.address = self.listener.address
+        self._threads = []
+
+    @classmethod
+    def from_queue(cls, job_queue, authkey, address=('127.0.0.1', 0), heartbeat_timeout=30.0):
+        """ Coordinator serving the jobs of a MediaConverterQueue, with it's journal, instead of running them locally.
+
+        :param job_queue: MediaConverterQueue
+        :param authkey: bytes, shared secret workers need to connect
+        :return: JobCoordinator
+        """
+        coordinator = cls(authkey, address, job_queue.journal, heartbeat_timeout)
+        coordinator.add_jobs(job_queue.job_list)
+        job_queue.job_list = []
+        return coordinator
+
+    def add_job(self, job):
+        """ Queues a MediaConverter or JournalJob for the workers.
+
+        :param job: MediaConverter or JournalJob
+        :return: int, id of job
+        """
+        if isinstance(job, MediaConverter):
+            if job.argsArray == ['ffmpeg']:
+                job.generateArgsArray()
+            if self.journal is not None:
+                self.journal.add(job, job_weight(job))
+
+        with self._lock:
+            job_id = getattr(job, 'journalId', None) if self.journal is not None else None
+            if job_id is None:
+                job_id = self._next_id
+                self._next_id += 1
+            self.pending.append(job_spec(job, job_id))
+            self.finished.clear()
+        return job_id
+
+    def add_jobs(self, jobs):
+        for job in jobs:
+            self.add_job(job)
+
+    def start(self):
+        """ Starts accepting workers and returns, a thread serves each worker. wait() blocks until every job is done.
+
+        :return:
+        """
+        self.start_time = time.time()
+        with self._lock:
+            self._check_finished()
+        for target in (self._accept, self._reap):
+            thread = threading.Thread(target=target, name='JobCoordinator', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def wait(self, timeout=None):
+        """ Blocks until every job has a result.
+
+        :param timeout: float, seconds to wait at most, None waits until the jobs are done
+        :return: bool, True if every job is done
+        """
+        return self.finished.wait(timeout)
+
+    def close(self):
+        """ Stops accepting workers. Workers still connected are told there's nothing left once they ask.
+
+        :return:
+        """
+        self._closing = True
+        try:  # accept() doesn't notice the listener closing, wake it with a connection of our own
+            Client(self.address, authkey=self.authkey).close()
+        except OSError:
+            pass
+        self.listener.close()
+
+    def _accept(self):
+        while not self._closing:
+            try:
+                connection = self.listener.accept()
+            except OSError:  # Listener closed, or a client failed authentication
+                continue
+            if self._closing:
+                connection.close()
+                break
+            thread = threading.Thread(target=self._serve, args=(connection,), name='JobCoordinator', daemon=True)
+            thread.start()
+
+    def _serve(self, connection):
+        """ Answers one worker's messages until it disconnects or is reaped.
+
+        :param connection: multiprocessing.connection.Connection
+        :return:
+        """
+        worker = None
+        try:
+            while True:
+                if worker is not None and worker not in self.workers:
+                    break  # Reaped for going silent
+                if not connection.poll(1.0):
+                    continue
+                message = connection.recv()
+                if worker is None:
+                    with self._lock:
+                        self._worker_count += 1
+                        worker = "{}#{}".format(message.get('name', 'worker'), self._worker_count)
+                        self.workers[worker] = time.time()
+                connection.send(self._handle(worker, message))
+        except (EOFError, OSError):
+            pass
+        finally:
+            connection.close()
+            if worker is not None:
+                self._drop(worker)
+
+    def _handle(self, worker, message):
+        """ Replies to a message from a worker.
+
+        :param worker: string, name of worker
+        :param message: dict, 'type' is one of 'hello', 'heartbeat', 'request', 'progress' or 'result'
+        :return: dict, reply
+        """
+        kind = message.get('type')
+        with self._lock:
+            self.workers[worker] = time.time()
+
+            if kind == 'request':
+                jobs = []
+                free = message['free']
+                while self.pending:
+                    index = heaviest_fitting([spec['weight'] for spec in self.pending], free,
+                                             message['idle'] and not jobs)
+                    if index is None:
+                        break
+                    spec = self.pending.pop(index)
+                    free -= spec['weight']
+                    spec['attempt'] += 1
+                    spec['partial_tag'] = '{}.{}'.format(re.sub(r'[^A-Za-z0-9_-]', '_', worker), spec['attempt'])
+                    self.assigned[spec['id']] = (worker, spec)
+                    jobs.append(spec)
+                for spec in jobs:
+                    self._set_state(spec['id'], 'running')
+                return {'type': 'jobs', 'jobs': jobs, 'finished': self.finished.is_set() or self._closing}
+
+            if kind == 'progress':
+                if self.assigned.get(message['job'], (None,))[0] == worker:
+                    self.progress[message['job']] = ConversionProgress(**message['progress'])
+
+            elif kind == 'result':
+                job_id = message['job']
+                # A requeued job's late result from the worker it was taken from is ignored
+                if self.assigned.get(job_id, (None,))[0] == worker:
+                    del self.assigned[job_id]
+                    self.results[job_id] = message['return_code']
+                    self._set_state(job_id, 'done' if message['return_code'] == 0 else 'failed',
+                                    message['return_code'])
+                    self._check_finished()
+
+            return {'type': 'ok'}
+
+    def _reap(self):
+        """ Drops workers that went silent for longer than self.heartbeat_timeout.
+
+        :return:
+        """
+        while not self._closing:
+            time.sleep(min(1.0, self.heartbeat_timeout / 4))
+            now = time.time()
+            with self._lock:
+                silent = [worker for worker, seen in self.workers.items() if now - seen > self.heartbeat_timeout]
+                self.pending += [spec for release, spec in self.held if release <= now]
+                self.held = [(release, spec) for release, spec in self.held if release > now]
+            for worker in silent:
+                warnings.warn("Conversion worker {} missed it's heartbeat, queueing it's jobs again".format(worker))
+                self._drop(worker)
+
+    def _drop(self, worker):
+        """ Forgets a worker and holds it's unfinished jobs for two heartbeat timeouts before queueing them again, a
+         worker that lost it's connection stops it's ffmpeg when it next hears from the coordinator.
+
+        :param worker: string, name of worker
+        :return:
+        """
+        with self._lock:
+            self.workers.pop(worker, None)
+            release = time.time() + 2 * self.heartbeat_timeout
+            for job_id, (owner, spec) in list(self.assigned.items()):
+                if owner == worker:
+                    del self.assigned[job_id]
+                    self.progress.pop(job_id, None)
+                    self.held.append((release, spec))
+                    self._set_state(job_id, 'queued')
+
+    def _set_state(self, job_id, state, return_code=None):
+        if self.journal is not None:
+            self.journal.set_state(job_id, state, return_code)
+
+    def _check_finished(self):
+        if not self.pending and not self.held and not self.assigned:
+            self.total_time = time.time() - self.start_time
+            self.finished.set()
+
+
+class ConversionWorker:
+    """ Pulls jobs from a JobCoordinator and runs them with ffmpeg, as many at once as fit in it's cores.
+
+    """
+    def __init__(self, address, authkey, cores=None, name='', heartbeat_interval=5.0, poll_interval=2.0):
+        """
+
+        :param address: (string, int) or string, address of the coordinator
+        :param authkey: bytes, the coordinator's shared secret
+        :param cores: float, cpu weight of jobs to run at once. Defaults to the number of cores.
+        :param name: string, name the coordinator knows this worker by. Defaults to the host name.
+        :param heartbeat_interval: float, seconds between messages to the coordinator while jobs run
+        :param poll_interval: float, seconds between asking for jobs while the coordinator has none to give
+        """
+        check_authkey(authkey)
+        self.address = address
+        self.authkey = authkey
+        self.cores = cores if cores is not None else (cpu_count() or 1)
+        self.name = name if name != '' else socket.gethostname()
+        self.heartbeat_interval = heartbeat_interval
+        self.poll_interval = poll_interval
+
+        self.results = {}  # job id: return code, of jobs run by this worker
+        self._running = {}  # job id: (job spec, ffmpeg process or None until it starts)
+        self._completed = queue.Queue()
+        self._connection = None
+        self._lock = threading.Lock()
+
+    def run(self):
+        """ Runs jobs until the coordinator has none left. If the coordinator goes away, running jobs are stopped.
+
+        :return: int, number of jobs run
+        """
+        self._connection = Client(self.address, authkey=self.authkey)
+        try:
+            self._call({'type': 'hello', 'name': self.name, 'cores': self.cores})
+            ask = True
+            while True:
+                if ask:
+                    free = self.cores - sum(spec['weight'] for spec, process in self._running.values())
+                    reply = self._call({'type': 'request', 'free': free, 'idle': not self._running})
+                    for spec in reply['jobs']:
+                        self._start(spec)
+                    if reply['finished'] and not self._running:
+                        break
+
+                try:
+                    job_id, return_code = self._completed.get(
+                        timeout=self.heartbeat_interval if self._running else self.poll_interval)
+                except queue.Empty:
+                    self._call({'type': 'heartbeat'})
+                    ask = not self._running
+                    continue
+
+                del self._running[job_id]
+                self.results[job_id] = return_code
+                self._call({'type': 'result', 'job': job_id, 'return_code': return_code})
+                ask = True
+        except (EOFError, OSError) as error:
+            warnings.warn("Lost the coordinator at {}: {}".format(self.address, error))
+            for spec, process in list(self._running.values()):
+                if process is not None:
+                    process.terminate()
+        finally:
+            self._connection.close()
+        return len(self.results)
+
+    def _call(self, message):
+        with self._lock:
+            self._connection.send(message)
+            return self._connection.recv()
+
+    def _start(self, spec):
+        self._running[spec['id']] = (spec, None)
+        thread = threading.Thread(target=self._convert, args=(spec,), name='ConversionWorker', daemon=True)
+        thread.start()
+
+    def _convert(self, spec):
+        """ Runs a job's ffmpeg args into a partial output, sending progress reports to the coordinator.
+
+        :param spec: dict, job spec from job_spec()
+        :return:
+        """
+        return_code = -1
+        try:
+            outputDirectory = path.dirname(spec['output_path'])
+            if outputDirectory != '' and not path.isdir(outputDirectory):
+                makedirs(outputDirectory)
+
+            argsArray, partials = partial_args(spec['args'], spec['outputs'], spec['partial_tag'])
+            argsArray = argsArray[:1] + ['-progress', 'pipe:1', '-nostats'] + argsArray[1:]
+            process = subprocess.Popen(argsArray, stdout=subprocess.PIPE)
+            self._running[spec['id']] = (spec, process)
+            try:
+                for progress in parse_progress(process.stdout, spec['duration']):
+                    self._call({'type': 'progress', 'job': spec['id'],
+                                'progress': {slot: getattr(progress, slot) for slot in ConversionProgress.__slots__}})
+            except (EOFError, OSError):
+                pass  # run() notices the coordinator is gone
+            finally:
+                process.stdout.close()
+                return_code = process.wait()
+            return_code = finish_output(partials, return_code)
+        except OSError as error:
+            warnings.warn("Couldn't run job {}: {}".format(spec['id'], error))
+        finally:
+            self._completed.put((spec['id'], return_code))
+
+
+def check_authkey(authkey):
+    """ Makes sure there's a shared secret, the connections carry pickles.
+
+    :param authkey: bytes
+    :return:
+    """
+    if not isinstance(authkey, bytes) or len(authkey) == 0:
+        raise ValueError("authkey has to be a non-empty bytes secret, got {}".format(type(authkey).__name__))
+
+
+def job_spec(job, job_id):
+    """ Plain data description of a job a ConversionWorker can run.
+
+    :param job: MediaConverter or JournalJob, with it's argsArray generated
+    :param job_id: int, id of job
+    :return: dict
+    """
+    return {'id': job_id,
+            'input_path': job.inputFilePath,
+            'output_path': job.outputFilePath,
+            'args': list(job.argsArray),
+            'outputs': list(job.outputIndices),
+            'weight': job_weight(job),
+            'duration': getattr(job, 'outputDuration', -1.0),
+            'attempt': 0,  # Times the job was handed to a worker
+            'partial_tag': ''}
@@ -0,0 +1,199 @@
+import json
+import sqlite3
+import subprocess
+import threading
+import time
+from os import path, makedirs
+
+from .converter import partial_args, finish_output, args_lane
+
+
+class JobJournal:
+    """ Durable record of a MediaConverterQueue's jobs in SQLite: each job's ffmpeg args, input and output paths, and
+     every state it moved through. Writes are synced before they return, so after a crash or reboot unfinished() hands
+     back exactly the jobs that didn't finish, ready to run again without probing or rescanning anything.
+
+     States are 'queued', 'running', 'done' and 'failed'. A job left 'running' was interrupted.
+
+    """
+    states = ('queued', 'running', 'done', 'failed')
+
+    def __init__(self, db_path=''):
+        """
+
+        :param db_path: string, path of the journal database. Defaults to ~/.cache/tympeg/jobs.sqlite3
+        """
+        if db_path == '':
+            db_path = path.join(path.expanduser('~'), '.cache', 'tympeg', 'jobs.sqlite3')
+        directory = path.dirname(path.abspath(db_path))
+        if not path.isdir(directory):
+            makedirs(directory)
+
+        self.db_path = db_path
+        self._lock = threading.Lock()
+
+        self._connection = sqlite3.connect(self.db_path, check_same_thread=False)
+        self._connection.row_factory = sqlite3.Row
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=FULL')  # A committed transition survives power loss
+        self._connection.execute('CREATE TABLE IF NOT EXISTS jobs ('
+                                 'id INTEGER PRIMARY KEY AUTOINCREMENT, input_path TEXT NOT NULL, '
+                                 'output_path TEXT NOT NULL, args TEXT NOT NULL, weight REAL NOT NULL, '
+                                 'state TEXT NOT NULL, return_code INTEGER, added REAL NOT NULL, '
+                                 'updated REAL NOT NULL, outputs TEXT)')
+        if 'outputs' not in [row['name'] for row in self._connection.execute('PRAGMA table_info(jobs)')]:
+            # Journals from before output indices were recorded, their jobs wrote to the last arg
+            self._connection.execute('ALTER TABLE jobs ADD COLUMN outputs TEXT')
+        self._connection.execute('CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state)')
+        self._connection.execute('CREATE TABLE IF NOT EXISTS transitions ('
+                                 'id INTEGER PRIMARY KEY AUTOINCREMENT, job INTEGER NOT NULL, time REAL NOT NULL, '
+                                 'state TEXT NOT NULL, return_code INTEGER)')
+        self._connection.execute('CREATE INDEX IF NOT EXISTS transitions_job ON transitions (job)')
+        self._connection.commit()
+
+    def add(self, job, weight=1.0):
+        """ Records a MediaConverter as queued. A job writing to the same output as an unfinished job already in the
+         journal isn't added twice, it gets the existing job's id. Sets job.journalId.
+
+        :param job: MediaConverter
+        :param weight: float, cores the job keeps busy, see MediaConverter.cpuWeight()
+        :return: int, id of job in journal
+        """
+        if job.argsArray == ['ffmpeg']:
+            job.generateArgsArray()
+        outputPath = path.abspath(job.outputFilePath)
+
+        with self._lock:
+            row = self._connection.execute("SELECT id FROM jobs WHERE output_path = ? AND state IN "
+                                           "('queued', 'running')", (outputPath,)).fetchone()
+            if row is not None:
+                job.journalId = row['id']
+                return job.journalId
+
+            now = time.time()
+            cursor = self._connection.execute('INSERT INTO jobs (input_path, output_path, args, weight, state, added, '
+                                              'updated, outputs) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                                              (path.abspath(job.inputFilePath), outputPath,
+                                               json.dumps(job.argsArray), weight, 'queued', now, now,
+                                               json.dumps(job.outputIndices)))
+            job.journalId = cursor.lastrowid
+            self._connection.execute('INSERT INTO transitions (job, time, state) VALUES (?, ?, ?)',
+                                     (job.journalId, now, 'queued'))
+            self._connection.commit()
+        return job.journalId
+
+    def set_state(self, job_id, state, return_code=None):
+        """ Moves a job to a new state and records the transition.
+
+        :param job_id: int, id of job in journal
+        :param state: string, one of JobJournal.states
+        :param return_code: int, exit code of the job's process, for 'done' and 'failed'
+        :return:
+        """
+        if state not in JobJournal.states:
+            raise ValueError("Unknown job state {!r}, should be one of {}".format(state, JobJournal.states))
+
+        now = time.time()
+        with self._lock:
+            self._connection.execute('UPDATE jobs SET state = ?, return_code = ?, updated = ? WHERE id = ?',
+                                     (state, return_code, now, job_id))
+            self._connection.execute('INSERT INTO transitions (job, time, state, return_code) VALUES (?, ?, ?, ?)',
+                                     (job_id, now, state, return_code))
+            self._connection.commit()
+
+    def unfinished(self):
+        """ Jobs that are queued or were running when the last run stopped, rebuilt from their recorded args. Running
+         jobs are moved back to 'queued', their partial output is overwritten when they run again.
+
+        :return: list[JournalJob], in the order they were added
+        """
+        with self._lock:
+            rows = self._connection.execute("SELECT * FROM jobs WHERE state IN ('queued', 'running') "
+                                            "ORDER BY id").fetchall()
+        jobs = []
+        for row in rows:
+            if row['state'] == 'running':
+                self.set_state(row['id'], 'queued')
+            outputIndices = json.loads(row['outputs']) if row['outputs'] is not None else None
+            jobs.append(JournalJob(row['id'], row['input_path'], row['output_path'], json.loads(row['args']),
+                                   row['weight'], outputIndices))
+        return jobs
+
+    def jobs(self, state=None):
+        """ Recorded jobs.
+
+        :param state: string, only jobs in this state. None for every job.
+        :return: list[sqlite3.Row], rows of the jobs table, args as json
+        """
+        with self._lock:
+            if state is None:
+                return self._connection.execute('SELECT * FROM jobs ORDER BY id').fetchall()
+            return self._connection.execute('SELECT * FROM jobs WHERE state = ? ORDER BY id', (state,)).fetchall()
+
+    def transitions(self, job_id):
+        """ States a job moved through.
+
+        :param job_id: int, id of job in journal
+        :return: list[(float, string, int)], time, state and return code of each transition, oldest first
+        """
+        with self._lock:
+            rows = self._connection.execute('SELECT time, state, return_code FROM transitions WHERE job = ? '
+                                            'ORDER BY id', (job_id,)).fetchall()
+        return [tuple(row) for row in rows]
+
+    def clear(self):
+        with self._lock:
+            self._connection.execute('DELETE FROM jobs')
+            self._connection.execute('DELETE FROM transitions')
+            self._connection.commit()
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+class JournalJob:
+    """ A job rebuilt from a JobJournal, runs it's recorded ffmpeg args without the MediaObject it was made from.
+
+    """
+    def __init__(self, journalId, inputFilePath, outputFilePath, argsArray, weight=1.0, outputIndices=None):
+        """
+
+        :param journalId: int, id of job in journal
+        :param inputFilePath: string, path of input file
+        :param outputFilePath: string, path of output file
+        :param argsArray: list[string], ffmpeg args
+        :param weight: float, cores the job keeps busy
+        :param outputIndices: list[int], indices of the output file paths in argsArray. Defaults to the last arg.
+        """
+        self.journalId = journalId
+        self.inputFilePath = inputFilePath
+        self.outputFilePath = outputFilePath
+        self.fileName = path.basename(inputFilePath)
+        self.argsArray = argsArray
+        self.outputIndices = outputIndices if outputIndices is not None else [len(argsArray) - 1]
+        self.weight = weight
+        self.returnCode = None
+
+    def cpuWeight(self):
+        return self.weight
+
+    def lane(self):
+        return args_lane(self.argsArray)
+
+    def convert(self):
+        """ Runs ffmpeg into a partial output, renamed to the output file if ffmpeg succeeds.
+
+        :return: float, seconds the conversion took
+        """
+        outputDirectory = path.dirname(self.outputFilePath)
+        if outputDirectory != '' and not path.isdir(outputDirectory):
+            makedirs(outputDirectory)
+
+        argsArray, partials = partial_args(self.argsArray, self.outputIndices)
+        startTime = time.time()
+        self.returnCode = finish_output(partials, subprocess.run(argsArray).returncode)
+        return time.time() - startTime
+
+    def __repr__(self):
+        return "JournalJob({}, {!r})".format(self.journalId, self.outputFilePath)
@@ -0,0 +1,130 @@
+from .probecache import get_default_probe_cache
+
+from bisect import bisect_right
+import subprocess
+import warnings
+import json
+
+
+class KeyframeIndex:
+    """ Keyframe times of a file's video streams, used to seek clips straight to the keyframe before their start.
+     Times are in seconds from the start of the file, the same timeline ffmpeg's -ss uses.
+
+    """
+    def __init__(self, keyframes, startTime=0.0):
+        """
+
+        :param keyframes: dict, {stream index: sorted list of keyframe times in seconds}
+        :param startTime: float, start_time of the file's format, already subtracted from the keyframe times
+        """
+        self.keyframes = keyframes
+        self.startTime = startTime
+
+    def times(self, stream=None):
+        """ Keyframe times of a stream.
+
+        :param stream: int, stream index. Defaults to the first video stream indexed.
+        :return: list[float], sorted keyframe times, empty if the stream wasn't indexed
+        """
+        if stream is None:
+            if not self.keyframes:
+                return []
+            stream = min(self.keyframes)
+        return self.keyframes.get(stream, [])
+
+    def preceding(self, seconds, stream=None):
+        """ Finds the last keyframe at or before a time.
+
+        :param seconds: float, time in seconds
+        :param stream: int, stream index. Defaults to the first video stream indexed.
+        :return: float, keyframe time, None if there isn't a keyframe before seconds
+        """
+        times = self.times(stream)
+        position = bisect_right(times, seconds)
+        if position == 0:
+            return None
+        return times[position - 1]
+
+    def following(self, seconds, stream=None):
+        """ Finds the first keyframe at or after a time.
+
+        :param seconds: float, time in seconds
+        :param stream: int, stream index. Defaults to the first video stream indexed.
+        :return: float, keyframe time, None if there isn't a keyframe after seconds
+        """
+        times = self.times(stream)
+        position = bisect_right(times, seconds)
+        if position > 0 and times[position - 1] == seconds:
+            return seconds
+        if position == len(times):
+            return None
+        return times[position]
+
+    def toJson(self):
+        return json.dumps({'start_time': self.startTime,
+                           'keyframes': {str(stream): times for stream, times in self.keyframes.items()}})
+
+    @classmethod
+    def fromJson(cls, data):
+        data = json.loads(data)
+        return cls({int(stream): times for stream, times in data['keyframes'].items()}, data['start_time'])
+
+
+def get_keyframe_index(file_path, probe_cache=None):
+    """ Gets the keyframe index of a file's video streams, from the probe cache if it's there. Otherwise it's built
+     with an ffprobe pass that only reads packet headers and their keyframe flags, nothing is decoded, and stored in
+     the cache next to the file's probe data.
+
+    :param file_path: string, path of media file
+    :param probe_cache: ProbeCache, cache to use. Defaults to the cache set with enable_probe_cache(), if any.
+    :return: KeyframeIndex, None if ffprobe couldn't read the file
+    """
+    cache = probe_cache
+    if cache is None:
+        cache = get_default_probe_cache()
+
+    if cache is not None:
+        cached = cache.get(file_path, kind='keyframes')
+        if cached is not None:
+            return KeyframeIndex.fromJson(cached)
+
+    index = build_keyframe_index(file_path)
+    if index is not None and cache is not None:
+        cache.put(file_path, index.toJson(), kind='keyframes')
+    return index
+
+
+def build_keyframe_index(file_path):
+    """ Runs ffprobe over a file's video packets and collects the times of the keyframes.
+
+    :param file_path: string, path of media file
+    :return: KeyframeIndex, None if ffprobe couldn't read the file
+    """
+    argsArray = ['ffprobe', '-v', 'quiet', '-select_streams', 'v', '-show_entries',
+                 'packet=stream_index,pts_time,flags:format=start_time', '-of', 'csv', '-i', file_path]
+    try:
+        probeOut = subprocess.check_output(argsArray).decode("utf-8")
+    except subprocess.CalledProcessError as cpe:
+        warnings.warn("CalledProcessError with " + file_path + " in build_keyframe_index().")
+        print("CalledProcessError: " + str(cpe))
+        print()
+        return None
+
+    keyframes = {}
+    startTime = 0.0
+    for line in probeOut.splitlines():
+        fields = line.split(',')
+        if fields[0] == 'packet' and len(fields) >= 4 and 'K' in fields[3]:
+            try:
+                keyframes.setdefault(int(fields[1]), []).append(float(fields[2]))
+            except ValueError:  # 'N/A' pts
+                continue
+        elif fields[0] == 'format' and len(fields) >= 2:
+            try:
+                startTime = float(fields[1])
+            except ValueError:
+                pass
+
+    for stream in keyframes:
+        keyframes[stream] = sorted(time - startTime for time in keyframes[stream])
+    return KeyframeIndex(keyframes, startTime)
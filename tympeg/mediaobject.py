@@ -1,10 +1,19 @@
 from .timecode import timecode_to_seconds
-
-from os import path, listdir
+from .probecache import get_default_probe_cache
+from .mediastream import MediaStream
+from .streamindex import StreamIndex
+from .discovery import has_media_extension
+from .keyframes import get_keyframe_index
+from .packets import get_bitrate_profile
+
+from os import path, listdir, cpu_count
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import subprocess
+import asyncio
 import warnings
 import json
 from argparse import Namespace
+from sys import intern
 
 
 class MediaObject:
@@ -13,16 +22,86 @@ class MediaObject:
      Contains methods to help find keys and/or values in streams and streams with keys and/or values.
 
     """
-    def __init__(self, filePath):
+    # Attributes a lazy MediaObject can fill in with a partial probe instead of a full one
+    partialAttributes = ('fileIsValid', 'duration', 'codecs', 'streamTypes', 'videoCodec')
+
+    # Keys of self.format{} kept when raw data is dropped
+    formatKeys = ('filename', 'format_name', 'nb_streams', 'duration', 'size', 'bit_rate')
+
+    # ffprobe analysis limits of each probe profile, 'full' uses ffprobe's defaults. probesize is in bytes,
+    # analyzeduration in microseconds.
+    probeLimits = {'full': [],
+                   'fast': ['-probesize', '1000000', '-analyzeduration', '1000000']}
+
+    # What each probe profile asks ffprobe to show, 'fast' only asks for the fields tympeg reads
+    probeEntries = {'full': ['-show_format', '-show_streams'],
+                    'fast': ['-show_entries', 'stream=index,codec_name,codec_type,bit_rate,width,height,coded_width,'
+                                              'coded_height,r_frame_rate:stream_tags=language,BPS,DURATION:'
+                                              'format=filename,format_name,nb_streams,duration,size,bit_rate']}
+
+    # Attributes a lazy MediaObject fills in with a full probe when they're first used
+    probedAttributes = ('ffprobeOut', 'streams', 'videoStreams', 'audioStreams', 'subtitleStreams',
+                        'attachmentStreams', 'unrecognizedStreams', 'resolutions', 'width', 'height', 'format',
+                        'framerates_dec', 'framerates_frac', 'framerate_dec', 'framerate_frac', 'bitrates',
+                        'video_bitrate', 'audio_bitrate', 'bitrate', 'size', 'languages',
+                        'streamIndex') + partialAttributes
+
+    def __init__(self, filePath, probeCache=None, lazy=False, keepRaw=True, probeProfile='full'):
         """ Initializes attributes that the MediaObject will contain.
 
         :param filePath: string, filepath of file to create object over.
+        :param probeCache: ProbeCache, cache of ffprobe results to use. Defaults to the cache set with
+                           enable_probe_cache(), if any.
+        :param lazy: bool, don't set probed attributes until they're used. The first use of an attribute in
+                     self.partialAttributes runs a partial probe, any other probed attribute runs self.run().
+        :param keepRaw: bool, keep ffprobe's output and the raw stream dictionaries after parsing. With False only the
+                        typed MediaStream attributes are kept, which uses a fraction of the memory.
+        :param probeProfile: string, 'full' shows every field with ffprobe's default analysis depth. 'fast' only asks
+                             for the fields tympeg reads and caps how much of the file ffprobe analyzes, which is much
+                             quicker on large MPEG-TS/VOB files and network mounts. Other stream fields aren't set
+                             and some values may be missing from files that need deeper analysis.
         :return:
         """
         self.filePath = filePath
+        self.probeCache = probeCache
+        self.lazy = lazy
+        self.keepRaw = keepRaw
+        if probeProfile not in MediaObject.probeEntries:
+            raise ValueError("Unknown probe profile '{}', use one of {}".format(probeProfile,
+                                                                                sorted(MediaObject.probeEntries)))
+        self.probeProfile = probeProfile
         self.directory, self.fileName = path.split(self.filePath)
+        self.file_size = path.getsize(self.filePath)
+        self.keyframeIndex = None  # Set by getKeyframeIndex()
+        self.bitrateProfile = None  # Set by getBitrateProfile()
+
+        if not lazy:
+            self.resetAttributes()
+
+    def __getattr__(self, name):
+        """ Only called when an attribute isn't set, which for probed attributes means the object is lazy and the
+         attribute hasn't been needed yet.
+        """
+        if name not in MediaObject.probedAttributes or '_partialRun' in self.__dict__ or 'lazy' not in self.__dict__:
+            raise AttributeError("'MediaObject' object has no attribute '{}'".format(name))
+
+        if name in MediaObject.partialAttributes:
+            self.partialRun()
+        else:
+            self.run()
+        return self.__dict__[name]
+
+    def resetAttributes(self):
+        """ Sets the attributes filled in by ffprobe to their defaults.
+
+        :return:
+        """
         self.ffprobeOut = ''
         self.fileIsValid = True
+        self.probeReturnCode = 0  # Set by probeFailed(), negative when ffprobe was killed by a signal
+
+        # Set by parse()
+        self.streamIndex = None
 
         # Set by parseStreams()
         self.streams = []
@@ -36,7 +115,6 @@ class MediaObject:
         self.height = 0
 
         # Set by parseMetaInfo()
-        self.file_size = path.getsize(self.filePath)
         self.format = {}        # Done
         self.framerates_dec = []
         self.framerates_frac = []
@@ -59,32 +137,268 @@ class MediaObject:
 
         :return:
         """
+        cache = self.startRun()
+        if cache is False:
+            return
+
+        if cache is None or not self.readCachedProbe(cache):
+            self.probe()
+            if cache is not None and self.probeReturnCode >= 0:
+                # A killed ffprobe says nothing about the file, only failures of ffprobe itself are remembered
+                cache.put(self.filePath, self.ffprobeOut, kind=self.probeCacheKind())
+
+        if self.fileIsValid:
+            self.parse()
+
+    async def runAsync(self):
+        """ Same as run(), but awaits ffprobe with asyncio instead of blocking on it, so an event loop can keep many
+         probes in flight at once.
+
+        :return:
+        """
+        cache = self.startRun()
+        if cache is False:
+            return
+
+        if cache is None or not self.readCachedProbe(cache):
+            await self.probeAsync()
+            if cache is not None and self.probeReturnCode >= 0:
+                # A killed ffprobe says nothing about the file, only failures of ffprobe itself are remembered
+                cache.put(self.filePath, self.ffprobeOut, kind=self.probeCacheKind())
+
+        if self.fileIsValid:
+            self.parse()
+
+    def startRun(self):
+        """ Resets probed attributes and checks the file exists before a run.
+
+        :return: ProbeCache to use, None if there isn't one, or False if the file doesn't exist.
+        """
+        self.resetAttributes()
 
         if not path.isfile(self.filePath):
             warnings.warn("File specified at " + str(self.filePath) + " does not exist or can't be found!")
+            return False
+
+        cache = self.probeCache
+        if cache is None:
+            cache = get_default_probe_cache()
+        return cache
+
+    def probeCacheKind(self):
+        """ Kind of ProbeCache entry that holds this object's probe profile.
+
+        :return: string
+        """
+        if self.probeProfile == 'full':
+            return 'probe'
+        return 'probe-' + self.probeProfile
+
+    def partialCacheKind(self):
+        """ Kind of ProbeCache entry that holds this object's partial probe.
+
+        :return: string
+        """
+        if self.probeProfile == 'full':
+            return 'partial'
+        return 'partial-' + self.probeProfile
+
+    def cachedProbe(self, cache):
+        """ Gets a cached probe of self.probeProfile. A cached full probe satisfies every profile.
+
+        :param cache: ProbeCache
+        :return: string, cached ffprobe output, None if there isn't one
+        """
+        cached = None
+        if self.probeProfile != 'full':
+            cached = cache.get(self.filePath, kind=self.probeCacheKind())
+        if cached is None:
+            cached = cache.get(self.filePath)
+        return cached
+
+    def readCachedProbe(self, cache):
+        """ Sets self.ffprobeOut and self.fileIsValid from a cached probe.
+
+        :param cache: ProbeCache
+        :return: bool, True if the file had a cache entry
+        """
+        cached = self.cachedProbe(cache)
+        if cached is None:
+            return False
+
+        # An empty entry records a file ffprobe couldn't read
+        self.ffprobeOut = cached
+        self.fileIsValid = cached != ''
+        return True
+
+    def partialRun(self):
+        """ Sets only the attributes in self.partialAttributes, using a cheaper ffprobe call that only asks for stream
+         codecs and duration. Uses a probe of self.probeProfile instead if one is already cached.
+
+        :return:
+        """
+        cache = self.probeCache
+        if cache is None:
+            cache = get_default_probe_cache()
+
+        if cache is not None and self.cachedProbe(cache) is not None:
+            self.run()
             return
 
-        argsArray = ['ffprobe', '-v', 'quiet', '-print_format', 'json', '-show_format', '-show_streams', '-i', self.filePath]
+        self._partialRun = True
+        try:
+            for name in MediaObject.partialAttributes:
+                self.__dict__.pop(name, None)
+            self.fileIsValid = True
+            self.duration = -1.0
+            self.codecs = []
+            self.streamTypes = []
+            self.videoCodec = ''
+
+            if not path.isfile(self.filePath):
+                warnings.warn("File specified at " + str(self.filePath) + " does not exist or can't be found!")
+                return
+
+            probeOut = None
+            if cache is not None:
+                probeOut = cache.get(self.filePath, kind=self.partialCacheKind())
+
+            if probeOut is None:
+                argsArray = ['ffprobe', '-v', 'quiet', '-print_format', 'json'] \
+                    + MediaObject.probeLimits[self.probeProfile] + ['-show_entries',
+                             'stream=index,codec_name,codec_type:stream_tags=DURATION:format=duration',
+                             '-i', self.filePath]
+                returnCode = 0
+                try:
+                    probeOut = subprocess.check_output(argsArray).decode("utf-8")
+                except subprocess.CalledProcessError as cpe:
+                    warnings.warn("CalledProcessError with " + self.filePath + " in MediaObject.partialRun()."
+                                                                               " File is likely malformed or invalid.")
+                    print("CalledProcessError: " + str(cpe))
+                    print()
+                    probeOut = ''
+                    returnCode = cpe.returncode
+                if cache is not None and returnCode >= 0:
+                    cache.put(self.filePath, probeOut, kind=self.partialCacheKind())
+
+            if probeOut == '':
+                self.fileIsValid = False
+            else:
+                self.parsePartial(json.loads(probeOut))
+        finally:
+            del self._partialRun
+
+    def parsePartial(self, probeData):
+        """ Sets duration, codecs, streamTypes and videoCodec from the output of partialRun()'s ffprobe call.
+
+        :param probeData: dict, decoded ffprobe output
+        :return:
+        """
+        streams = probeData.get('streams', [])
+        try:
+            self.duration = float(probeData['format']['duration'])
+        except KeyError:
+            try:
+                self.duration = timecode_to_seconds(streams[0]['tags']['DURATION'])
+            except (KeyError, IndexError):
+                pass
+
+        for stream in streams:
+            self.codecs.append(intern(stream.get('codec_name', 'unknown')))
+            self.streamTypes.append(intern(stream.get('codec_type', 'unknown')))
+        self.setVideoCodec()
+
+    def probeArgs(self):
+        """ Args of the ffprobe call made by probe() and probeAsync().
+
+        :return: list[str]
+        """
+        return ['ffprobe', '-v', 'quiet', '-print_format', 'json'] + MediaObject.probeLimits[self.probeProfile] \
+            + MediaObject.probeEntries[self.probeProfile] + ['-i', self.filePath]
+
+    def probe(self):
+        """ Calls ffprobe on the file and stores it's json output as self.ffprobeOut. Sets self.fileIsValid to False if
+         ffprobe fails.
+
+        :return:
+        """
         try:
             print("Creating MediaObject of: " + str(self.filePath))
-            self.ffprobeOut = subprocess.check_output(argsArray).decode("utf-8")
+            self.ffprobeOut = subprocess.check_output(self.probeArgs()).decode("utf-8")
         except subprocess.CalledProcessError as cpe:
-            warnings.warn("CalledProcessError with " + self.filePath + " in MediaObject.run()."
-                                                                       " File is likely malformed or invalid.")
-            print("CalledProcessError: " + str(cpe))
-            print()
-            self.fileIsValid = False
+            self.probeFailed(cpe)
 
-        if self.fileIsValid:
+    async def probeAsync(self):
+        """ Same as probe(), but runs ffprobe with asyncio.create_subprocess_exec().
 
-            self.parseStreams()
-            self.parseMetaInfo()
+        :return:
+        """
+        argsArray = self.probeArgs()
+        print("Creating MediaObject of: " + str(self.filePath))
+        process = await asyncio.create_subprocess_exec(*argsArray, stdout=asyncio.subprocess.PIPE)
+        try:
+            stdout, stderr = await process.communicate()
+        except asyncio.CancelledError:
+            process.kill()
+            await process.wait()
+            raise
+        if process.returncode != 0:
+            self.probeFailed(subprocess.CalledProcessError(process.returncode, argsArray, stdout))
+        else:
+            self.ffprobeOut = stdout.decode("utf-8")
+
+    def probeFailed(self, cpe):
+        """ Marks the file invalid after ffprobe exits with an error.
 
+        :param cpe: CalledProcessError
+        :return:
+        """
+        warnings.warn("CalledProcessError with " + self.filePath + " in MediaObject.run()."
+                                                                   " File is likely malformed or invalid.")
+        print("CalledProcessError: " + str(cpe))
+        print()
+        self.fileIsValid = False
+        self.ffprobeOut = ''
+        self.probeReturnCode = cpe.returncode
+
+    def parse(self):
+        """ Decodes self.ffprobeOut once and parses the streams and meta info from the decoded dictionaries. Then
+         replaces the stream dictionaries in self.streams[] with MediaStream objects, dropping the raw data unless
+         self.keepRaw is set.
+
+        :return:
+        """
+        probeData = json.loads(self.ffprobeOut)
+        self.streamIndex = StreamIndex(probeData.get('streams', []))
+        self.parseStreams(probeData)
+        self.parseMetaInfo(probeData)
 
-    def parseMetaInfo(self):
+        self.streams = [MediaStream.fromDict(stream, self.keepRaw) for stream in self.streams]
+        if not self.keepRaw:
+            self.compact()
+
+    def compact(self):
+        """ Drops ffprobe's output and the raw stream dictionaries, keeping only the typed MediaStream attributes.
+         Dictionary style access to streams still works for the fields MediaStream keeps, and self.format{} keeps
+         the keys in self.formatKeys.
+
+        :return:
+        """
+        self.keepRaw = False
+        self.ffprobeOut = ''
+        self.streamIndex = None  # Rebuilt from the MediaStreams if it's needed again
+        self.format = {key: self.format[key] for key in MediaObject.formatKeys if key in self.format}
+        for stream in self.streams:
+            if isinstance(stream, MediaStream):
+                stream.dropRaw()
+        self.streams = [stream if isinstance(stream, MediaStream) else MediaStream.fromDict(stream, False)
+                        for stream in self.streams]
+
+    def parseMetaInfo(self, probeData=None):
         """ Parses ffprobe json output and builds the self.format{} dictionary. Also sets some useful attributes like
         filesize, bitrate, codecs, etc...
 
+        :param probeData: dict, decoded ffprobe output. self.ffprobeOut is decoded if not given.
         :return:
         """
 
@@ -102,25 +416,27 @@ class MediaObject:
                 value = default
             return value
 
-        ffProbeInfo = json.loads(self.ffprobeOut, object_hook=lambda d: Namespace(**d))
-        self.namespaceToDict(ffProbeInfo.format, '', -1, self.format)
+        if probeData is None:
+            probeData = json.loads(self.ffprobeOut)
+
+        self.format = probeData.get('format', {})
         self.bitrate = try_to_get_int('bit_rate')
-        self.duration = try_to_get_float('duration')
+        self.duration = try_to_get_float('duration', self.duration)  # keeps the stream duration parseStreams() found
         self.size = try_to_get_int('size')
 
         for stream in self.streams:
 
             # Setting self.codecs[],
             try:
-                self.codecs.append(stream['codec_name'])
+                self.codecs.append(intern(stream['codec_name']))
             except KeyError:
                 print("codec_name not found in stream " + str(stream['index']))
                 print("     codecs[" + str(stream['index']) + "] set to 'unknown'.")
-                self.streamTypes.append('unknown')
+                self.codecs.append('unknown')
 
             # Setting self.streamTypes[]
             try:
-                self.streamTypes.append(stream['codec_type'])
+                self.streamTypes.append(intern(stream['codec_type']))
             except KeyError:
                 print("codec_type not found in stream " + str(stream['index']))
                 print("     streamTypes[" + str(stream['index']) + "] set to 'unknown'.")
@@ -145,7 +461,13 @@ class MediaObject:
 
         # warnings.warn("self.bitrates[] is currently unreliable, particularily if a file has already been transcoded.")
 
-        # Set self.videoCodec
+        self.setVideoCodec()
+
+    def setVideoCodec(self):
+        """ Sets self.videoCodec from self.codecs[] and self.streamTypes[].
+
+        :return:
+        """
         vidcodecs = self.videoCodecs()
         if len(vidcodecs) > 1:
             self.videoCodec = [0]
@@ -158,37 +480,31 @@ class MediaObject:
                 print(ie)
                 print("Could not find videoCodec info")
 
-
-    def parseStreams(self):
+    def parseStreams(self, probeData=None):
         """ Turns the ffprobe json stream output into nested dictionaries stored as a list at self.streams[{}]. Sorts
          streams into seperate lists based on type (audio, video, etc...). Lists of types integers that correspond to
          the index of self.streams[].
 
+        :param probeData: dict, decoded ffprobe output. self.ffprobeOut is decoded if not given.
         :return:
         """
-        ffProbeInfo = json.loads(self.ffprobeOut, object_hook=lambda d: Namespace(**d))
+        if probeData is None:
+            probeData = json.loads(self.ffprobeOut)
 
         try:
-            # print(self.ffprobeOut)
-            self.duration = float(json.loads(self.ffprobeOut)['format']['duration'])
+            self.duration = float(probeData['format']['duration'])
 
         except KeyError:
             try:  # Try getting duration from video stream
                 print("Extracting duration from video stream...")
                 print("\t"+self.filePath)
-                self.duration = timecode_to_seconds(json.loads(self.ffprobeOut)['streams'][0]['tags']['DURATION'])
+                self.duration = timecode_to_seconds(probeData['streams'][0]['tags']['DURATION'])
                 print("Extracted duration is {}\n".format(self.duration))
 
-            except KeyError:
+            except (KeyError, IndexError):
                 print("\tDuration couldn't be found in file meta-info or video stream! Defaulting to a duration of -1.0!")
 
-
-        i = 0
-        for stream in ffProbeInfo.streams:
-            streamDict = {}
-            self.streams.append(streamDict)
-            self.namespaceToDict(stream, '', -1, self.streams[i])
-            i += 1
+        self.streams = probeData.get('streams', [])
         for stream in self.streams:
             if stream['codec_type'] == "video":
                 self.videoStreams.append(stream['index'])
@@ -309,6 +625,35 @@ class MediaObject:
 
         return streamArray
 
+    def getKeyframeIndex(self):
+        """ Gets the KeyframeIndex of the file's video streams, from the probe cache or with a packet scan the first
+         time it's needed.
+
+        :return: KeyframeIndex, None if ffprobe couldn't read the file
+        """
+        if self.keyframeIndex is None:
+            self.keyframeIndex = get_keyframe_index(self.filePath, self.probeCache)
+        return self.keyframeIndex
+
+    def getBitrateProfile(self, interval=1.0):
+        """ Gets the measured per stream bitrates of the file, see packets.analyze_packets(). Needs numpy.
+
+        :param interval: float, length of each bitrate interval in seconds
+        :return: BitrateProfile, None if ffprobe couldn't read the file
+        """
+        if self.bitrateProfile is None or self.bitrateProfile.interval != interval:
+            self.bitrateProfile = get_bitrate_profile(self.filePath, interval, self.probeCache)
+        return self.bitrateProfile
+
+    def getStreamIndex(self):
+        """ Gets the StreamIndex of self.streams[], building it if parse() didn't or compact() dropped it.
+
+        :return: StreamIndex
+        """
+        if self.streamIndex is None:
+            self.streamIndex = StreamIndex(self.streams)
+        return self.streamIndex
+
     def getStreamsWithValue(self, value, streamList=''):
         """ Finds streams with values in them and returns their self.streams[] indices in an array.
 
@@ -316,58 +661,21 @@ class MediaObject:
         :return: array[int], an array of integers whose values correspond to the self.streams[] array that the value
         was found in.
         """
-        def isValueInStream(nestedDict, value, prepath=()):
-            for keys, values in nestedDict.items():
-                path = prepath + (keys,)
-                if values == value: # found value
-                    return True
-                elif hasattr(values, 'items'): # v is a dict
-                    p = isValueInStream(values, value, path) # recursive call
-                    if p is not None:
-                        return p
-        streams = []
         if streamList == '':
-            streams = self.streams
-        else:
-            for stream in streamList:
-                streams.append(self.streams[int(stream)])
-
-        streamArray = []
-        for stream in streams:
-            if isValueInStream(stream, value):
-                streamArray.append(stream['index'])
-        return streamArray
+            streamList = None
+        return self.getStreamIndex().streamsWithValue(value, streamList)
 
     def getStreamsWithKeys(self, key, streamList=''):
         """ Finds streams with the specified key in them and returns their self.streams[] indices in an array.
 
-        :param key: string, the value that you want to find in the stream dictionaries.
+        :param key: string, the key that you want to find in the stream dictionaries. Nested keys can also be given
+                    as a dotted path, 'tags.language'.
         :return: array[int], an array of integers whose values correspond to the self.streams[] array that the key
         was found in.
         """
-        def isKeyInStream(nestedDict, key, prepath=()):
-            for keys, values in nestedDict.items():
-                path = prepath + (keys,)
-                if keys == key: # found value
-                    return True
-                elif hasattr(values, 'items'): # v is a dict
-                    p = isKeyInStream(values, key, path) # recursive call
-                    if p is not None:
-                        return p
-
-
-        streamArray = []
-        streams = []
         if streamList == '':
-            streams = self.streams
-        else:
-            for stream in streamList:
-                streams.append(self.streams[int(stream)])
-
-        for stream in streams:
-            if isKeyInStream(stream, key):
-                streamArray.append(stream['index'])
-        return streamArray
+            streamList = None
+        return self.getStreamIndex().streamsWithKey(key, streamList)
 
     def getValueFromKey(self,  key, stream):
         """ Gets the value associated with a key from a stream or format dictionary.
@@ -380,8 +688,11 @@ class MediaObject:
         streamDict = {}
 
         if isinstance(stream, int):
-            streamDict = self.streams[stream]
-        elif isinstance(stream, dict):
+            return self.getStreamIndex().value(stream, key)
+        elif isinstance(stream, (dict, MediaStream)) and self.streamIndex is not None \
+                and self.streamIndex.flat and self._isIndexedStream(stream):
+            return self.streamIndex.value(stream['index'], key)
+        elif isinstance(stream, (dict, MediaStream)):
             streamDict = stream
         else:
             print('getValueFromKey(): stream parameter not understood. Should be a stream dictionary'
@@ -395,8 +706,19 @@ class MediaObject:
                     if item is not None:
                         return item
 
+    def _isIndexedStream(self, stream):
+        """ Whether stream is the self.streams[] entry self.streamIndex was built for, rather than a format or
+         other dictionary.
+        """
+        position = stream.get('index')
+        if not isinstance(position, int) or not 0 <= position < len(self.streams):
+            return False
+        indexed = self.streams[position]
+        return indexed is stream or (isinstance(indexed, MediaStream) and indexed.raw is stream)
+
     def namespaceToDict(self, data, key, level, streamDict):
-        """ Transforms namespace extracted from ffprobe json into a nested dictionary strucutre for polling later.
+        """ Transforms namespace extracted from ffprobe json into a nested dictionary strucutre for polling later. No
+         longer used by parse(), which decodes ffprobe's json straight into dictionaries.
 
         :param data: Namespace or dictionary
         :param key: string, can be empty (should be for top levels)
@@ -420,7 +742,17 @@ class MediaObject:
                     self.namespaceToDict(value, key, level, streamDict)
 
 
-def makeMediaObjectsInDirectory(directory, selector=None):
+def makeMediaObjectsInDirectory(directory, selector=None, workers=None, lazy=False, probeProfile='full'):
+    """ Makes and runs MediaObjects of the media files in a directory (non-recursive).
+
+    :param directory: string, path of directory to search for media files
+    :param selector: unused
+    :param workers: int, number of ffprobe calls to run at once. Defaults to the number of cores, 1 probes serially.
+    :param lazy: bool, make lazy MediaObjects and only run their partial probes, which is enough to filter files on
+                 codec, duration or validity. A full probe runs later for any object whose other attributes are used.
+    :param probeProfile: string, 'full' or 'fast', see MediaObject()
+    :return: array[MediaObject], in directory listing order. Files ffprobe couldn't read have fileIsValid set to False.
+    """
 
     def conditionDirectoryString(directoryString):
         if type(directoryString) is not str:
@@ -433,13 +765,167 @@ def makeMediaObjectsInDirectory(directory, selector=None):
 
     directory = conditionDirectoryString(directory)
     mediaObjectArray = []
-    fileExtensions = ['.mp4', '.mkv', '.avi', '.m4v', '.wmv', '.webm', '.flv', '.mov', '.mpg', '.mpeg', '.ogg', '.ogv',
-                      '.ts', '.vob', '.VOB', '.mov', '.MOV', '.rmvb']
 
     for fileNames in listdir(directory):
-        if any(extensions in fileNames for extensions in fileExtensions):
-            mediaInfo = MediaObject(directory + fileNames)
-            mediaInfo.run()
-            mediaObjectArray.append(mediaInfo)
+        if has_media_extension(fileNames) and path.isfile(directory + fileNames):
+            mediaObjectArray.append(MediaObject(directory + fileNames, lazy=lazy, probeProfile=probeProfile))
+
+    if workers is None:
+        workers = cpu_count() or 1
+
+    if lazy:
+        runner = partialRunMediaObject
+    else:
+        runner = runMediaObject
+
+    if workers <= 1 or len(mediaObjectArray) <= 1:
+        for mediaInfo in mediaObjectArray:
+            runner(mediaInfo)
+    else:
+        # ffprobe does the work, threads just wait on it. map() keeps the results in listing order.
+        with ThreadPoolExecutor(max_workers=min(workers, len(mediaObjectArray))) as executor:
+            list(executor.map(runner, mediaObjectArray))
 
     return mediaObjectArray
+
+
+def iterMediaObjects(filePaths, workers=None, lazy=False, probeProfile='full'):
+    """ Makes and runs MediaObjects of filePaths in a pool of workers, yielding them as they complete. filePaths is only
+     consumed as workers free up, so it can be find_media_files() feeding the workers while it's still walking a tree.
+
+        for media in iterMediaObjects(find_media_files('/media/', sniff=True)):
+            ...
+
+    :param filePaths: iterable[string], paths of media files
+    :param workers: int, number of ffprobe calls to run at once. Defaults to the number of cores.
+    :param lazy: bool, only run partial probes, see makeMediaObjectsInDirectory()
+    :param probeProfile: string, 'full' or 'fast', see MediaObject()
+    :return: iterator of MediaObject, in completion order
+    """
+    if workers is None:
+        workers = cpu_count() or 1
+    workers = max(1, workers)
+
+    if lazy:
+        runner = partialRunMediaObject
+    else:
+        runner = runMediaObject
+
+    filePaths = iter(filePaths)
+    pending = set()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        try:
+            while True:
+                # Keep a few paths queued per worker so none of them wait on the walk
+                for filePath in filePaths:
+                    try:
+                        mediaObject = MediaObject(filePath, lazy=lazy, probeProfile=probeProfile)
+                    except OSError:  # Removed since it was found
+                        continue
+                    pending.add(executor.submit(runner, mediaObject))
+                    if len(pending) >= 2 * workers:
+                        break
+                if not pending:
+                    return
+
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+def runMediaObject(mediaObject):
+    """ Runs a MediaObject, marking it invalid instead of raising if it's ffprobe output can't be parsed, so one bad
+     file doesn't abort a batch.
+
+    :param mediaObject: MediaObject
+    :return: MediaObject
+    """
+    try:
+        mediaObject.run()
+    except Exception as e:
+        warnings.warn("{} while parsing {}: {}".format(type(e).__name__, mediaObject.filePath, e))
+        mediaObject.fileIsValid = False
+    return mediaObject
+
+
+def partialRunMediaObject(mediaObject):
+    """ Same as runMediaObject(), but only runs the MediaObject's partial probe.
+
+    :param mediaObject: MediaObject
+    :return: MediaObject
+    """
+    try:
+        mediaObject.partialRun()
+    except Exception as e:
+        warnings.warn("{} while parsing {}: {}".format(type(e).__name__, mediaObject.filePath, e))
+        mediaObject.fileIsValid = False
+    return mediaObject
+
+
+async def probe(filePath, probeCache=None, keepRaw=True, probeProfile='full'):
+    """ Makes and runs a MediaObject without blocking the event loop. Like runMediaObject(), a file whose ffprobe
+     output can't be parsed is marked invalid instead of raising.
+
+    :param filePath: string, path of media file
+    :param probeCache: ProbeCache, cache of ffprobe results to use. Defaults to the cache set with enable_probe_cache().
+    :param keepRaw: bool, see MediaObject()
+    :param probeProfile: string, 'full' or 'fast', see MediaObject()
+    :return: MediaObject, None if the file was removed or can't be read
+    """
+    try:
+        mediaObject = MediaObject(filePath, probeCache=probeCache, keepRaw=keepRaw, probeProfile=probeProfile)
+    except OSError as e:  # Removed or unreadable since it was found
+        warnings.warn("{} while probing {}: {}".format(type(e).__name__, filePath, e))
+        return None
+    try:
+        await mediaObject.runAsync()
+    except Exception as e:
+        warnings.warn("{} while parsing {}: {}".format(type(e).__name__, mediaObject.filePath, e))
+        mediaObject.fileIsValid = False
+    return mediaObject
+
+
+async def probe_many(filePaths, concurrency=None, probeCache=None, keepRaw=True, probeProfile='full'):
+    """ Probes many files with at most concurrency ffprobe calls in flight, yielding MediaObjects as they complete.
+     filePaths is only consumed as slots free up, so it can be a generator over a large library. Files that were
+     removed or can't be read are skipped.
+
+        async for mediaObject in probe_many(paths, concurrency=64):
+            ...
+
+    :param filePaths: iterable[string], paths of media files
+    :param concurrency: int, number of ffprobe calls to run at once. Defaults to four per core.
+    :param probeCache: ProbeCache, cache of ffprobe results to use. Defaults to the cache set with enable_probe_cache().
+    :param keepRaw: bool, see MediaObject()
+    :param probeProfile: string, 'full' or 'fast', see MediaObject()
+    :return: async iterator of MediaObject, in completion order
+    """
+    if concurrency is None:
+        concurrency = 4 * (cpu_count() or 1)
+    concurrency = max(1, concurrency)
+
+    filePaths = iter(filePaths)
+    pending = set()
+    try:
+        while True:
+            for filePath in filePaths:
+                pending.add(asyncio.ensure_future(probe(filePath, probeCache, keepRaw, probeProfile)))
+                if len(pending) >= concurrency:
+                    break
+            if not pending:
+                return
+
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                mediaObject = task.result()
+                if mediaObject is not None:
+                    yield mediaObject
+    finally:
+        # The caller stopped iterating early, don't leave ffprobe calls running
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.wait(pending)
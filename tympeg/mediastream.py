@@ -0,0 +1,139 @@
+from fractions import Fraction
+from sys import intern
+
+
+class MediaStream:
+    """ Compact representation of one stream of a MediaObject. Holds the fields tympeg uses as typed attributes and,
+     optionally, the raw ffprobe dictionary of the stream. Supports read-only dictionary style access
+     (stream['codec_type'], stream['tags']['language'], .items(), etc...) so code written against the old stream
+     dictionaries keeps working after the raw dictionary is dropped.
+
+    """
+    __slots__ = ('index', 'codec_type', 'codec_name', 'bit_rate', 'width', 'height', 'coded_width', 'coded_height',
+                 'frame_rate', 'language', 'raw')
+
+    def __init__(self, index=0, codec_type='unknown', codec_name='unknown', bit_rate=0, width=0, height=0,
+                 coded_width=0, coded_height=0, frame_rate=None, language='', raw=None):
+        """
+
+        :param index: int, index of stream in file
+        :param codec_type: string, 'video', 'audio', 'subtitle', 'attachment', etc...
+        :param codec_name: string, name of codec stream is encoded with
+        :param bit_rate: int, bits/s of stream, 0 if unknown
+        :param width: int, width in pixels, 0 for non-video streams
+        :param height: int, height in pixels, 0 for non-video streams
+        :param coded_width: int, coded width in pixels, 0 for non-video streams
+        :param coded_height: int, coded height in pixels, 0 for non-video streams
+        :param frame_rate: Fraction, frame rate of video streams, None for others
+        :param language: string, language tag of the stream, '' if not tagged
+        :param raw: dict, raw ffprobe dictionary of stream, None if it was dropped
+        """
+        self.index = index
+        self.codec_type = codec_type
+        self.codec_name = codec_name
+        self.bit_rate = bit_rate
+        self.width = width
+        self.height = height
+        self.coded_width = coded_width
+        self.coded_height = coded_height
+        self.frame_rate = frame_rate
+        self.language = language
+        self.raw = raw
+
+    @classmethod
+    def fromDict(cls, streamDict, keepRaw=True):
+        """ Makes a MediaStream from a stream dictionary of ffprobe's json output.
+
+        :param streamDict: dict, stream dictionary
+        :param keepRaw: bool, keep streamDict for access to fields that don't have an attribute
+        :return: MediaStream
+        """
+        tags = streamDict.get('tags', {})
+
+        bit_rate = streamDict.get('bit_rate', tags.get('BPS', 0))
+        try:
+            bit_rate = int(bit_rate)
+        except ValueError:
+            bit_rate = 0
+
+        try:
+            frame_rate = Fraction(streamDict['r_frame_rate'])
+        except (KeyError, ValueError, ZeroDivisionError):
+            frame_rate = None
+
+        def intField(key):
+            try:
+                return int(streamDict.get(key, 0))
+            except ValueError:
+                return 0
+
+        return cls(index=intField('index'),
+                   codec_type=intern(streamDict.get('codec_type', 'unknown')),
+                   codec_name=intern(streamDict.get('codec_name', 'unknown')),
+                   bit_rate=bit_rate,
+                   width=intField('width'),
+                   height=intField('height'),
+                   coded_width=intField('coded_width'),
+                   coded_height=intField('coded_height'),
+                   frame_rate=frame_rate,
+                   language=intern(tags.get('language', '')),
+                   raw=streamDict if keepRaw else None)
+
+    def fieldDict(self):
+        """ Rebuilds a stream dictionary from the typed attributes, in the same layout as ffprobe's.
+
+        :return: dict
+        """
+        fields = {'index': self.index, 'codec_type': self.codec_type, 'codec_name': self.codec_name}
+        if self.bit_rate:
+            fields['bit_rate'] = self.bit_rate
+        if self.codec_type == 'video':
+            fields['width'] = self.width
+            fields['height'] = self.height
+            fields['coded_width'] = self.coded_width
+            fields['coded_height'] = self.coded_height
+            if self.frame_rate is not None:
+                fields['r_frame_rate'] = '{}/{}'.format(self.frame_rate.numerator, self.frame_rate.denominator)
+        if self.language:
+            fields['tags'] = {'language': self.language}
+        return fields
+
+    def dropRaw(self):
+        """ Drops the raw ffprobe dictionary, leaving only the typed attributes.
+
+        :return:
+        """
+        self.raw = None
+
+    def _dict(self):
+        if self.raw is not None:
+            return self.raw
+        return self.fieldDict()
+
+    def __getitem__(self, key):
+        return self._dict()[key]
+
+    def __contains__(self, key):
+        return key in self._dict()
+
+    def __iter__(self):
+        return iter(self._dict())
+
+    def __len__(self):
+        return len(self._dict())
+
+    def get(self, key, default=None):
+        return self._dict().get(key, default)
+
+    def keys(self):
+        return self._dict().keys()
+
+    def values(self):
+        return self._dict().values()
+
+    def items(self):
+        return self._dict().items()
+
+    def __repr__(self):
+        return "MediaStream(index={}, codec_type='{}', codec_name='{}')".format(self.index, self.codec_type,
+                                                                               self.codec_name)
@@ -0,0 +1,251 @@
+from .probecache import get_default_probe_cache
+
+from array import array
+from io import BytesIO
+import subprocess
+import warnings
+
+try:
+    import numpy
+except ImportError:  # Only needed for packet analysis, pip install tympeg[packets]
+    numpy = None
+
+
+class StreamProfile:
+    """ Measured bitrate over time and GOP sizes of one stream, from it's packet sizes.
+
+    """
+    def __init__(self, index, bits, interval, gopSizes):
+        """
+
+        :param index: int, index of stream in file
+        :param bits: numpy.ndarray, bits of packets in each interval, from the first packet of the file
+        :param interval: float, length of each interval in seconds
+        :param gopSizes: numpy.ndarray, packets in each group of pictures, empty for streams without keyframe gaps
+        """
+        self.index = index
+        self.bits = bits
+        self.interval = interval
+        self.gopSizes = gopSizes
+
+    @property
+    def bitrates(self):
+        """ Bitrate of each interval, bits/s.
+
+        :return: numpy.ndarray
+        """
+        return self.bits / self.interval
+
+    def mean(self):
+        """ Average bitrate over the stream, bits/s.
+
+        :return: float, 0 for an empty stream
+        """
+        if len(self.bits) == 0:
+            return 0.0
+        return float(self.bits.sum()) / (len(self.bits) * self.interval)
+
+    def peak(self):
+        """ Highest bitrate of any interval, bits/s.
+
+        :return: float
+        """
+        if len(self.bits) == 0:
+            return 0.0
+        return float(self.bits.max()) / self.interval
+
+    def percentile(self, q):
+        """ Bitrate that q percent of intervals are at or below, bits/s.
+
+        :param q: float, percentile [0, 100]
+        :return: float
+        """
+        if len(self.bits) == 0:
+            return 0.0
+        return float(numpy.percentile(self.bits, q)) / self.interval
+
+    def __repr__(self):
+        return "StreamProfile(index={}, mean={:.0f}, peak={:.0f})".format(self.index, self.mean(), self.peak())
+
+
+class BitrateProfile:
+    """ Per stream bitrate profiles of a file, see analyze_packets().
+
+    """
+    def __init__(self, streams, interval):
+        """
+
+        :param streams: dict, {stream index: StreamProfile}
+        :param interval: float, length of each interval in seconds
+        """
+        self.streams = streams
+        self.interval = interval
+
+    def __getitem__(self, index):
+        return self.streams[index]
+
+    def __contains__(self, index):
+        return index in self.streams
+
+    def totalMean(self, indices):
+        """ Sum of the average bitrates of streams, bits/s.
+
+        :param indices: list[int], stream indices, streams that weren't measured are skipped
+        :return: float
+        """
+        return sum(self.streams[index].mean() for index in indices if index in self.streams)
+
+    def toBytes(self):
+        """ Compressed .npz representation, for the probe cache.
+
+        :return: bytes
+        """
+        arrays = {'interval': numpy.array([self.interval])}
+        for index, stream in self.streams.items():
+            arrays['bits_{}'.format(index)] = stream.bits
+            arrays['gops_{}'.format(index)] = stream.gopSizes
+        data = BytesIO()
+        numpy.savez_compressed(data, **arrays)
+        return data.getvalue()
+
+    @classmethod
+    def fromBytes(cls, data):
+        with numpy.load(BytesIO(data), allow_pickle=False) as arrays:
+            interval = float(arrays['interval'][0])
+            streams = {}
+            for name in arrays.files:
+                if name.startswith('bits_'):
+                    index = int(name[5:])
+                    streams[index] = StreamProfile(index, arrays[name], interval, arrays['gops_{}'.format(index)])
+        return cls(streams, interval)
+
+
+def get_bitrate_profile(file_path, interval=1.0, probe_cache=None):
+    """ Gets the bitrate profile of a file, from the probe cache if it's there, otherwise with analyze_packets(),
+     storing the result in the cache.
+
+    :param file_path: string, path of media file
+    :param interval: float, length of each bitrate interval in seconds
+    :param probe_cache: ProbeCache, cache to use. Defaults to the cache set with enable_probe_cache(), if any.
+    :return: BitrateProfile, None if ffprobe couldn't read the file
+    """
+    cache = probe_cache
+    if cache is None:
+        cache = get_default_probe_cache()
+
+    kind = 'bitrates-{}'.format(interval)
+    if cache is not None:
+        cached = cache.get(file_path, kind=kind)
+        if cached is not None:
+            _require_numpy()
+            return BitrateProfile.fromBytes(cached)
+
+    profile = analyze_packets(file_path, interval)
+    if profile is not None and cache is not None:
+        cache.put(file_path, profile.toBytes(), kind=kind)
+    return profile
+
+
+def analyze_packets(file_path, interval=1.0, batch_size=65536):
+    """ Measures the bitrate of every stream over time from it's packet sizes. ffprobe's packet listing is read line
+     by line and folded into per interval totals a batch at a time, so memory stays flat however long the file is.
+
+    :param file_path: string, path of media file
+    :param interval: float, length of each bitrate interval in seconds
+    :param batch_size: int, packets parsed before they're added to the totals
+    :return: BitrateProfile, None if ffprobe couldn't read the file
+    """
+    _require_numpy()
+
+    argsArray = ['ffprobe', '-v', 'quiet', '-show_entries', 'packet=stream_index,pts_time,dts_time,size,flags',
+                 '-of', 'csv=p=0', '-i', file_path]
+    process = subprocess.Popen(argsArray, stdout=subprocess.PIPE)
+
+    bits = {}         # stream index: numpy array of bits per interval
+    packets = {}      # stream index: packets seen
+    keyframes = {}    # stream index: array of packet numbers of keyframes
+    lastTime = {}     # stream index: time of last timestamped packet
+    origin = None
+
+    streams = array('l')
+    times = array('d')
+    sizes = array('q')
+
+    def flush():
+        if not streams:
+            return
+        # Copies, the arrays can't be cleared while numpy views of them exist
+        batchStreams = numpy.array(streams)
+        buckets = numpy.maximum(numpy.array(times) - origin, 0) // interval
+        batchSizes = numpy.array(sizes) * 8
+        for index in numpy.unique(batchStreams):
+            selected = batchStreams == index
+            totals = numpy.bincount(buckets[selected].astype(numpy.int64), weights=batchSizes[selected])
+            current = bits.get(int(index))
+            if current is None:
+                current = numpy.zeros(0)
+            if len(totals) > len(current):
+                current = numpy.concatenate([current, numpy.zeros(len(totals) - len(current))])
+            current[:len(totals)] += totals
+            bits[int(index)] = current
+        del streams[:]
+        del times[:]
+        del sizes[:]
+
+    try:
+        for line in process.stdout:
+            fields = line.decode('utf-8').strip().split(',')
+            if len(fields) < 5:
+                continue
+            try:
+                index = int(fields[0])
+                size = int(fields[3])
+            except ValueError:
+                continue
+
+            time = lastTime.get(index)
+            for field in fields[1:3]:
+                try:
+                    time = float(field)
+                    break
+                except ValueError:  # 'N/A'
+                    continue
+            if time is None:
+                continue
+            lastTime[index] = time
+            if origin is None:
+                origin = time
+
+            count = packets.get(index, 0)
+            if 'K' in fields[4]:
+                keyframes.setdefault(index, array('l')).append(count)
+            packets[index] = count + 1
+
+            streams.append(index)
+            times.append(time)
+            sizes.append(size)
+            if len(streams) >= batch_size:
+                flush()
+        flush()
+    finally:
+        process.stdout.close()
+        returncode = process.wait()
+
+    if returncode != 0:
+        warnings.warn("ffprobe exited with {} in analyze_packets() for {}".format(returncode, file_path))
+        return None
+
+    profiles = {}
+    for index, streamBits in bits.items():
+        gopSizes = numpy.zeros(0, dtype=numpy.int64)
+        starts = keyframes.get(index)
+        # Streams where every packet is a keyframe (audio, subtitles) don't have GOPs
+        if starts is not None and len(starts) < packets[index]:
+            gopSizes = numpy.diff(numpy.append(numpy.array(starts), packets[index]))
+        profiles[index] = StreamProfile(index, streamBits, interval, gopSizes.astype(numpy.int64))
+    return BitrateProfile(profiles, interval)
+
+
+def _require_numpy():
+    if numpy is None:
+        raise ImportError("Packet analysis needs numpy, install it with 'pip install numpy'")
@@ -0,0 +1,212 @@
+import sqlite3
+import threading
+import time
+from os import path, makedirs, stat
+
+
+class ProbeCache:
+    """ On-disk cache of ffprobe results backed by SQLite. Entries are keyed on a file's path and validated against
+     its size, mtime_ns and inode, so a file that changes on disk is re-probed automatically. Entries that haven't
+     been used in max_age seconds are evicted, as are the least recently used entries once the cache grows past
+     max_size bytes.
+
+     Empty entries record files ffprobe couldn't read. They expire failure_ttl seconds after they're written, so a
+     file that was still being copied when it was probed is probed again.
+
+    """
+    def __init__(self, cache_directory='', max_size=256 * 1024 * 1024, max_age=90 * 24 * 60 * 60,
+                 failure_ttl=10 * 60):
+        """
+
+        :param cache_directory: string, directory the cache database lives in. Defaults to ~/.cache/tympeg
+        :param max_size: int, maximum size of cached data in bytes
+        :param max_age: int, seconds an entry can go unused before it's evicted
+        :param failure_ttl: int, seconds an empty entry, a failed probe, is kept before the file is probed again
+        """
+        if cache_directory == '':
+            cache_directory = path.join(path.expanduser('~'), '.cache', 'tympeg')
+        if not path.isdir(cache_directory):
+            makedirs(cache_directory)
+
+        self.cache_directory = cache_directory
+        self.db_path = path.join(cache_directory, 'probecache.sqlite3')
+        self.max_size = max_size
+        self.max_age = max_age
+        self.failure_ttl = failure_ttl
+        self.touch_interval = 60 * 60  # Only rewrite an entry's access time when it's older than this (seconds)
+        self.evict_interval = 100  # Number of writes between eviction passes
+
+        self.hits = 0
+        self.misses = 0
+        self._writes = 0
+        self._lock = threading.Lock()
+
+        self._connection = sqlite3.connect(self.db_path, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.execute('CREATE TABLE IF NOT EXISTS probes ('
+                                 'path TEXT NOT NULL, kind TEXT NOT NULL, size INTEGER NOT NULL, '
+                                 'mtime_ns INTEGER NOT NULL, inode INTEGER NOT NULL, created REAL NOT NULL, '
+                                 'accessed REAL NOT NULL, data BLOB NOT NULL, PRIMARY KEY (path, kind))')
+        self._connection.execute('CREATE INDEX IF NOT EXISTS probes_accessed ON probes (accessed)')
+        self._connection.commit()
+        self.evict()
+
+    def get(self, file_path, kind='probe'):
+        """ Gets cached data for a file. Entries whose size, mtime or inode no longer match the file are deleted.
+
+        :param file_path: string, path of the media file
+        :param kind: string, what kind of data is requested, allows several results to be cached per file
+        :return: string or bytes of cached data, None if there's no valid entry
+        """
+        key_path = path.abspath(file_path)
+        try:
+            key = file_key(key_path)
+        except OSError:
+            return None
+
+        with self._lock:
+            row = self._connection.execute('SELECT size, mtime_ns, inode, created, accessed, data FROM probes '
+                                           'WHERE path = ? AND kind = ?', (key_path, kind)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+
+            if tuple(row[:3]) != key:
+                # File changed since it was probed, everything cached about it is stale
+                self._connection.execute('DELETE FROM probes WHERE path = ?', (key_path,))
+                self._connection.commit()
+                self.misses += 1
+                return None
+
+            now = time.time()
+            if len(row[5]) == 0 and now - row[3] > self.failure_ttl:
+                # Failed probe that's old enough to be worth trying again
+                self._connection.execute('DELETE FROM probes WHERE path = ? AND kind = ?', (key_path, kind))
+                self._connection.commit()
+                self.misses += 1
+                return None
+
+            if now - row[4] > self.touch_interval:
+                self._connection.execute('UPDATE probes SET accessed = ? WHERE path = ? AND kind = ?',
+                                         (now, key_path, kind))
+                self._connection.commit()
+            self.hits += 1
+            return row[5]
+
+    def put(self, file_path, data, kind='probe'):
+        """ Stores data for a file, keyed on it's current size, mtime and inode.
+
+        :param file_path: string, path of the media file
+        :param data: string or bytes, data to be cached
+        :param kind: string, what kind of data is being stored
+        :return:
+        """
+        key_path = path.abspath(file_path)
+        try:
+            size, mtime_ns, inode = file_key(key_path)
+        except OSError:
+            return
+
+        now = time.time()
+        with self._lock:
+            # A new key for the file means the other kinds cached for it are stale
+            self._connection.execute('DELETE FROM probes WHERE path = ? AND NOT (size = ? AND mtime_ns = ? '
+                                     'AND inode = ?)', (key_path, size, mtime_ns, inode))
+            self._connection.execute('INSERT OR REPLACE INTO probes VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                                     (key_path, kind, size, mtime_ns, inode, now, now, data))
+            self._connection.commit()
+            self._writes += 1
+            evict = self._writes % self.evict_interval == 0
+
+        if evict:
+            self.evict()
+
+    def invalidate(self, file_path):
+        """ Removes every entry cached for a file.
+
+        :param file_path: string, path of the media file
+        :return:
+        """
+        with self._lock:
+            self._connection.execute('DELETE FROM probes WHERE path = ?', (path.abspath(file_path),))
+            self._connection.commit()
+
+    def evict(self):
+        """ Removes entries older than self.max_age, then the least recently used entries until the cache is no larger
+         than self.max_size.
+
+        :return: int, number of entries removed
+        """
+        with self._lock:
+            removed = self._connection.execute('DELETE FROM probes WHERE accessed < ?',
+                                               (time.time() - self.max_age,)).rowcount
+
+            total_size = self._connection.execute('SELECT COALESCE(SUM(LENGTH(data)), 0) FROM probes').fetchone()[0]
+            if total_size > self.max_size:
+                stale = []
+                for rowid, size in self._connection.execute('SELECT rowid, LENGTH(data) FROM probes '
+                                                            'ORDER BY accessed'):
+                    if total_size <= self.max_size:
+                        break
+                    stale.append((rowid,))
+                    total_size -= size
+                self._connection.executemany('DELETE FROM probes WHERE rowid = ?', stale)
+                removed += len(stale)
+
+            self._connection.commit()
+        return removed
+
+    def clear(self):
+        """ Removes every entry in the cache.
+
+        :return:
+        """
+        with self._lock:
+            self._connection.execute('DELETE FROM probes')
+            self._connection.commit()
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+def file_key(file_path):
+    """ Gets the values a cache entry is validated against.
+
+    :param file_path: string, path of file
+    :return: (int, int, int), size, mtime in nanoseconds and inode of file
+    """
+    st = stat(file_path)
+    return st.st_size, st.st_mtime_ns, st.st_ino
+
+
+_default_cache = None
+
+
+def enable_probe_cache(cache_directory='', max_size=256 * 1024 * 1024, max_age=90 * 24 * 60 * 60,
+                       failure_ttl=10 * 60):
+    """ Creates a ProbeCache and makes it the default for every MediaObject that isn't given one explicitly.
+
+    :param cache_directory: string, directory the cache database lives in. Defaults to ~/.cache/tympeg
+    :param max_size: int, maximum size of cached data in bytes
+    :param max_age: int, seconds an entry can go unused before it's evicted
+    :param failure_ttl: int, seconds an empty entry, a failed probe, is kept before the file is probed again
+    :return: ProbeCache
+    """
+    set_default_probe_cache(ProbeCache(cache_directory, max_size, max_age, failure_ttl))
+    return _default_cache
+
+
+def set_default_probe_cache(cache):
+    """ Sets the ProbeCache MediaObjects use by default, None disables caching.
+
+    :param cache: ProbeCache or None
+    :return:
+    """
+    global _default_cache
+    _default_cache = cache
+
+
+def get_default_probe_cache():
+    return _default_cache
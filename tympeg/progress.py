@@ -0,0 +1,88 @@
+from .timecode import seconds_to_timecode
+
+
+class ConversionProgress:
+    """ One progress report of a running ffmpeg conversion, parsed from it's -progress output.
+
+    """
+    __slots__ = ('frame', 'fps', 'out_time', 'total_size', 'bitrate', 'speed', 'percent', 'eta', 'done')
+
+    def __init__(self, frame=0, fps=0.0, out_time=0.0, total_size=0, bitrate=0.0, speed=0.0, percent=None, eta=None,
+                 done=False):
+        """
+
+        :param frame: int, frames encoded so far
+        :param fps: float, frames encoded per second
+        :param out_time: float, seconds of output written so far
+        :param total_size: int, bytes of output written so far
+        :param bitrate: float, bitrate of output so far, kbits/s
+        :param speed: float, seconds of output written per second, 1.0 is realtime
+        :param percent: float, percent of the output's duration written, None if the duration isn't known
+        :param eta: float, estimated seconds remaining, None if the duration or speed isn't known
+        :param done: bool, True for ffmpeg's last report
+        """
+        self.frame = frame
+        self.fps = fps
+        self.out_time = out_time
+        self.total_size = total_size
+        self.bitrate = bitrate
+        self.speed = speed
+        self.percent = percent
+        self.eta = eta
+        self.done = done
+
+    def __str__(self):
+        line = "frame={} fps={:.1f} time={} size={:,.1f}MB speed={:.2f}x".format(
+            self.frame, self.fps, seconds_to_timecode(self.out_time), self.total_size / 1000000, self.speed)
+        if self.percent is not None:
+            line += " {:.1f}%".format(self.percent)
+        if self.eta is not None:
+            line += " ETA {}".format(seconds_to_timecode(self.eta))
+        return line
+
+    def __repr__(self):
+        return "ConversionProgress({})".format(self)
+
+
+def parse_progress(lines, duration=-1.0):
+    """ Parses ffmpeg's -progress key=value output as it's produced, yielding a ConversionProgress each time ffmpeg
+     finishes a report.
+
+    :param lines: iterable[string or bytes], lines of ffmpeg's -progress output
+    :param duration: float, seconds of output expected, used for percent and eta. <= 0 if unknown.
+    :return: iterator of ConversionProgress
+    """
+    values = {}
+    for line in lines:
+        if isinstance(line, bytes):
+            line = line.decode('utf-8', 'replace')
+        key, separator, value = line.strip().partition('=')
+        if not separator:
+            continue
+        if key != 'progress':
+            values[key] = value
+            continue
+
+        progress = ConversionProgress(frame=_number(values.get('frame'), int),
+                                      fps=_number(values.get('fps')),
+                                      out_time=_number(values.get('out_time_us')) / 1000000,
+                                      total_size=_number(values.get('total_size'), int),
+                                      bitrate=_number(values.get('bitrate', '').replace('kbits/s', '')),
+                                      speed=_number(values.get('speed', '').rstrip('x')),
+                                      done=value == 'end')
+        if duration > 0:
+            progress.percent = min(100.0, 100 * progress.out_time / duration)
+            if progress.done:
+                progress.percent = 100.0
+                progress.eta = 0.0
+            elif progress.speed > 0:
+                progress.eta = max(0.0, duration - progress.out_time) / progress.speed
+        yield progress
+        values = {}
+
+
+def _number(value, kind=float):
+    try:
+        return kind(value)
+    except (TypeError, ValueError):  # Missing or 'N/A'
+        return kind(0)
@@ -0,0 +1,189 @@
+from .probecache import get_default_probe_cache
+
+from concurrent.futures import ThreadPoolExecutor
+from os import path, cpu_count
+import subprocess
+import tempfile
+import warnings
+import shutil
+import json
+import re
+
+
+class CrfEstimate:
+    """ Quality and size of sample encodes of a file at several crfs, and the highest crf that met a quality target,
+     see find_crf().
+
+    """
+    def __init__(self, crf, metric, target, measurements):
+        """
+
+        :param crf: int, highest crf whose samples averaged at least target, the lowest crf tried if none did
+        :param metric: string, 'ssim' or 'psnr'
+        :param target: float, quality the crf had to reach
+        :param measurements: dict, {crf: (mean quality of samples, bitrate of samples in bits/s)}
+        """
+        self.crf = crf
+        self.metric = metric
+        self.target = target
+        self.measurements = measurements
+
+    def quality(self, crf=None):
+        """ Mean quality of the samples encoded at a crf.
+
+        :param crf: int, defaults to the chosen crf
+        :return: float
+        """
+        return self.measurements[self.crf if crf is None else crf][0]
+
+    def bitrate(self, crf=None):
+        """ Bitrate of the samples encoded at a crf, an estimate of the whole encode's video bitrate.
+
+        :param crf: int, defaults to the chosen crf
+        :return: float, bits/s
+        """
+        return self.measurements[self.crf if crf is None else crf][1]
+
+    def toJson(self):
+        return json.dumps({'crf': self.crf, 'metric': self.metric, 'target': self.target,
+                           'measurements': {str(crf): values for crf, values in self.measurements.items()}})
+
+    @classmethod
+    def fromJson(cls, data):
+        data = json.loads(data)
+        return cls(data['crf'], data['metric'], data['target'],
+                   {int(crf): tuple(values) for crf, values in data['measurements'].items()})
+
+    def __repr__(self):
+        return "CrfEstimate(crf={}, {}={:.4f}, bitrate={:.0f})".format(self.crf, self.metric, self.quality(),
+                                                                      self.bitrate())
+
+
+# ffmpeg encoders of the video encoders MediaConverter.createVideoStream() takes
+sample_encoders = {'x264': 'libx264', 'x265': 'libx265', 'vp9': 'libvpx-vp9', 'vp8': 'libvpx'}
+
+# Summary lines the ssim and psnr filters log when they finish
+metric_patterns = {'ssim': re.compile(r'SSIM .*All:([0-9.]+)'), 'psnr': re.compile(r'PSNR .*average:([0-9.]+|inf)')}
+
+
+def find_crf(media_object, video_encoder='x265', speed='veryfast', target=0.98, metric='ssim',
+             crfs=(18, 20, 22, 24, 26, 28, 30), samples=4, sample_seconds=4.0, width=-1, height=-1, workers=None,
+             probe_cache=None):
+    """ Picks the highest crf that keeps a file's video at a target quality, from what the file actually looks like
+     instead of it's bitrate tags. Short samples spread evenly over the file are encoded at every candidate crf at
+     once, and compared to the source with ffmpeg's ssim or psnr filter. The result is stored in the probe cache,
+     keyed on the settings, and used again until the file changes.
+
+    :param media_object: MediaObject, file to encode
+    :param video_encoder: string, 'x264', 'x265', 'vp9' or 'vp8'
+    :param speed: string, x26X preset the file will be encoded with
+    :param target: float, quality to keep, mean SSIM (0 - 1) or PSNR (dB) of the samples
+    :param metric: string, 'ssim' or 'psnr'
+    :param crfs: iterable[int], candidate crfs
+    :param samples: int, number of samples
+    :param sample_seconds: float, length of each sample
+    :param width: int, width the file will be scaled to, -1 keeps the aspect ratio or source width
+    :param height: int, height the file will be scaled to
+    :param workers: int, sample encodes to run at once. Defaults to the number of cores.
+    :param probe_cache: ProbeCache, cache to use. Defaults to the cache set with enable_probe_cache(), if any.
+    :return: CrfEstimate, None if the file has no video or none of the samples could be encoded
+    """
+    if metric not in metric_patterns:
+        raise ValueError("Unknown quality metric {!r}, should be 'ssim' or 'psnr'".format(metric))
+    encoder = sample_encoders.get(video_encoder)
+    if encoder is None:
+        raise ValueError("Can't sample encode with {!r}, should be one of {}".format(video_encoder,
+                                                                                    list(sample_encoders)))
+    if not media_object.videoStreams or media_object.duration <= 0:
+        return None
+    crfs = sorted(crfs)
+
+    cache = probe_cache
+    if cache is None:
+        cache = get_default_probe_cache()
+    kind = 'crf-{}-{}-{}-{}-{}-{}-{}-{}x{}'.format(video_encoder, speed, metric, target,
+                                                   ','.join(str(crf) for crf in crfs), samples, sample_seconds,
+                                                   width, height)
+    if cache is not None:
+        cached = cache.get(media_object.filePath, kind=kind)
+        if cached is not None:
+            return CrfEstimate.fromJson(cached)
+
+    # Sample starts, centered in evenly sized stretches of the file
+    sample_seconds = min(sample_seconds, media_object.duration / samples)
+    starts = [max(0.0, media_object.duration * (sample + 0.5) / samples - sample_seconds / 2)
+              for sample in range(samples)]
+    stream = media_object.videoStreams[0]
+
+    workDirectory = tempfile.mkdtemp(prefix='tympeg-crf-')
+    try:
+        def measure(task):
+            crf, start = task
+            return crf, sample_encode(media_object.filePath, stream, start, sample_seconds, encoder, crf, speed,
+                                      width, height, metric, workDirectory)
+
+        tasks = [(crf, start) for crf in crfs for start in starts]
+        with ThreadPoolExecutor(max_workers=workers or cpu_count() or 1) as executor:
+            results = list(executor.map(measure, tasks))
+    finally:
+        shutil.rmtree(workDirectory, ignore_errors=True)
+
+    measurements = {}
+    for crf in crfs:
+        measured = [result for resultCrf, result in results if resultCrf == crf and result is not None]
+        if len(measured) == len(starts):
+            quality = sum(score for score, size in measured) / len(measured)
+            bitrate = 8 * sum(size for score, size in measured) / (sample_seconds * len(measured))
+            measurements[crf] = (quality, bitrate)
+    if not measurements:
+        warnings.warn("Couldn't encode samples of " + media_object.filePath + " in find_crf().")
+        return None
+
+    passing = [crf for crf, (quality, bitrate) in measurements.items() if quality >= target]
+    estimate = CrfEstimate(max(passing) if passing else min(measurements), metric, target, measurements)
+    if cache is not None:
+        cache.put(media_object.filePath, estimate.toJson(), kind=kind)
+    return estimate
+
+
+def sample_encode(file_path, stream, start, duration, encoder, crf, speed, width, height, metric, directory):
+    """ Encodes one sample of a file's video and measures it against the source.
+
+    :param file_path: string, path of media file
+    :param stream: int, index of video stream
+    :param start: float, seconds into the file the sample starts
+    :param duration: float, seconds of sample
+    :param encoder: string, ffmpeg encoder
+    :param crf: int, constant rate factor
+    :param speed: string, x26X preset
+    :param width: int, width to scale to, -1 to keep the aspect ratio
+    :param height: int, height to scale to
+    :param metric: string, 'ssim' or 'psnr'
+    :param directory: string, directory to write the sample to
+    :return: (float, int), quality and size of the sample in bytes, None if ffmpeg failed
+    """
+    samplePath = path.join(directory, 'sample_{}_{:.3f}.mkv'.format(crf, start))
+    seek = ['-ss', '{:.3f}'.format(start), '-t', '{:.3f}'.format(duration), '-i', file_path]
+    encodeArgs = ['ffmpeg', '-v', 'error', '-nostdin', '-y'] + seek + \
+                 ['-map', '0:' + str(stream), '-c:v', encoder, '-crf', str(crf)]
+    if encoder == 'libvpx-vp9':
+        encodeArgs += ['-b:v', '0']
+    if encoder in ('libx264', 'libx265') and speed:
+        encodeArgs += ['-preset', speed]
+    if width != -1 or height != -1:
+        encodeArgs += ['-vf', 'scale={}:{}'.format(width, height)]
+    if subprocess.run(encodeArgs + [samplePath]).returncode != 0:
+        return None
+
+    # The source is scaled to the sample's size before comparing, when the sample was scaled
+    compareArgs = ['ffmpeg', '-hide_banner', '-nostats', '-nostdin', '-i', samplePath] + seek + \
+                  ['-lavfi', '[1:{}][0:v]scale2ref[reference][sample];[sample][reference]{}'.format(stream, metric),
+                   '-f', 'null', '-']
+    process = subprocess.run(compareArgs, stderr=subprocess.PIPE)
+    if process.returncode != 0:
+        return None
+    match = metric_patterns[metric].search(process.stderr.decode('utf-8', 'replace'))
+    if match is None:
+        return None
+    score = float(match.group(1))  # PSNR of identical frames is 'inf'
+    return score, path.getsize(samplePath)
@@ -1,34 +1,102 @@
+import sys
 import time
+import threading
+from os import path, stat
 from multiprocessing import Process
-from threading import Timer
+from multiprocessing.connection import wait
 
 from .timecode import seconds_to_timecode
 
 from .converter import MediaConverter
+from .jobjournal import JournalJob
 
 
 class MediaConverterQueue:
-    def __init__(self, log_directory='', max_processes=1, logging=False, debug=False):
+    def __init__(self, log_directory='', max_processes=1, logging=False, debug=False, cores=None, journal=None,
+                 controller=None, lanes=None, device_limit=None):
+        """
+
+        :param log_directory: string
+        :param max_processes: int, jobs run at once at most
+        :param logging: bool
+        :param debug: bool
+        :param cores: float, cores to fill. When set, jobs are packed by their MediaConverter.cpuWeight() so the
+                      running jobs add up to about this many cores, a 4K x265 encode runs alone while several 480p
+                      encodes share the machine. None runs max_processes jobs regardless of their weight.
+        :param journal: JobJournal, records each job added and every state it moves through, so resume() can pick
+                        up the unfinished jobs after a crash or reboot
+        :param controller: AdaptiveController, adjusts max_processes from the machine's load while jobs run, and
+                           pauses jobs when memory runs low
+        :param lanes: dict, {lane: jobs run at once at most} for the 'cpu' lane of encodes and the 'io' lane of
+                      stream copies, see job_lane(), so disk bound copies and cpu bound encodes don't crowd each
+                      other out. max_processes still caps the total. None runs every job in one pool.
+        :param device_limit: int, io lane jobs run at once at most on each block device their input or output is on
+        """
+        for lane, limit in (lanes or {}).items():
+            if limit < 1:
+                raise ValueError("Lane {!r} has to run at least 1 job at once, got {}".format(lane, limit))
+        if device_limit is not None and device_limit < 1:
+            raise ValueError("device_limit has to be at least 1, got {}".format(device_limit))
+
         self.job_list = []
         self.processes = []
-        self.refresh_interval = 10  # How often processes are checked to see if they're converted (seconds)
+        self.process_weights = {}  # Running process: cpu weight of it's job
+        self.process_journal_ids = {}  # Running process: journal id of it's job
+        self.process_lanes = {}  # Running process: (lane, block devices) of it's job
         self.active_processes = 0
         self.start_time = 0
         self.end_time = 0
         self.total_time = 0
         self.done = False
+        self.error = None  # Exception that stopped the dispatcher, wait() raises it
 
         self.log_directory = log_directory
         self.max_processes = max_processes
+        self.cores = cores
+        self.journal = journal
+        self.controller = controller
+        self.lanes = lanes
+        self.device_limit = device_limit
+
+        self.dispatcher = None
+        self.finished = threading.Event()
 
     def run(self):
-        self.job_list = sorted(self.job_list, key=lambda media: media.mediaObject.fileName)  # todo TEST THIS !!!
+        """ Starts converting the queued jobs and returns, a dispatcher thread starts the next job the moment a
+         running one exits. self.done is set once every job is finished, wait() blocks until then.
 
-        while (self.count_active_processes() < self.max_processes) and (len(self.job_list) > 0):
-            self.start_job()
+        :return:
+        """
+        self.job_list = sorted(self.job_list, key=job_name)  # todo TEST THIS !!!
+        self.done = False
+        self.error = None
+        self.finished.clear()
+
+        # The dispatcher starts the first jobs, so an error starting them reaches wait() like any other
         self.start_time = time.time()
 
-        self.periodic()
+        self.dispatcher = threading.Thread(target=self.dispatch, name='MediaConverterQueue')
+        self.dispatcher.start()
+
+    def resume(self):
+        """ Queues the jobs self.journal has that didn't finish, as they were recorded, nothing is probed.
+
+        :return: int, number of jobs queued
+        """
+        jobs = self.journal.unfinished()
+        self.job_list.extend(jobs)
+        return len(jobs)
+
+    def wait(self, timeout=None):
+        """ Blocks until every job is done, or the dispatcher stopped on an error, which is raised here.
+
+        :param timeout: float, seconds to wait at most, None waits until the jobs are done
+        :return: bool, self.done
+        """
+        self.finished.wait(timeout)
+        if self.error is not None:
+            raise self.error
+        return self.done
 
     def count_active_processes(self):
         active = 0
@@ -37,7 +105,58 @@ class MediaConverterQueue:
                 active += 1
         return active
 
-    def start_job(self):
+    def active_weight(self):
+        return sum(self.process_weights.get(process, 1.0) for process in self.processes)
+
+    def next_job_index(self):
+        """ Picks the queued job to start next, out of the jobs whose lane and devices have room. Without self.cores
+         that's the one nearest the end of self.job_list. With it, it's the heaviest job that fits in the cores left
+         over, or the heaviest job of all when nothing is running so a job heavier than the machine still runs, alone.
+
+        :return: int, index in self.job_list, None if no job fits
+        """
+        candidates = list(range(len(self.job_list)))
+        if self.lanes is not None or self.device_limit is not None:
+            candidates = [index for index in candidates if self.has_room(self.job_list[index])]
+        if not candidates:
+            return None
+        if self.cores is None:
+            return candidates[-1]
+
+        index = heaviest_fitting([job_weight(self.job_list[index]) for index in candidates],
+                                 self.cores - self.active_weight(), not self.processes)
+        return None if index is None else candidates[index]
+
+    def has_room(self, job):
+        """ Checks a job's lane is under it's limit in self.lanes and, for io lane jobs, that every block device it
+         reads or writes is under self.device_limit.
+
+        :param job: MediaConverter
+        :return: bool
+        """
+        lane = job_lane(job)
+        running = [self.process_lanes[process] for process in self.processes if process in self.process_lanes]
+        if self.lanes is not None and lane in self.lanes:
+            if sum(1 for running_lane, devices in running if running_lane == lane) >= self.lanes[lane]:
+                return False
+        if self.device_limit is not None and lane == 'io':
+            for device in job_devices(job):
+                if sum(1 for running_lane, devices in running if device in devices) >= self.device_limit:
+                    return False
+        return True
+
+    def fill_slots(self):
+        """ Starts queued jobs until max_processes are running, the cores are full or the queue is empty.
+
+        :return:
+        """
+        while (self.count_active_processes() < self.max_processes) and (len(self.job_list) > 0):
+            index = self.next_job_index()
+            if index is None:
+                break
+            self.start_job(index)
+
+    def start_job(self, index=-1):
         # make sure a job can be started without surpassing self.max_processes!
         if self.count_active_processes() >= self.max_processes:
             print("Failed to start a new job, would exceed maximum processes")
@@ -48,37 +167,77 @@ class MediaConverterQueue:
             print("Failed to start a new job, no more jobs remaining!")
             return
 
-        next_job = self.job_list.pop()
-        process = Process(target=next_job.convert, args=())
+        next_job = self.job_list.pop(index)
+        process = Process(target=run_job, args=(next_job,))
         process.start()
         self.processes.append(process)
+        self.process_weights[process] = job_weight(next_job)
+        lane = job_lane(next_job)
+        self.process_lanes[process] = (lane, job_devices(next_job) if lane == 'io' else frozenset())
+        journal_id = getattr(next_job, 'journalId', None)
+        if self.journal is not None and journal_id is not None:
+            self.journal.set_state(journal_id, 'running')
+            self.process_journal_ids[process] = journal_id
 
     def prune_dead_processes(self):
+        alive = []
         for process in self.processes:
-            if (not process.is_alive()) and (type(process) == Process):
-                process.terminate()
-                ndx = self.processes.index(process)
-                del self.processes[ndx]
+            if process.is_alive():
+                alive.append(process)
+            else:
+                process.join()
+                self.process_weights.pop(process, None)
+                self.process_lanes.pop(process, None)
+                journal_id = self.process_journal_ids.pop(process, None)
+                if journal_id is not None:
+                    self.journal.set_state(journal_id, 'done' if process.exitcode == 0 else 'failed',
+                                           process.exitcode)
+        self.processes = alive
 
-    def periodic(self):
-        self.prune_dead_processes()
+    def dispatch(self):
+        """ Waits on the sentinels of the running jobs, filling each freed slot with the next job as soon as it frees
+         up, until the queue is empty and every job has exited.
+
+        :return:
+        """
+        timeout = None
+        next_sample = time.time()
+        try:
+            while True:
+                self.prune_dead_processes()
+                if self.controller is not None and time.time() >= next_sample:
+                    self.controller.update(self)
+                    next_sample = time.time() + self.controller.interval
+                self.fill_slots()
+
+                if len(self.processes) == 0:
+                    if len(self.job_list) > 0:
+                        # Nothing is running to free up room, so these jobs would never start
+                        raise RuntimeError("{} queued jobs can't be started with max_processes={}, lanes={} and "
+                                           "device_limit={}".format(len(self.job_list), self.max_processes,
+                                                                    self.lanes, self.device_limit))
+                    break
+                if self.controller is not None:
+                    timeout = max(0.0, next_sample - time.time())
+                wait([process.sentinel for process in self.processes], timeout)
 
-        # Check if queue is empty and jobs are done
-        if (self.count_active_processes() == 0) and (len(self.job_list) == 0):
-            self.done = True
             print("All jobs completed!")
+        except BaseException as error:
+            self.error = error
+            print("Stopped dispatching jobs: {!r}".format(error))
+        finally:
+            self.done = True
             self.end_time = time.time()
             self.total_time = self.end_time - self.start_time
             print("Took approximately {}.".format(seconds_to_timecode(self.total_time)))
-        else:
-            while (self.count_active_processes() < self.max_processes) and (len(self.job_list) > 0):
-                self.start_job()
-
-            # Schedule next periodic check
-            Timer(self.refresh_interval, self.periodic).start()
+            self.finished.set()
 
     def add_job(self, job):
         if type(job) == MediaConverter:
+            if self.journal is not None:
+                self.journal.add(job, job_weight(job))
+            self.job_list.append(job)
+        elif type(job) == JournalJob:
             self.job_list.append(job)
         else:
             print("add_job(job) takes a MediaConverter object, received {}".format(type(job)))
@@ -103,4 +262,88 @@ class MediaConverterQueue:
         pass
 
     def open_log(self):
-        pass
\ No newline at end of file
+        pass
+
+
+def job_weight(job):
+    """ Cores a queued job keeps busy, 1 for jobs that can't estimate it.
+
+    :param job: MediaConverter
+    :return: float
+    """
+    cpuWeight = getattr(job, 'cpuWeight', None)
+    if cpuWeight is None:
+        return 1.0
+    return cpuWeight()
+
+
+def job_lane(job):
+    """ Lane a queued job runs in, 'io' for stream copies that are disk bound, 'cpu' for encodes.
+
+    :param job: MediaConverter
+    :return: string
+    """
+    lane = getattr(job, 'lane', None)
+    if lane is None:
+        return 'cpu'
+    return lane()
+
+
+def job_devices(job):
+    """ Block devices (st_dev) a job reads it's input from and writes it's output to.
+
+    :param job: MediaConverter
+    :return: frozenset[int]
+    """
+    devices = set()
+    paths = [getattr(job, 'inputFilePath', ''), path.dirname(path.abspath(getattr(job, 'outputFilePath', '')))]
+    for file_path in paths:
+        # The output directory might not exist yet, it'll be made on the device of it's nearest existing parent
+        while file_path != '':
+            try:
+                devices.add(stat(file_path).st_dev)
+                break
+            except OSError:
+                parent = path.dirname(file_path)
+                file_path = parent if parent != file_path else ''
+    return frozenset(devices)
+
+
+def job_name(job):
+    """ Name queued jobs are sorted by, the input file's name.
+
+    :param job: MediaConverter or JournalJob
+    :return: string
+    """
+    return getattr(job, 'mediaObject', job).fileName
+
+
+def heaviest_fitting(weights, free, idle):
+    """ Picks the heaviest job that fits in the free cores. When idle, the heaviest job of all is picked even if it
+     doesn't fit, so a job heavier than the machine still runs, alone.
+
+    :param weights: list[float], cpu weights of queued jobs
+    :param free: float, cores not in use
+    :param idle: bool, nothing is running
+    :return: int, index of job in weights, None if no job fits
+    """
+    best = None
+    best_weight = 0.0
+    # Walked from the end so ties go to the job the count based queue would have started
+    for index in range(len(weights) - 1, -1, -1):
+        weight = weights[index]
+        if (weight <= free or idle) and (best is None or weight > best_weight):
+            best = index
+            best_weight = weight
+    return best
+
+
+def run_job(job):
+    """ Target of a job's process. Exits non-zero if ffmpeg failed, so the queue can tell from the exit code.
+
+    :param job: MediaConverter or JournalJob
+    :return:
+    """
+    job.convert()
+    if getattr(job, 'returnCode', 0):
+        sys.exit(1)
@@ -0,0 +1,209 @@
+"""Micro-benchmarks for tympeg internals that don't need ffmpeg installed. Run with
+python -m tympeg.scripts.benchmarks"""
+
+import json
+import os
+import tempfile
+import time
+import tracemalloc
+from argparse import Namespace
+
+from .. import MediaObject, MediaConverterQueue
+
+
+def synthetic_probe_output(num_video=1, num_audio=4, num_subtitle=24, num_chapters=200):
+    """ Builds an ffprobe -show_format -show_streams -show_chapters style json string, indented like ffprobe's.
+
+    :param num_video: int, number of video streams
+    :param num_audio: int, number of audio streams
+    :param num_subtitle: int, number of subtitle streams
+    :param num_chapters: int, number of chapters
+    :return: string, json
+    """
+    languages = ['eng', 'jpn', 'fre', 'ger', 'spa', 'ita']
+    streams = []
+    for i in range(num_video):
+        streams.append({'index': len(streams), 'codec_name': 'h264', 'codec_long_name': 'H.264 / AVC / MPEG-4 AVC',
+                        'profile': 'High', 'codec_type': 'video', 'codec_tag_string': '[0][0][0][0]',
+                        'width': 1920, 'height': 1080, 'coded_width': 1920, 'coded_height': 1088,
+                        'has_b_frames': 2, 'pix_fmt': 'yuv420p', 'level': 41, 'r_frame_rate': '24000/1001',
+                        'avg_frame_rate': '24000/1001', 'time_base': '1/1000', 'start_pts': 0,
+                        'start_time': '0.000000', 'bit_rate': '6000000',
+                        'disposition': {'default': 1, 'dub': 0, 'original': 0, 'comment': 0, 'lyrics': 0,
+                                        'karaoke': 0, 'forced': 0, 'hearing_impaired': 0},
+                        'tags': {'language': 'und', 'DURATION': '01:58:30.012000000'}})
+    for i in range(num_audio):
+        streams.append({'index': len(streams), 'codec_name': 'aac', 'codec_type': 'audio', 'sample_fmt': 'fltp',
+                        'sample_rate': '48000', 'channels': 2, 'channel_layout': 'stereo', 'time_base': '1/1000',
+                        'bit_rate': '192000',
+                        'disposition': {'default': int(i == 0), 'dub': 0, 'original': 0, 'comment': 0,
+                                        'forced': 0},
+                        'tags': {'language': languages[i % len(languages)], 'title': 'Audio {}'.format(i)}})
+    for i in range(num_subtitle):
+        streams.append({'index': len(streams), 'codec_name': 'ass', 'codec_type': 'subtitle', 'time_base': '1/1000',
+                        'disposition': {'default': 0, 'forced': 0, 'hearing_impaired': 0},
+                        'tags': {'language': languages[i % len(languages)], 'BPS': '120', 'title': 'Sub {}'.format(i)}})
+
+    chapters = []
+    for i in range(num_chapters):
+        chapters.append({'id': i, 'time_base': '1/1000000000', 'start': i * 30000000000,
+                         'start_time': '{:.6f}'.format(i * 30.0), 'end': (i + 1) * 30000000000,
+                         'end_time': '{:.6f}'.format((i + 1) * 30.0), 'tags': {'title': 'Chapter {}'.format(i)}})
+
+    probe = {'streams': streams, 'chapters': chapters,
+             'format': {'filename': 'synthetic.mkv', 'nb_streams': len(streams), 'format_name': 'matroska,webm',
+                        'duration': '7110.012000', 'size': '5400000000', 'bit_rate': '6075000',
+                        'tags': {'title': 'Synthetic', 'ENCODER': 'Lavf58.29.100'}}}
+    return json.dumps(probe, indent=4)
+
+
+def legacy_parse(media):
+    """ Parses media.ffprobeOut the way MediaObject used to: two Namespace decodes, up to two plain decodes for
+     the duration and namespaceToDict() rebuilding dictionaries from the Namespaces.
+
+    :param media: MediaObject with ffprobeOut set
+    :return:
+    """
+    streamsInfo = json.loads(media.ffprobeOut, object_hook=lambda d: Namespace(**d))
+    try:
+        json.loads(media.ffprobeOut)['format']['duration']
+    except KeyError:
+        json.loads(media.ffprobeOut)['streams'][0]['tags']['DURATION']
+
+    streams = []
+    for stream in streamsInfo.streams:
+        streamDict = {}
+        media.namespaceToDict(stream, '', -1, streamDict)
+        streams.append(streamDict)
+
+    formatInfo = json.loads(media.ffprobeOut, object_hook=lambda d: Namespace(**d))
+    formatDict = {}
+    media.namespaceToDict(formatInfo.format, '', -1, formatDict)
+
+    probeData = {'streams': streams, 'format': formatDict}
+    media.parseStreams(probeData)
+    media.parseMetaInfo(probeData)
+
+
+def time_parse(file_path, ffprobe_out, parse, iterations):
+    """ CPU time spent parsing ffprobe_out into fresh MediaObjects.
+
+    :return: float, seconds of cpu time per parse
+    """
+    total = 0.0
+    for i in range(iterations):
+        media = MediaObject(file_path)
+        media.ffprobeOut = ffprobe_out
+        start = time.process_time()
+        parse(media)
+        total += time.process_time() - start
+    return total / iterations
+
+
+def benchmark_parsing(iterations=200, num_subtitle=24, num_chapters=200):
+    ffprobe_out = synthetic_probe_output(num_subtitle=num_subtitle, num_chapters=num_chapters)
+    fd, file_path = tempfile.mkstemp(suffix='.mkv')
+    os.close(fd)
+    try:
+        legacy = time_parse(file_path, ffprobe_out, legacy_parse, iterations)
+        single = time_parse(file_path, ffprobe_out, MediaObject.parse, iterations)
+    finally:
+        os.remove(file_path)
+
+    print("Parsing {:,} bytes of ffprobe output ({} streams, {} chapters), {} iterations:"
+          .format(len(ffprobe_out), len(json.loads(ffprobe_out)['streams']), num_chapters, iterations))
+    print("\tNamespace round-trips: {:.3f} ms/file".format(legacy * 1000))
+    print("\tSingle pass:           {:.3f} ms/file".format(single * 1000))
+    print("\tSaved:                 {:.3f} ms/file ({:.1f}x)".format((legacy - single) * 1000, legacy / single))
+    return legacy, single
+
+
+def benchmark_memory(count=100000, num_subtitle=2):
+    """ Memory held by count parsed MediaObjects, keeping and dropping the raw ffprobe data.
+
+    :param count: int, number of synthetic probe results to hold
+    :param num_subtitle: int, subtitle streams per synthetic file
+    :return: (int, int), bytes held with and without the raw data
+    """
+    template = synthetic_probe_output(num_audio=2, num_subtitle=num_subtitle, num_chapters=0)
+    fd, file_path = tempfile.mkstemp(suffix='.mkv')
+    os.close(fd)
+
+    results = []
+    try:
+        for keepRaw in [True, False]:
+            tracemalloc.start()
+            catalog = []
+            for i in range(count):
+                media = MediaObject(file_path, keepRaw=keepRaw)
+                media.ffprobeOut = template.replace('synthetic.mkv', 'synthetic_{}.mkv'.format(i))
+                media.parse()
+                catalog.append(media)
+            held, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            del catalog
+            results.append(held)
+    finally:
+        os.remove(file_path)
+
+    print("Holding {:,} parsed MediaObjects ({} streams each):".format(count, 4 + num_subtitle))
+    print("\tRaw dictionaries kept: {:,.1f} MB ({:,.0f} bytes/file)".format(results[0] / 1e6, results[0] / count))
+    print("\tMediaStreams only:     {:,.1f} MB ({:,.0f} bytes/file)".format(results[1] / 1e6, results[1] / count))
+    return results[0], results[1]
+
+
+class SleepJob:
+    """ Stand-in for a MediaConverter whose convert() sleeps and logs when it ran. """
+    def __init__(self, name, seconds, log_path):
+        self.mediaObject = Namespace(fileName=name)
+        self.seconds = seconds
+        self.log_path = log_path
+
+    def convert(self):
+        start = time.time()
+        time.sleep(self.seconds)
+        with open(self.log_path, 'a') as log:
+            log.write("{!r},{!r}\n".format(start, time.time()))
+
+
+def benchmark_queue_dispatch(jobs=40, job_seconds=0.05, max_processes=4):
+    """ Delay between a MediaConverterQueue job exiting and the next job starting in the freed slot.
+
+    :param jobs: int, number of jobs
+    :param job_seconds: float, how long each job runs
+    :param max_processes: int, jobs run at once
+    :return: (float, float), mean and max dispatch latency in seconds
+    """
+    fd, log_path = tempfile.mkstemp(suffix='.log')
+    os.close(fd)
+    try:
+        queue = MediaConverterQueue(max_processes=max_processes)
+        queue.job_list = [SleepJob('job_{:04d}'.format(i), job_seconds, log_path) for i in range(jobs)]
+        queue.run()
+        queue.wait()
+        with open(log_path) as log:
+            runs = [tuple(float(value) for value in line.split(',')) for line in log]
+    finally:
+        os.remove(log_path)
+
+    # The k-th job to start (past the first max_processes) waited on the (k - max_processes)-th job to end. Process
+    # startup is included, a job's start is logged from inside it.
+    starts = sorted(start for start, end in runs)
+    ends = sorted(end for start, end in runs)
+    latencies = [starts[k] - ends[k - max_processes] for k in range(max_processes, len(starts))]
+    mean = sum(latencies) / len(latencies)
+
+    print("MediaConverterQueue dispatch of {} jobs of {} s, {} at once:".format(jobs, job_seconds, max_processes))
+    print("\tSentinel wait:  {:.1f} ms mean, {:.1f} ms max between a job exiting and the next starting"
+          .format(mean * 1000, max(latencies) * 1000))
+    print("\tTimer polling:  up to 10 s, 5 s on average (old refresh_interval)")
+    print("\tTotal {:.2f} s, ideal {:.2f} s".format(queue.total_time, jobs * job_seconds / max_processes))
+    return mean, max(latencies)
+
+
+if __name__ == '__main__':
+    benchmark_parsing()
+    print()
+    benchmark_memory()
+    print()
+    benchmark_queue_dispatch()
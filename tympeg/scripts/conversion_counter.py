@@ -37,7 +37,10 @@ def save_log(directory, printable_list, invalid_files, terse=False):
             log_file.write("\t{}\n".format(invalid_files[i]))
 
 
-def analyze(directory, target_codec, print_progress=True):
+def analyze(directory, target_codec, print_progress=True, probe_profile='full', catalog=None):
+    if catalog is not None:
+        return analyze_catalog(directory, target_codec, catalog)
+
     print("Analyzing {}".format(directory))
     directory_list = []
     info_tuples = []
@@ -75,8 +78,7 @@ def analyze(directory, target_codec, print_progress=True):
 
             else:
                 if any(extensions in fileNames for extensions in file_extensions_to_analyze):
-                    media_info = MediaObject(file_path)
-                    media_info.run()
+                    media_info = MediaObject(file_path, lazy=True, probeProfile=probe_profile)
 
                     if media_info.fileIsValid:
                         codec = media_info.videoCodec
@@ -106,8 +108,37 @@ def analyze(directory, target_codec, print_progress=True):
     return printable_list, invalid_files
 
 
-def run_conversion_counter(directory, target_codec):
+def analyze_catalog(directory, target_codec, catalog):
+    """ Same tallies as analyze(), answered by a Catalog instead of probing every file. Run catalog.scan(directory)
+     first to bring it up to date. The catalog only holds media files, so sizes of other files are reported as 0.
+
+    :param directory: string, path of directory whose immediate subdirectories are tallied
+    :param target_codec: string, files whose video codec isn't this are counted
+    :param catalog: Catalog
+    :return: (list[tuple], list[string]), same as analyze()
+    """
+    subdirectories = sorted(path.join(path.abspath(directory), name) for name in os.listdir(directory)
+                            if os.path.isdir(path.join(directory, name)))
+
+    invalid_files = catalog.select([('directory', 'in', subdirectories), ('valid', '=', 0)],
+                                   columns=['path', 'directory', 'size'], order_by=['directory', 'file_name'])
+    invalid = {}
+    for entry in invalid_files:
+        count, size = invalid.get(entry['directory'], (0, 0))
+        invalid[entry['directory']] = (count + 1, size + entry['size'])
+
+    info_tuples = []
+    for group in catalog.group('directory', [('directory', 'in', subdirectories), ('valid', '=', 1),
+                                             ('video_codec', '!=', target_codec)]):
+        num_of_invalid_files, size_of_invalid_files = invalid.get(group['directory'], (0, 0))
+        info_tuples.append((group['size'] / 1000000, group['count'], path.basename(group['directory']),
+                            size_of_invalid_files / 1000000, num_of_invalid_files, 0))
+
+    return sorted(info_tuples), [entry['path'] for entry in invalid_files]
+
+
+def run_conversion_counter(directory, target_codec, probe_profile='full', catalog=None):
 
-    printable, invalids = analyze(directory, target_codec)
+    printable, invalids = analyze(directory, target_codec, probe_profile=probe_profile, catalog=catalog)
     print("\n\nSaving log to {}".format(directory))
     save_log(directory, printable, invalids)
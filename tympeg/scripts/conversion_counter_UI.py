@@ -7,6 +7,7 @@ from __future__ import print_function
 import os, sys, time, math
 
 from .. import MediaObject, get_dir_size_recursive
+from .conversion_counter import analyze_catalog
 
 from PyQt5.QtGui import QTextCursor
 from PyQt5 import QtCore
@@ -21,6 +22,8 @@ class Window(QDialog):
         self.target_codec = 'hevc'
         self.logIsTerse = True
         self.printProgress = True
+        self.probeProfile = 'full'  # 'fast' for quicker scans of large libraries
+        self.catalog = None  # Catalog to answer analyze() from instead of probing every file
         defaultDirectory = "/media/"
 
         screen1 = QHBoxLayout()
@@ -65,6 +68,11 @@ class Window(QDialog):
         print("Analyzing")
 
         rootdir = self.getDirString()
+        if self.catalog is not None:
+            printableList, invalidFilesList = analyze_catalog(rootdir, self.target_codec, self.catalog)
+            self.printAnalysis(printableList, invalidFilesList)
+            return
+
         directoryList = []
         infoTuples = []
         fileExtensionsToAnalyze = ['.mp4', '.mkv', '.avi', '.m4v', '.wmv',
@@ -101,8 +109,7 @@ class Window(QDialog):
 
                 else:
                     if any(extensions in fileNames for extensions in fileExtensionsToAnalyze):
-                        mediaInfo = MediaObject(filePath)
-                        mediaInfo.run()
+                        mediaInfo = MediaObject(filePath, lazy=True, probeProfile=self.probeProfile)
 
                         if mediaInfo.fileIsValid:
                             codec = mediaInfo.videoCodec
@@ -0,0 +1,35 @@
+"""Runs conversion jobs for a JobCoordinator on another machine, replacing hand splitting directories between encode
+boxes. Start a coordinator where the jobs are made, e.g. JobCoordinator.from_queue() with the queue
+convert_folder_x265() in pooled_converter.py builds and an address other machines can reach, then run this on every
+encode box. Input and output paths have to be the same on every box, like a shared mount.
+
+The coordinator's shared secret is read from the TYMPEG_AUTHKEY environment variable, anyone holding it can run
+code on the workers, so keep it out of scripts and shell history.
+
+    TYMPEG_AUTHKEY=... python -m tympeg.scripts.conversion_worker coordinator-host:6390
+"""
+
+import os
+import sys
+
+from .. import ConversionWorker
+
+coordinator_address = ('localhost', 6390)
+authkey_variable = 'TYMPEG_AUTHKEY'
+cores = None  # None uses every core
+
+
+if __name__ == '__main__':
+    address = coordinator_address
+    if len(sys.argv) > 1:
+        host, port = sys.argv[1].rsplit(':', 1)
+        address = (host, int(port))
+
+    authkey = os.environ.get(authkey_variable, '')
+    if authkey == '':
+        print("Set {} to the coordinator's shared secret".format(authkey_variable))
+        sys.exit(1)
+
+    worker = ConversionWorker(address, authkey=authkey.encode('utf-8'), cores=cores)
+    print("Running jobs from {}:{} on {} cores".format(address[0], address[1], worker.cores))
+    print("Ran {} jobs".format(worker.run()))
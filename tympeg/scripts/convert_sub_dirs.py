@@ -9,7 +9,7 @@ import os
 import sys
 import time
 
-from tympeg import MediaConverter, makeMediaObjectsInDirectory, calc_bits_per_pixel, split_ext, get_dir_size
+from tympeg import MediaConverter, makeMediaObjectsInDirectory, calc_bits_per_pixel, split_ext, get_dir_size, find_crf
 
 # This will convert all files in /media/folder1 and /media/folder2 (non-recursive) and will place a log file in each folder
 # parent_dir = '/media/'
@@ -18,6 +18,10 @@ from tympeg import MediaConverter, makeMediaObjectsInDirectory, calc_bits_per_pi
 speed = 'veryfast'  # Reminder: this is x265, don't expect x264 speeds
 log_file = True
 
+# Mean SSIM to keep, each file's crf is picked by sample encoding it at several crfs. None picks the crf from the
+# bits/pixel thresholds in qualities below instead, which go wrong on files with wrong bitrate tags.
+target_ssim = 0.98
+
 # Quality intervals for quality dicts: X & Y are bits/pixel thresholds; a, b, & c are crfs corresponding to intervals
 # Bits/pixel       X           Y
 # <----------------](----------](----------->
@@ -67,7 +71,7 @@ class PrintLogger:
             log.close()
 
 
-def convert_folder_x265(dir_path, qualities, speed, autodelete=False, log=True):
+def convert_folder_x265(dir_path, qualities, speed, autodelete=False, log=True, probe_profile='full', catalog=None):
     """
     Does the converting of sub directories. A lot of the stuff in here is for reporting stats back to user/log.
     :param dir_path: string, path to directory
@@ -75,6 +79,8 @@ def convert_folder_x265(dir_path, qualities, speed, autodelete=False, log=True):
     :param speed: str, x265 speed parameter
     :param autodelete: bool, sets if original files should be deleted after conversion
     :param log: bool, True writes log file into directory, False doesn't
+    :param probe_profile: str, 'full' or 'fast' ffprobe profile used to find the files to convert
+    :param catalog: Catalog, find the files to convert with a catalog query instead of probing every file
     :return:
     """
 
@@ -94,11 +100,13 @@ def convert_folder_x265(dir_path, qualities, speed, autodelete=False, log=True):
     lo.pl(sep)
 
     # Figure out what files need to be converted to h265
-    all_files = makeMediaObjectsInDirectory(dir_path)
-    files_to_move = []
-    for media in all_files:
-        if media.videoCodec != 'hevc':
-            files_to_move.append(media)
+    if catalog is not None:
+        files_to_move = [entry['path'] for entry in
+                         catalog.select([('directory', '=', os.path.abspath(dir_path)), ('video_codec', '!=', 'hevc')],
+                                        columns=['path'], order_by='file_name')]
+    else:
+        all_files = makeMediaObjectsInDirectory(dir_path, lazy=True, probeProfile=probe_profile)
+        files_to_move = [media.filePath for media in all_files if media.videoCodec != 'hevc']
 
     # move files
     original_files_dir = os.path.join(dir_path, 'original_files')
@@ -109,12 +117,14 @@ def convert_folder_x265(dir_path, qualities, speed, autodelete=False, log=True):
 
     if not os.path.isdir(original_files_dir):
         os.mkdir(original_files_dir)
-    for media in files_to_move:
+    for file_path in files_to_move:
         try:
-            os.rename(media.filePath, os.path.join(original_files_dir, media.fileName))
+            os.rename(file_path, os.path.join(original_files_dir, os.path.basename(file_path)))
         except FileExistsError:
-            lo.pl("\nFile: {}\n\tAlready exists! Skipping this one...".format(media.filePath))
+            lo.pl("\nFile: {}\n\tAlready exists! Skipping this one...".format(file_path))
             continue
+    if catalog is not None:
+        catalog.remove(files_to_move)  # Outputs are picked up by the next catalog.scan()
 
     # convert files
     files_to_convert = makeMediaObjectsInDirectory(original_files_dir)
@@ -127,7 +137,7 @@ def convert_folder_x265(dir_path, qualities, speed, autodelete=False, log=True):
     total_files = len(files_to_convert)
     total_input_size = get_dir_size(original_files_dir)/1000000
     for media in files_to_convert:
-        video_rate, audio_rate, channels = decide_quality(qualities, media)
+        video_rate, audio_rate, channels = decide_quality(qualities, media, target_quality=target_ssim, speed=speed)
         name, ext = split_ext(media.fileName)
         output_file_path = os.path.join(dir_path, name + '.mkv')
         media_size = media.file_size/1000000  # MB
@@ -167,7 +177,8 @@ def convert_folder_x265(dir_path, qualities, speed, autodelete=False, log=True):
             print("\nNo audio or video found, skipping...")
             continue
 
-        sec = cvt.convert()
+        sec = cvt.convert(progressCallback=print_progress)
+        print()
         end = time.time()
 
         output_file_size += os.path.getsize(output_file_path)/1000000
@@ -207,18 +218,33 @@ def convert_folder_x265(dir_path, qualities, speed, autodelete=False, log=True):
     lo.pl("{:{align}{width}}".format("-------   DONE   -------", align='^', width=len(sep)))
 
 
-def decide_quality(qualities, media_object):
+def print_progress(progress):
+    """ Overwrites the console line with ffmpeg's latest progress, doesn't go to the log.
+
+    :param progress: ConversionProgress
+    :return:
+    """
+    print("\r\t{}".format(progress), end='', flush=True)
+
+
+def decide_quality(qualities, media_object, measured_bitrate=False, target_quality=None, speed='veryfast'):
     """Chooses the crf quality of the video as well as the bitrate and channels of the audio files from the
     supplied qualities dict.
 
     :param qualities: dict, see notes at top of file
     :param media_object: MediaObject
+    :param measured_bitrate: bool, judge the file by the bitrate measured from it's packets instead of the tagged or
+                             inferred one, needs numpy
+    :param target_quality: float, mean SSIM to keep. When set the crf comes from sample encodes of the file, see
+                           find_crf(), instead of the bits/pixel thresholds that go wrong with wrong bitrate tags. The
+                           thresholds still pick the audio settings.
+    :param speed: str, x265 speed the file will be encoded at, for the sample encodes
     :return: Int, crf level
              Int or Float, audio bitrate
              Int, audio channels
     """
     q = qualities
-    bits_pixel = calc_bits_per_pixel(media_object)
+    bits_pixel = calc_bits_per_pixel(media_object, measured_bitrate)
 
     # Making sure qualities is valid
     n = len(q['threshold'])
@@ -244,5 +270,12 @@ def decide_quality(qualities, media_object):
             audio_bitrate = q['audio'][x][0]
             audio_channels = q['audio'][x][1]
 
+    if target_quality is not None:
+        estimate = find_crf(media_object, 'x265', speed, target_quality)
+        if estimate is not None:
+            crf = estimate.crf
+        else:
+            print("Unable to sample encode, using crf = {} from bits per pixel".format(crf))
+
     return crf, audio_bitrate, audio_channels
 
@@ -6,9 +6,9 @@ import sys
 import time
 from os import path
 
-from .. import makeMediaObjectsInDirectory, MediaConverter, MediaConverterQueue, seconds_to_timecode
+from .. import makeMediaObjectsInDirectory, MediaConverter, MediaConverterQueue, JobJournal, seconds_to_timecode
 
-from .. import calc_bits_per_pixel, split_ext
+from .. import calc_bits_per_pixel, split_ext, find_crf
 
 """Converts media files in specified sub directories of parent_dir to x265 video and opus audio. Keeps only the
 first video and audio stream found.Doesn't attempt to retain subtitles or attachment streams. Attempts to
@@ -21,6 +21,10 @@ dirs_to_convert = ['folder1', 'folder2']
 speed = 'superfast'  # Reminder: this is x265, don't expect x264 speeds
 log_file = True
 
+# Mean SSIM to keep, each file's crf is picked by sample encoding it at several crfs. None picks the crf from the
+# bits/pixel thresholds in qualities below instead, which go wrong on files with wrong bitrate tags.
+target_ssim = 0.98
+
 # Quality intervals for quality dicts: X & Y are bits/pixel thresholds; a, b, & c are crfs corresponding to intervals
 # Bits/pixel       X           Y
 # <----------------](----------](----------->
@@ -60,14 +64,25 @@ class PrintLogger:
             log.close()
 
 
-def convert_folder_x265(dir_path, log=True):
+def convert_folder_x265(dir_path, log=True, probe_profile='full'):
     # declare some media arguments
-    concurrency = 2
+    cores = os.cpu_count() or 1
     speed = 'veryfast'
     codec = 'x265'
 
+    # Jobs are journaled in the folder, if the last run was interrupted pick up it's unfinished jobs as they were
+    journal = JobJournal(path.join(dir_path, '.tympeg_jobs.sqlite3'))
+    q = MediaConverterQueue(max_processes=cores, cores=cores, journal=journal)
+    number_of_files = q.resume()
+    if number_of_files > 0:
+        print("Resuming {} unfinished jobs in {}".format(number_of_files, dir_path))
+        accum_input_size = 1 + sum(path.getsize(job.inputFilePath) for job in q.job_list
+                                   if path.isfile(job.inputFilePath))
+        run_queue(q, dir_path, accum_input_size, number_of_files)
+        return
+
     # Figure out what files need to be converted to h265
-    all_files = makeMediaObjectsInDirectory(dir_path)
+    all_files = makeMediaObjectsInDirectory(dir_path, lazy=True, probeProfile=probe_profile)
     files_to_move = []
     for media in all_files:
         if media.videoCodec != 'hevc':
@@ -91,7 +106,8 @@ def convert_folder_x265(dir_path, log=True):
     accum_input_size = 1  # 1 byte to avoid div by 0 errors in case nothing gets converted
     number_of_files = 0
     for media in files_to_convert:
-        video_rate, audio_rate, audio_channels = decide_quality(media)
+        video_rate, audio_rate, audio_channels = decide_quality(qualities, media, target_quality=target_ssim,
+                                                                speed=speed)
         name, ext = split_ext(media.fileName)
         output_file_path = path.join(dir_path, name + '.mkv')
         if path.isfile(output_file_path):
@@ -113,14 +129,16 @@ def convert_folder_x265(dir_path, log=True):
             print("NO AUDIO FOUND")
         c.append(cvt)
 
+    q.add_jobs(c)
+    run_queue(q, dir_path, accum_input_size, number_of_files)
+
+
+def run_queue(q, dir_path, accum_input_size, number_of_files):
     print("-----  CONVERTING  -----")
 
-    q = MediaConverterQueue(max_processes=concurrency)
-    q.add_jobs(c)
     q.run()
 
-    while not q.done:
-        time.sleep(5)
+    while not q.wait(5):
         print("Working on {}\n".format(dir_path))
 
     MB_Min = (accum_input_size/1000000)/(q.total_time/60)
@@ -128,16 +146,22 @@ def convert_folder_x265(dir_path, log=True):
     print("Conversion took {}, at an average rate of {} MB/min\n\n".format(seconds_to_timecode(q.total_time), MB_Min))
 
 
-def decide_quality(qualities, media_object):
+def decide_quality(qualities, media_object, measured_bitrate=False, target_quality=None, speed='veryfast'):
     """Chooses the crf quality of the video as well as the bitrate and channels of the audio files from the
     supplied qualities dict.
 
     :param qualities: dict, see notes at top of file
     :param media_object: MediaObject
+    :param measured_bitrate: bool, judge the file by the bitrate measured from it's packets instead of the tagged or
+                             inferred one, needs numpy
+    :param target_quality: float, mean SSIM to keep. When set the crf comes from sample encodes of the file, see
+                           find_crf(), instead of the bits/pixel thresholds that go wrong with wrong bitrate tags. The
+                           thresholds still pick the audio settings.
+    :param speed: str, x265 speed the file will be encoded at, for the sample encodes
     :return:
     """
     q = qualities
-    bits_pixel = calc_bits_per_pixel(media_object)
+    bits_pixel = calc_bits_per_pixel(media_object, measured_bitrate)
 
     # Making sure qualities is valid
     n = len(q['threshold'])
@@ -163,6 +187,13 @@ def decide_quality(qualities, media_object):
             audio_bitrate = q['audio'][x][0]
             audio_channels = q['audio'][x][1]
 
+    if target_quality is not None:
+        estimate = find_crf(media_object, 'x265', speed, target_quality)
+        if estimate is not None:
+            crf = estimate.crf
+        else:
+            print("Unable to sample encode, using crf = {} from bits per pixel".format(crf))
+
     return crf, audio_bitrate, audio_channels
 
 if __name__ == '__main__':
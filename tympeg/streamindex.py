@@ -0,0 +1,149 @@
+class StreamIndex:
+    """ Flattened index of a MediaObject's streams. Maps keys, dotted key paths ('tags.language') and values to the
+     streams they're found in, so key and value lookups are dictionary hits instead of walks of nested dictionaries.
+
+    """
+    def __init__(self, streams):
+        """
+
+        :param streams: list of stream dictionaries (or MediaStreams), in self.streams[] order
+        """
+        self.streamIndices = []  # 'index' of each stream, by position
+        self.flat = []           # {key or dotted path: value} of each stream, by position
+        self.keys = {}           # key or dotted path: [positions]
+        self.values = {}         # value: [positions]
+
+        for position, stream in enumerate(streams):
+            flat = {}
+            flattenStream(stream, '', flat)
+            self.flat.append(flat)
+            self.streamIndices.append(stream['index'])
+
+            for key in flat:
+                self.keys.setdefault(key, []).append(position)
+
+            found = set()
+            for value in walkValues(stream):
+                try:
+                    if value in found:
+                        continue
+                    found.add(value)
+                    self.values.setdefault(value, []).append(position)
+                except TypeError:  # unhashable, lists like side_data_list
+                    continue
+
+    def value(self, position, key):
+        """ Gets the value of a key or dotted key path in a stream. Plain keys resolve to the same value
+         MediaObject.getValueFromKey() finds: the stream's own key first, then nested dictionaries in order.
+
+        :param position: int, position of stream in self.streams[]
+        :param key: string, key or dotted key path
+        :return: value, None if the key isn't in the stream
+        """
+        return self.flat[position].get(key)
+
+    def streamsWithKey(self, key, positions=None):
+        """
+
+        :param key: string, key or dotted key path
+        :param positions: list[int], only search these positions, results are in this order
+        :return: list[int], 'index' of streams that contain key
+        """
+        return self._select(self.keys.get(key, []), positions)
+
+    def streamsWithValue(self, value, positions=None):
+        """
+
+        :param value: value to search for. Unhashable values never match.
+        :param positions: list[int], only search these positions, results are in this order
+        :return: list[int], 'index' of streams that contain value
+        """
+        try:
+            found = self.values.get(value, [])
+        except TypeError:
+            found = []
+        return self._select(found, positions)
+
+    def _select(self, found, positions):
+        if positions is None:
+            return [self.streamIndices[position] for position in found]
+        found = set(found)
+        return [self.streamIndices[int(position)] for position in positions if int(position) in found]
+
+
+class MultiStreamIndex:
+    """ Key and value index over the streams of many MediaObjects, for library wide queries like "all streams tagged
+     jpn". Results are (MediaObject, stream index) tuples.
+
+    """
+    def __init__(self, mediaObjects):
+        """
+
+        :param mediaObjects: list[MediaObject], run MediaObjects to index. Invalid ones are skipped.
+        """
+        self.mediaObjects = []
+        self.keys = {}
+        self.values = {}
+        for mediaObject in mediaObjects:
+            self.add(mediaObject)
+
+    def add(self, mediaObject):
+        """ Adds a MediaObject's streams to the index.
+
+        :param mediaObject: MediaObject
+        :return:
+        """
+        if not mediaObject.fileIsValid:
+            return
+        index = mediaObject.getStreamIndex()
+        self.mediaObjects.append(mediaObject)
+
+        for table, merged in [(index.keys, self.keys), (index.values, self.values)]:
+            for item, positions in table.items():
+                merged.setdefault(item, []).extend((mediaObject, index.streamIndices[position])
+                                                   for position in positions)
+
+    def streamsWithKey(self, key):
+        """
+
+        :param key: string, key or dotted key path
+        :return: list[(MediaObject, int)], MediaObjects and the 'index' of their streams that contain key
+        """
+        return list(self.keys.get(key, []))
+
+    def streamsWithValue(self, value):
+        """
+
+        :param value: value to search for
+        :return: list[(MediaObject, int)], MediaObjects and the 'index' of their streams that contain value
+        """
+        try:
+            return list(self.values.get(value, []))
+        except TypeError:
+            return []
+
+
+def flattenStream(nestedDict, prefix, flat):
+    """ Adds every key of a nested dictionary to flat, both as a plain key and as a dotted path. A plain key keeps the
+     first value found in a depth first walk that checks a dictionary's own keys before it's nested dictionaries.
+
+    :param nestedDict: dict
+    :param prefix: string, dotted path of nestedDict
+    :param flat: dict, flattened keys and their values
+    :return:
+    """
+    for key, value in nestedDict.items():
+        flat.setdefault(key, value)
+        if prefix:
+            flat.setdefault(prefix + key, value)
+    for key, value in nestedDict.items():
+        if hasattr(value, 'items'):
+            flattenStream(value, prefix + key + '.', flat)
+
+
+def walkValues(nestedDict):
+    for value in nestedDict.values():
+        yield value
+        if hasattr(value, 'items'):
+            for nestedValue in walkValues(value):
+                yield nestedValue
@@ -9,17 +9,19 @@ from .util import get_dir_size, list_dirs, split_ext
 from .concat import concat_files_in_directory
 
 
-def quick_clip(file_path, start_time, end_time, output_path=''):
+def quick_clip(file_path, start_time, end_time, output_path='', keyframe_seek=True):
     """
     Clips file between start_time and end_time. Copies all stream in file between time codes.
     :param file_path: string, path of file to clip
     :param start_time: string, timecode of when to start clip
     :param end_time: string, timecode of when to stop clip
     :param output_path: string, optional, path of output file
+    :param keyframe_seek: bool, start the clip on the keyframe at or before start_time, found with the file's cached
+                          keyframe index
     :return:
     """
     media = MediaObject(file_path)
-    cvt = MediaConverter(media, output_path)
+    cvt = MediaConverter(media, output_path, keyframeSeek=keyframe_seek)
 
     for videoIndex in media.videoStreams:
         cvt.createVideoStream('copy', 'copy', 0, videoStream=videoIndex)
@@ -31,8 +33,33 @@ def quick_clip(file_path, start_time, end_time, output_path=''):
     cvt.clip(start_time, end_time)
 
 
+def batch_clip(file_path, clips, keyframe_seek=True, clips_per_run=32):
+    """ Cuts many clips out of one file, copying all streams like quick_clip() does for each. The file is probed
+     once and the clips are cut clips_per_run at a time, each batch in one ffmpeg run, instead of starting ffmpeg and
+     re-reading the file's headers for every clip.
+
+    :param file_path: string, path of file to clip
+    :param clips: list[(string, string, string)], start timecode, end timecode and output path of each clip, an empty
+                  output path names the clip after the file
+    :param keyframe_seek: bool, start each clip on the keyframe at or before it's start, see quick_clip()
+    :param clips_per_run: int, most clips cut by one ffmpeg run
+    :return: list[string], paths of the clips that were written
+    """
+    media = MediaObject(file_path)
+    cvt = MediaConverter(media, keyframeSeek=keyframe_seek)
+
+    for videoIndex in media.videoStreams:
+        cvt.createVideoStream('copy', 'copy', 0, videoStream=videoIndex)
+
+    for audioIndex in media.audioStreams:
+        cvt.createAudioStream(audioEncoder='copy', audioStream=audioIndex)
+
+    cvt.createSubtitleStreams(media.subtitleStreams)
+    return cvt.clipMany(clips, clips_per_run)
+
+
 def convert_files_in_dir_to_vcodec(input_folder, video_codec, video_encoder, rate_control_method, video_rate, speed,
-                                   audio_encoder, audio_bitrate, channels):
+                                   audio_encoder, audio_bitrate, channels, probe_profile='full'):
     """ Searches directory for videos NOT encoded with video_codec, moves them to a separate file and encodes them
      to the selected codec, saving the encodes in the original directory. Retains all streams.
 
@@ -45,6 +72,7 @@ def convert_files_in_dir_to_vcodec(input_folder, video_codec, video_encoder, rat
     :param audio_encoder: string, audio encoder ('opus', 'aac', 'fdk', etc...)
     :param audio_bitrate: int, bitrate of audio
     :param channels: string, channel layout of audio ('mono', 'stereo')
+    :param probe_profile: string, 'full' or 'fast' ffprobe profile used to find the files to convert
     :return:
     """
 
@@ -52,7 +80,7 @@ def convert_files_in_dir_to_vcodec(input_folder, video_codec, video_encoder, rat
     original_files_dir = path.join(input_folder, "original_files/")
 
     # figure out what isn't the codec and move those to original_files_dir
-    sorting_media_array = makeMediaObjectsInDirectory(input_folder)
+    sorting_media_array = makeMediaObjectsInDirectory(input_folder, lazy=True, probeProfile=probe_profile)
     if len(sorting_media_array) < 1:
         return
 
@@ -167,9 +195,20 @@ def concat_files_grouped_in_folders(parent_dir, alphabetical=True, delete_source
         concat_files_in_directory(directory, alphabetical, delete_source)
 
 
-def calc_bits_per_pixel(media_object):
+def calc_bits_per_pixel(media_object, measured_bitrate=False):
+    """ Video bits per pixel per frame of a file.
+
+    :param media_object: MediaObject
+    :param measured_bitrate: bool, use the video bitrate measured from the file's packets (needs numpy) instead of
+                             the tagged or inferred one
+    :return: float, -1 if it can't be calculated
+    """
     media = media_object
     video_bitrate = media.video_bitrate
+    if measured_bitrate:
+        profile = media.getBitrateProfile()
+        if profile is not None:
+            video_bitrate = profile.totalMean(media.videoStreams)
     pixels = media.width * media.height
     framerate = media.framerate_dec
     try:
@@ -181,27 +220,37 @@ def calc_bits_per_pixel(media_object):
     return bits_pixel
 
 
-def save_bits_per_pixel_dist(parent_dir, output_file_path, exclude_codec):
+def save_bits_per_pixel_dist(parent_dir, output_file_path, exclude_codec, probe_profile='full', catalog=None):
     """ Calculates the bits/pixel of files in parent_dir and outputs data as a csv. Useful for visualizing
     bits/pixel in excel/calc to define intervals in convert_sub_dirs.py or more introspection.
 
     :param parent_dir: string, Path of directory that contains media files to analyze
     :param output_file_path: string, path of where you want the .csv file
     :param exclude_codec: string, codec of files you want to exclude 'hevc' for 265 and 'avc1' for 264
+    :param probe_profile: string, 'full' or 'fast' ffprobe profile, see MediaObject()
+    :param catalog: Catalog, answer from a catalog instead of probing every file. Only valid files are written.
     :return:
     """
     directories = sorted(list_dirs(parent_dir))
     with open(output_file_path, 'w', encoding='utf8') as file:
         file.write("{},{} bits,{} bits,{} bytes,{}\n".format("bits/pixel", "video bitrate", "audio bitrate", "file size", "file path"))
-        for dirs in directories:
-            media_array = sorted(makeMediaObjectsInDirectory(dirs), key=lambda media: media.fileName)
-
-            for media in media_array:
-                if media.videoCodec != exclude_codec:
-                    bits_pixel = calc_bits_per_pixel(media)
-                    video_bitrate = media.video_bitrate
-
-                    file.write("{},{},{},{},{}\n".format(bits_pixel, video_bitrate, media.audio_bitrate,media.file_size, media.filePath))
+        if catalog is not None:
+            entries = catalog.select([('directory', 'in', [path.abspath(dirs) for dirs in directories]),
+                                      ('valid', '=', 1), ('video_codec', '!=', exclude_codec)],
+                                     order_by=['directory', 'file_name'])
+            for entry in entries:
+                file.write("{},{},{},{},{}\n".format(entry['bits_per_pixel'], entry['video_bitrate'],
+                                                     entry['audio_bitrate'], entry['size'], entry['path']))
+        else:
+            for dirs in directories:
+                media_array = sorted(makeMediaObjectsInDirectory(dirs, probeProfile=probe_profile), key=lambda media: media.fileName)
+
+                for media in media_array:
+                    if media.videoCodec != exclude_codec:
+                        bits_pixel = calc_bits_per_pixel(media)
+                        video_bitrate = media.video_bitrate
+
+                        file.write("{},{},{},{},{}\n".format(bits_pixel, video_bitrate, media.audio_bitrate,media.file_size, media.filePath))
         file.close()
 
 
@@ -1,4 +1,4 @@
-from os import path, listdir, walk
+from os import path, listdir, walk, scandir
 
 
 def split_ext(file_name):
@@ -24,6 +24,27 @@ def list_files(dir_path):
     return files
 
 
+def list_entries(dir_path):
+    """
+    Lists a directory's files and sub directories in one os.scandir pass, with the stat results scandir already has.
+    :param dir_path: string, path of directory to list
+    :return: (dict, list), {file name: (size, mtime in nanoseconds, inode)} and paths of sub directories
+    """
+    files = {}
+    dirs = []
+    with scandir(dir_path) as entries:
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    dirs.append(entry.path)
+                elif entry.is_file():
+                    st = entry.stat()
+                    files[entry.name] = (st.st_size, st.st_mtime_ns, st.st_ino)
+            except OSError:
+                continue
+    return files, dirs
+
+
 def get_dir_size(directory_path):
     """
     Gets the size of files in a folder. Non-recursive, ignores folders.